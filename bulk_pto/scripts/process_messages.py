@@ -1,82 +1,359 @@
+import os
 import json
 import time
+import uuid
 import signal
 import threading
 import logging
+from collections import deque
 
-from google.cloud import pubsub_v1
-from pto_update.models import PTO
+from pto_update.mirror import ready_mirror, start_mirror
+from pto_update.models import PTO, id_prefix_range
+from pto_update.watch import PTOWatch
+from bulk_pto.snapshot import BulkSnapshot, parse_version
 from utils.dashboard_events import build_dashboard_payload
-from google.cloud import logging as cloud_logging
-
-# Initialize Google Cloud Logging
-cloud_client = cloud_logging.Client()
-cloud_client.setup_logging()
+from utils.dashboard_publisher import get_dashboard_publisher
+from utils.subscriber_settings import subscribe_options
+from utils.single_flight import SingleFlight
+from utils.supervision import await_stream, restart_delay
+from utils.structured_logging import level_for, log_payload
+from utils import gcp_clients, metrics
 
 # Standard logger setup
 logger = logging.getLogger("bulk_pto_lookup")
-logger.setLevel(logging.INFO)
+logger.setLevel(level_for("bulk_pto"))
 
 # GCP configuration
-project_id = "hopkinstimesheetproj"
 subscription_name = "bulk_pto_queue-sub"
-dashboard_topic = f"projects/{project_id}/topics/dashboard-queue"
-subscription_path = pubsub_v1.SubscriberClient().subscription_path(project_id, subscription_name)
+subscription_path = gcp_clients.subscription_path(subscription_name)
+
+# Streaming mode publishes the collection in sequenced chunks instead of one blob.
+streaming_enabled = os.getenv("BULK_PTO_STREAMING", "False") == "True"
+page_size = int(os.getenv("BULK_PTO_PAGE_SIZE", "1000"))
+chunk_size = int(os.getenv("BULK_PTO_CHUNK_SIZE", "1000"))
+max_inflight_chunks = 4
+
+# Snapshot mode answers triggers from memory. A pto collection listener
+# keeps it current with writes from every pod and process; PTO writes in this
+# process are applied at once. While the listener is down the snapshot falls
+# back to a full rescan once it is older than max age.
+snapshot = None
+snapshot_watch = None
+if os.getenv("BULK_PTO_SNAPSHOT_ENABLED", "False") == "True":
+    snapshot = BulkSnapshot(float(os.getenv("BULK_PTO_SNAPSHOT_MAX_AGE_SECONDS", "300")))
+    PTO.add_change_listener(snapshot.apply)
+    if os.getenv("BULK_PTO_SNAPSHOT_LISTEN", "True") == "True":
+        snapshot_watch = PTOWatch("bulk snapshot", snapshot.load, snapshot.apply)
 
-# Pub/Sub clients
-subscriber = pubsub_v1.SubscriberClient()
-publisher = pubsub_v1.PublisherClient()
+# Triggers that arrive while a scan is running are queued, without holding
+# a callback thread, and answered together by one follow-up scan.
+scans = SingleFlight()
+
+# Pub/Sub publishing goes through the shared dashboard publisher
+dashboard_publisher = get_dashboard_publisher()
 
 # Graceful shutdown event
 shutdown_event = threading.Event()
+streaming_pull_future = None
 
 def signal_handler(sig, frame):
     logger.info("Shutdown signal received. Exiting gracefully...")
     shutdown_event.set()
+    if streaming_pull_future is not None:
+        streaming_pull_future.cancel()
 
-def callback(message):
+def publish_streamed_records(scan_id, records, extra_payload=None, scan_ids=None):
+    """
+    Publish (employee_id, balance) pairs as bulk_pto_lookup_chunk messages of
+    at most chunk_size records, followed by a bulk_pto_lookup_complete marker.
+    Only one chunk and a few unresolved publishes are held at a time. Every
+    message carries scan_ids, the IDs of all requests the stream answers.
+    """
+    scan_ids = scan_ids or [scan_id]
+    inflight = deque()
+    sequence = 0
+    total = 0
+    chunk = []
+
+    def publish_chunk(records):
+        payload = build_dashboard_payload(
+            "all",
+            "bulk_pto_lookup_chunk",
+            f"Bulk PTO lookup chunk {sequence}.",
+            {"scan_id": scan_id, "scan_ids": scan_ids, "sequence": sequence, "pto_records": records}
+        )
+        if len(inflight) >= max_inflight_chunks:
+            inflight.popleft().result()
+        inflight.append(dashboard_publisher.publish(payload))
+
+    for employee_id, balance in records:
+        chunk.append({"employee_id": employee_id, "pto_balance": balance})
+        total += 1
+        if len(chunk) >= chunk_size:
+            publish_chunk(chunk)
+            sequence += 1
+            chunk = []
+    if chunk:
+        publish_chunk(chunk)
+        sequence += 1
+
+    while inflight:
+        inflight.popleft().result()
+
+    msg_str = f"Bulk PTO lookup: found {total} records."
+    payload = build_dashboard_payload(
+        "all",
+        "bulk_pto_lookup_complete",
+        msg_str,
+        {
+            "scan_id": scan_id, "scan_ids": scan_ids, "chunk_count": sequence, "record_count": total,
+            **(extra_payload or {}),
+        }
+    )
+    dashboard_publisher.publish(payload).result()
+    logger.info(f"{msg_str} Streamed in {sequence} chunks (scan {scan_id}).")
+
+def publish_bulk_records(pto_list, message, extra_payload=None):
+    # message may be a list of messages answered by the same payload.
+    msg_str = f"Bulk PTO lookup: found {len(pto_list)} records."
+    logger.info(msg_str)
+
+    # Build a dashboard payload containing all PTO records.
+    payload = build_dashboard_payload(
+        "all",                    # Use a special identifier (e.g., "all") for bulk messages.
+        "bulk_pto_lookup",        # Type to indicate this is a bulk PTO lookup message.
+        msg_str,
+        {"pto_records": pto_list, **(extra_payload or {})}
+    )
+
+    dashboard_publisher.publish(payload, ack=message)
+    logger.debug("Queued bulk PTO lookup update to dashboard topic; ack deferred until publish completes.")
+
+def parse_target(trigger):
+    """
+    (employee_ids, prefix) a trigger asks for; both None means the whole
+    collection. Given both, only the listed IDs with that prefix are returned.
+    """
+    employee_ids = trigger.get("employee_ids")
+    if employee_ids is not None:
+        if not isinstance(employee_ids, list):
+            raise ValueError("employee_ids must be a list")
+        employee_ids = list(dict.fromkeys(str(employee_id) for employee_id in employee_ids))
+    prefix = trigger.get("prefix")
+    if prefix is not None and not isinstance(prefix, str):
+        raise ValueError("prefix must be a string")
+    return employee_ids, prefix or None
+
+def read_targeted(employee_ids, prefix):
+    """Batched reads of just the requested records, as a list of pto_records entries."""
+    if employee_ids is not None:
+        if prefix:
+            employee_ids = [employee_id for employee_id in employee_ids if employee_id.startswith(prefix)]
+        balances = PTO.get_many(employee_ids)
+        return [
+            {"employee_id": employee_id, "pto_balance": balance}
+            for employee_id, balance in balances.items() if balance is not None
+        ]
+    mirror = ready_mirror()
+    if mirror is not None:
+        return mirror.records(prefix)
+    start_at, end_before = id_prefix_range(prefix)
+    return [
+        {"employee_id": employee_id, "pto_balance": balance}
+        for employee_id, balance in PTO.iter_balances(page_size=page_size, start_at=start_at, end_before=end_before)
+    ]
+
+def respond_targeted(trigger, employee_ids, prefix, stream, message):
+    # Answered from the snapshot when it is fresh, otherwise with reads that
+    # scale with the number of requested records, not the collection.
+    extra_payload = {}
+    if snapshot is not None and snapshot.is_fresh():
+        version, pto_list = snapshot.subset(employee_ids, prefix)
+        extra_payload.update({"snapshot_id": snapshot.snapshot_id, "version": version})
+    else:
+        pto_list = read_targeted(employee_ids, prefix)
+
+    if employee_ids is not None:
+        found = {record["employee_id"] for record in pto_list}
+        extra_payload["not_found"] = [
+            employee_id for employee_id in employee_ids
+            if employee_id not in found and (not prefix or employee_id.startswith(prefix))
+        ]
+    if prefix:
+        extra_payload["prefix"] = prefix
+
+    if stream:
+        records = ((record["employee_id"], record["pto_balance"]) for record in pto_list)
+        publish_streamed_records(trigger.get("request_id") or uuid.uuid4().hex, records, extra_payload)
+        message.ack()
+    else:
+        publish_bulk_records(pto_list, message, extra_payload)
+
+def stream_scan(waiters):
+    """
+    Answer queued (scan_id, message) stream triggers with one scan. Its
+    chunks carry every waiter's scan_id, so each client can match them.
+    """
+    scan_ids = [scan_id for scan_id, _ in waiters]
     try:
-        logger.info("Received bulk PTO lookup message.")
-        data = json.loads(message.data.decode("utf-8"))
-        logger.info(f"Bulk PTO lookup trigger payload: {data}")
-
-        # Retrieve all PTO objects from the database.
-        all_pto = PTO.all()
-        pto_list = [{"employee_id": p.employee_id, "pto_balance": p.balance} for p in all_pto]
-        msg_str = f"Bulk PTO lookup: found {len(pto_list)} records."
-        logger.info(msg_str)
+        publish_streamed_records(scan_ids[0], PTO.iter_balances(page_size=page_size), scan_ids=scan_ids)
+    except Exception:
+        logger.exception(f"Streamed bulk PTO lookup failed for {len(waiters)} triggers.")
+        for _, message in waiters:
+            message.nack()
+        return
+    for _, message in waiters:
+        message.ack()
+
+def scan_all(waiters):
+    """
+    Answer queued (request_id, message) triggers with one whole-collection
+    read and one publish. The payload lists the waiters' request_ids.
+    """
+    try:
+        pto_list = [{"employee_id": p.employee_id, "pto_balance": p.balance} for p in PTO.all()]
+    except Exception:
+        logger.exception(f"Bulk PTO scan failed for {len(waiters)} triggers.")
+        for _, message in waiters:
+            message.nack()
+        return
+    # One payload answers every waiter; each is acked once it is published.
+    # request_id is kept for clients that match on it, as stream_scan keeps scan_id.
+    request_ids = [request_id for request_id, _ in waiters if request_id]
+    extra_payload = {"request_id": request_ids[0], "request_ids": request_ids} if request_ids else None
+    publish_bulk_records(pto_list, [message for _, message in waiters], extra_payload)
 
-        # Build a dashboard payload containing all PTO records.
+def rescan_snapshot(waiters):
+    """Reload a cold or expired snapshot once, then answer queued (trigger, stream, message) triggers."""
+    try:
+        if not snapshot.is_fresh():
+            snapshot.load(PTO.iter_balances(page_size=page_size))
+    except Exception:
+        logger.exception(f"Bulk PTO snapshot rescan failed for {len(waiters)} triggers.")
+        for _, _, message in waiters:
+            message.nack()
+        return
+    for trigger, stream, message in waiters:
+        try:
+            answer_from_snapshot(trigger, stream, message)
+        except Exception:
+            logger.exception("Error answering bulk PTO lookup from snapshot:")
+            message.nack()
+
+def respond_from_snapshot(trigger, stream, message):
+    listening = snapshot_watch is not None and snapshot_watch.ensure_running()
+    if listening or snapshot.is_fresh():
+        answer_from_snapshot(trigger, stream, message)
+        return
+    logger.info("Bulk PTO snapshot is cold or expired; rescanning the pto collection.")
+    if not scans.run_or_queue("snapshot", (trigger, stream, message), rescan_snapshot):
+        logger.info("Queued behind the in-flight snapshot rescan.")
+
+def answer_from_snapshot(trigger, stream, message):
+    since_version = parse_version(trigger.get("since_version"))
+    if since_version is None and trigger.get("since_version") is not None:
+        logger.warning(f"Ignoring invalid since_version {trigger.get('since_version')!r}; sending the full snapshot.")
+    if since_version is not None and trigger.get("snapshot_id", snapshot.snapshot_id) == snapshot.snapshot_id:
+        version, changes = snapshot.changes_since(since_version)
+        msg_str = f"Bulk PTO lookup: {len(changes)} records changed since version {since_version}."
+        logger.info(msg_str)
         payload = build_dashboard_payload(
-            "all",                    # Use a special identifier (e.g., "all") for bulk messages.
-            "bulk_pto_lookup",        # Type to indicate this is a bulk PTO lookup message.
+            "all",
+            "bulk_pto_delta",
             msg_str,
-            {"pto_records": pto_list}
+            {
+                "snapshot_id": snapshot.snapshot_id,
+                "version": version,
+                "since_version": since_version,
+                "pto_records": changes,
+            }
         )
+        dashboard_publisher.publish(payload, ack=message)
+        return
 
-        publisher.publish(dashboard_topic, json.dumps(payload).encode("utf-8"))
-        logger.info("Published bulk PTO lookup update to dashboard topic.")
+    version, pto_list = snapshot.records()
+    extra_payload = {"snapshot_id": snapshot.snapshot_id, "version": version}
+    if stream:
+        records = ((record["employee_id"], record["pto_balance"]) for record in pto_list)
+        publish_streamed_records(trigger.get("request_id") or uuid.uuid4().hex, records, extra_payload)
         message.ack()
-        logger.info("Message acknowledged.")
+    else:
+        publish_bulk_records(pto_list, message, extra_payload)
+
+def callback(message):
+    try:
+        logger.debug("Received bulk PTO lookup message.")
+        with metrics.stage("decode"):
+            raw_data = message.data.decode("utf-8")
+            data = json.loads(raw_data)
+        log_payload(logger, "bulk_pto", raw_data)
+
+        trigger = data if isinstance(data, dict) else {}
+        stream = streaming_enabled or bool(trigger.get("stream"))
+        employee_ids, prefix = parse_target(trigger)
+
+        mirror = None if snapshot is not None else ready_mirror()
+        if employee_ids is not None or prefix:
+            respond_targeted(trigger, employee_ids, prefix, stream, message)
+        elif snapshot is not None:
+            # Checked before the mirror: only the snapshot can answer since_version with a delta.
+            respond_from_snapshot(trigger, stream, message)
+        elif mirror is not None:
+            # The mirror holds the whole collection; answer without reads.
+            pto_list = mirror.records()
+            extra_payload = {"mirror_staleness_seconds": mirror.stats()["staleness_seconds"]}
+            if stream:
+                records = ((record["employee_id"], record["pto_balance"]) for record in pto_list)
+                publish_streamed_records(trigger.get("request_id") or uuid.uuid4().hex, records, extra_payload)
+                message.ack()
+            else:
+                publish_bulk_records(pto_list, message, extra_payload)
+        elif stream:
+            # Acked once the stream answering it has been published.
+            waiter = (trigger.get("request_id") or uuid.uuid4().hex, message)
+            if not scans.run_or_queue("stream", waiter, stream_scan):
+                logger.info("Queued streamed bulk PTO lookup behind the scan in flight.")
+        else:
+            if not scans.run_or_queue("all", (trigger.get("request_id"), message), scan_all):
+                logger.info("Queued bulk PTO lookup behind the scan in flight.")
 
     except Exception as e:
         logger.exception(f"Error processing bulk PTO lookup message: {str(e)}")
         message.nack()
 
 def listen_for_messages():
+    global streaming_pull_future
     logger.info(f"Listening to Pub/Sub subscription: {subscription_path}")
 
     while not shutdown_event.is_set():
         try:
-            future = subscriber.subscribe(subscription_path, callback=callback)
+            streaming_pull_future = future = gcp_clients.get_subscriber_client().subscribe(
+                subscription_path, callback=metrics.instrument("bulk_pto", callback),
+                **subscribe_options("bulk_pto")
+            )
             logger.info("Bulk PTO lookup service is now actively listening for messages...")
-            future.result()  # Blocks until failure
+            await_stream(future, "bulk_pto")
         except Exception as e:
-            logger.exception("Pub/Sub listener crashed. Restarting in 5 seconds...")
-            time.sleep(5)  # Avoid rapid crash loop
+            if shutdown_event.is_set():
+                break
+            delay = restart_delay("bulk_pto")
+            logger.exception(f"Pub/Sub listener crashed. Restarting in {delay:.1f} seconds...")
+            shutdown_event.wait(delay)
 
 
+def start_listeners():
+    """Start the snapshot and mirror listeners; the asyncio engine calls this too."""
+    if snapshot_watch is not None:
+        snapshot_watch.start()
+    start_mirror()
+
+def stop_listeners():
+    if snapshot_watch is not None:
+        snapshot_watch.stop()
+
 def run():
+    gcp_clients.setup_cloud_logging()
+
     if threading.current_thread() == threading.main_thread():
         signal.signal(signal.SIGINT, signal_handler)
         signal.signal(signal.SIGTERM, signal_handler)
@@ -86,20 +363,21 @@ def run():
     # Heartbeat to signal liveness
     def heartbeat():
         while not shutdown_event.is_set():
-            logger.info("Heartbeat: Bulk PTO Lookup microservice is alive")
+            logger.info(f"Heartbeat: Bulk PTO Lookup microservice is alive. Coalesced triggers: {scans.coalesced}")
             time.sleep(300)
 
     threading.Thread(target=heartbeat, daemon=True).start()
+    start_listeners()
 
     try:
         listen_for_messages()
     except Exception as e:
         logger.exception("Unhandled exception in run().")
     finally:
-        try:
-            subscriber.close()
-            logger.info("Subscriber client closed.")
-        except Exception as e:
-            logger.warning("Failed to close subscriber cleanly: %s", e)
+        stop_listeners()
+        # The subscriber client is shared; only this service's stream is cancelled here.
+        if streaming_pull_future is not None:
+            streaming_pull_future.cancel()
+            logger.info("Subscriber stream cancelled.")
 
         logger.info("Bulk PTO Lookup microservice shut down.")
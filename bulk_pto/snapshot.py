@@ -0,0 +1,116 @@
+import time
+import uuid
+import threading
+from typing import Iterable, List, Optional, Tuple
+
+
+def parse_version(value) -> Optional[int]:
+    """A client's since_version as a non-negative int, or None if absent or malformed."""
+    if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+        return None
+    try:
+        version = int(value)
+    except (TypeError, ValueError):
+        return None
+    return version if version >= 0 else None
+
+
+class BulkSnapshot:
+    """
+    In-memory copy of every PTO balance with a monotonically increasing
+    version. Each changed or deleted employee remembers the version at which
+    it last changed, so deltas can be served without touching Firestore.
+
+    snapshot_id identifies this process's version sequence; a client holding
+    a version from another snapshot_id must take a full response.
+    """
+
+    def __init__(self, max_age_seconds: float):
+        self.max_age_seconds = max_age_seconds
+        self.snapshot_id = uuid.uuid4().hex
+        self.version = 0
+        self.loaded_at = None
+        self._balances = {}
+        self._changed_at = {}
+        self._loading_writes = None
+        self._lock = threading.Lock()
+
+    def is_fresh(self) -> bool:
+        if self.loaded_at is None:
+            return False
+        return self.max_age_seconds <= 0 or time.monotonic() - self.loaded_at < self.max_age_seconds
+
+    def load(self, records: Iterable[Tuple[str, int]]):
+        """
+        Rebuild from a full scan. Employees whose balance differs from the
+        previous snapshot get a new version; writes that land while the scan
+        is running win over the scanned values.
+        """
+        with self._lock:
+            self._loading_writes = {}
+
+        try:
+            scanned = dict(records)
+        except Exception:
+            with self._lock:
+                self._loading_writes = None
+            raise
+
+        with self._lock:
+            scanned.update(self._loading_writes)
+            self._loading_writes = None
+            for employee_id in self._balances.keys() - scanned.keys():
+                self._set(employee_id, None)
+            for employee_id, balance in scanned.items():
+                self._set(employee_id, balance)
+            self.loaded_at = time.monotonic()
+
+    def apply(self, employee_id: str, balance: Optional[int]):
+        """Change listener for PTO writes; balance None means deleted."""
+        with self._lock:
+            if self._loading_writes is not None:
+                self._loading_writes[employee_id] = balance
+            if self.loaded_at is not None:
+                self._set(employee_id, balance)
+
+    def _set(self, employee_id: str, balance: Optional[int]):
+        if balance is None:
+            if employee_id not in self._balances:
+                return
+            del self._balances[employee_id]
+        elif self._balances.get(employee_id) == balance:
+            return
+        else:
+            self._balances[employee_id] = balance
+        self.version += 1
+        self._changed_at[employee_id] = self.version
+
+    def records(self) -> Tuple[int, List[dict]]:
+        with self._lock:
+            return self.version, [
+                {"employee_id": employee_id, "pto_balance": balance}
+                for employee_id, balance in self._balances.items()
+            ]
+
+    def subset(self, employee_ids: Optional[List[str]] = None,
+               prefix: Optional[str] = None) -> Tuple[int, List[dict]]:
+        """records() restricted to the given employee IDs and/or an ID prefix."""
+        with self._lock:
+            candidates = self._balances.keys() if employee_ids is None else employee_ids
+            return self.version, [
+                {"employee_id": employee_id, "pto_balance": self._balances[employee_id]}
+                for employee_id in candidates
+                if employee_id in self._balances and (not prefix or employee_id.startswith(prefix))
+            ]
+
+    def changes_since(self, since_version: int) -> Tuple[int, List[dict]]:
+        with self._lock:
+            changes = []
+            for employee_id, version in self._changed_at.items():
+                if version <= since_version:
+                    continue
+                if employee_id in self._balances:
+                    changes.append({"employee_id": employee_id, "pto_balance": self._balances[employee_id]})
+                else:
+                    changes.append({"employee_id": employee_id, "deleted": True})
+            return self.version, changes
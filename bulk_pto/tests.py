@@ -1,3 +1,230 @@
-from django.test import TestCase
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase
+
+import bulk_pto.scripts.process_messages as bulk_pto_service
+from bulk_pto.snapshot import BulkSnapshot, parse_version
+from pto_update.models import PTO
+
+
+class BulkSnapshotTests(SimpleTestCase):
+    def loaded(self, records):
+        snapshot = BulkSnapshot(max_age_seconds=300)
+        snapshot.load(records)
+        return snapshot
+
+    def test_not_fresh_until_loaded(self):
+        snapshot = BulkSnapshot(max_age_seconds=300)
+        self.assertFalse(snapshot.is_fresh())
+        snapshot.load([("E1", 10)])
+        self.assertTrue(snapshot.is_fresh())
+
+    def test_writes_before_the_first_load_are_ignored(self):
+        snapshot = BulkSnapshot(max_age_seconds=300)
+        snapshot.apply("E1", 10)
+        self.assertEqual(snapshot.records(), (0, []))
+
+    def test_changes_since_returns_changed_and_deleted_records(self):
+        snapshot = self.loaded([("E1", 10), ("E2", 20)])
+        version = snapshot.version
+        snapshot.apply("E1", 15)
+        snapshot.apply("E2", None)
+        snapshot.apply("E3", 30)
+        new_version, changes = snapshot.changes_since(version)
+        self.assertEqual(new_version, version + 3)
+        self.assertCountEqual(changes, [
+            {"employee_id": "E1", "pto_balance": 15},
+            {"employee_id": "E2", "deleted": True},
+            {"employee_id": "E3", "pto_balance": 30},
+        ])
+
+    def test_unchanged_balance_does_not_bump_the_version(self):
+        snapshot = self.loaded([("E1", 10)])
+        version = snapshot.version
+        snapshot.apply("E1", 10)
+        snapshot.apply("E9", None)
+        self.assertEqual(snapshot.version, version)
+
+    def test_reload_versions_only_the_differences(self):
+        snapshot = self.loaded([("E1", 10), ("E2", 20)])
+        version = snapshot.version
+        snapshot.load([("E1", 10), ("E3", 30)])
+        _, changes = snapshot.changes_since(version)
+        self.assertCountEqual(changes, [
+            {"employee_id": "E2", "deleted": True},
+            {"employee_id": "E3", "pto_balance": 30},
+        ])
+
+    def test_writes_during_a_load_win_over_scanned_values(self):
+        snapshot = self.loaded([("E1", 10)])
+
+        def scan():
+            yield "E1", 10
+            snapshot.apply("E1", 5)
+            yield "E2", 20
+
+        snapshot.load(scan())
+        self.assertEqual(dict((r["employee_id"], r["pto_balance"]) for r in snapshot.records()[1]), {"E1": 5, "E2": 20})
+
+    def test_subset_by_ids_and_prefix(self):
+        snapshot = self.loaded([("A1", 1), ("A2", 2), ("B1", 3)])
+        self.assertEqual(snapshot.subset(["A2", "B1", "C9"])[1], [
+            {"employee_id": "A2", "pto_balance": 2},
+            {"employee_id": "B1", "pto_balance": 3},
+        ])
+        self.assertCountEqual(snapshot.subset(prefix="A")[1], [
+            {"employee_id": "A1", "pto_balance": 1},
+            {"employee_id": "A2", "pto_balance": 2},
+        ])
+        self.assertEqual(snapshot.subset(["A1", "B1"], prefix="B")[1], [{"employee_id": "B1", "pto_balance": 3}])
+
+
+class ParseVersionTests(SimpleTestCase):
+    def test_valid_versions(self):
+        self.assertEqual(parse_version(0), 0)
+        self.assertEqual(parse_version("42"), 42)
+        self.assertEqual(parse_version(7.0), 7)
+
+    def test_malformed_versions_are_rejected(self):
+        for value in (None, "abc", "", -1, 1.5, True, [], {}):
+            self.assertIsNone(parse_version(value), value)
+
+
+class FakeMessage:
+    def __init__(self):
+        self.acked = False
+        self.nacked = False
+
+    def ack(self):
+        self.acked = True
+
+    def nack(self):
+        self.nacked = True
+
+
+class ScanAllTests(SimpleTestCase):
+    def test_coalesced_waiters_share_one_publish(self):
+        waiters = [("r1", FakeMessage()), (None, FakeMessage()), ("r3", FakeMessage())]
+        with mock.patch.object(bulk_pto_service.PTO, "all", return_value=[PTO("E1", 4), PTO("E2", 0)]), \
+                mock.patch.object(bulk_pto_service, "dashboard_publisher") as publisher:
+            bulk_pto_service.scan_all(waiters)
+        publisher.publish.assert_called_once()
+        payload = publisher.publish.call_args[0][0]["payload"]
+        self.assertEqual(payload["request_ids"], ["r1", "r3"])
+        self.assertEqual(payload["request_id"], "r1")
+        self.assertEqual(len(payload["pto_records"]), 2)
+        self.assertEqual(publisher.publish.call_args[1]["ack"], [message for _, message in waiters])
+
+    def test_failed_scan_nacks_every_waiter(self):
+        waiters = [("r1", FakeMessage()), ("r2", FakeMessage())]
+        with mock.patch.object(bulk_pto_service.PTO, "all", side_effect=RuntimeError("unavailable")), \
+                mock.patch.object(bulk_pto_service, "dashboard_publisher") as publisher:
+            bulk_pto_service.scan_all(waiters)
+        publisher.publish.assert_not_called()
+        self.assertTrue(all(message.nacked for _, message in waiters))
+
+
+class FakePublishFuture:
+    def __init__(self, pending):
+        self.pending = pending
+        pending.add(self)
+
+    def result(self):
+        self.pending.discard(self)
+
+
+class PublishStreamedRecordsTests(SimpleTestCase):
+    def stream(self, records, **kwargs):
+        pending = set()
+        published = []
+
+        def publish(payload):
+            # (payload, futures still unresolved once this one is added)
+            future = FakePublishFuture(pending)
+            published.append((payload, len(pending)))
+            return future
+
+        with mock.patch.object(bulk_pto_service, "chunk_size", 2), \
+                mock.patch.object(bulk_pto_service, "max_inflight_chunks", 2), \
+                mock.patch.object(bulk_pto_service, "dashboard_publisher") as publisher:
+            publisher.publish.side_effect = publish
+            bulk_pto_service.publish_streamed_records("s1", iter(records), **kwargs)
+        return published
+
+    def test_chunks_are_sequenced_and_followed_by_a_complete_marker(self):
+        records = [(f"E{i}", i) for i in range(5)]
+        published = self.stream(records, extra_payload={"version": 7}, scan_ids=["s1", "s2"])
+        chunks = [payload["payload"] for payload, _ in published[:-1]]
+        self.assertEqual([chunk["sequence"] for chunk in chunks], [0, 1, 2])
+        self.assertEqual([len(chunk["pto_records"]) for chunk in chunks], [2, 2, 1])
+        self.assertEqual(chunks[0]["pto_records"][0], {"employee_id": "E0", "pto_balance": 0})
+        self.assertTrue(all(chunk["scan_ids"] == ["s1", "s2"] for chunk in chunks))
+
+        complete, outstanding = published[-1]
+        self.assertEqual(complete["type"], "bulk_pto_lookup_complete")
+        keys = ("scan_id", "scan_ids", "chunk_count", "record_count", "version")
+        self.assertEqual(
+            {key: complete["payload"][key] for key in keys},
+            {"scan_id": "s1", "scan_ids": ["s1", "s2"], "chunk_count": 3, "record_count": 5, "version": 7},
+        )
+        # Every chunk was confirmed before the marker went out.
+        self.assertEqual(outstanding, 1)
+
+    def test_in_flight_chunk_publishes_are_bounded(self):
+        published = self.stream([(f"E{i}", i) for i in range(20)])
+        self.assertEqual(max(outstanding for _, outstanding in published), 2)
+
+    def test_scan_ids_default_to_the_scan_id(self):
+        published = self.stream([])
+        self.assertEqual(len(published), 1)
+        self.assertEqual(published[0][0]["payload"]["scan_ids"], ["s1"])
+        self.assertEqual(published[0][0]["payload"]["chunk_count"], 0)
+
+
+class ParseTargetTests(SimpleTestCase):
+    def test_no_target_means_the_whole_collection(self):
+        self.assertEqual(bulk_pto_service.parse_target({}), (None, None))
+        self.assertEqual(bulk_pto_service.parse_target({"prefix": ""}), (None, None))
+
+    def test_ids_are_stringified_and_deduplicated_in_order(self):
+        self.assertEqual(
+            bulk_pto_service.parse_target({"employee_ids": ["E2", 7, "E2", "E1"], "prefix": "E"}),
+            (["E2", "7", "E1"], "E"),
+        )
+
+    def test_malformed_targets_are_rejected(self):
+        for trigger in ({"employee_ids": "E1"}, {"employee_ids": {"E1": 1}}, {"prefix": 7}, {"prefix": ["E"]}):
+            with self.subTest(trigger=trigger), self.assertRaises(ValueError):
+                bulk_pto_service.parse_target(trigger)
+
+    def test_malformed_target_nacks_the_trigger(self):
+        message = FakeMessage()
+        message.data = b'{"employee_ids": "E1"}'
+        with mock.patch.object(bulk_pto_service, "dashboard_publisher") as publisher:
+            bulk_pto_service.callback(message)
+        self.assertTrue(message.nacked)
+        publisher.publish.assert_not_called()
+
+
+class ReadTargetedTests(SimpleTestCase):
+    def test_listed_ids_are_filtered_by_prefix_and_read_in_one_batch(self):
+        with mock.patch.object(bulk_pto_service.PTO, "get_many", return_value={"E1": 4, "E2": None}) as get_many:
+            records = bulk_pto_service.read_targeted(["E1", "X1", "E2"], "E")
+        get_many.assert_called_once_with(["E1", "E2"])
+        self.assertEqual(records, [{"employee_id": "E1", "pto_balance": 4}])
+
+    def test_prefix_is_answered_by_a_ready_mirror(self):
+        mirror = mock.Mock()
+        mirror.records.return_value = [{"employee_id": "E1", "pto_balance": 4}]
+        with mock.patch.object(bulk_pto_service, "ready_mirror", return_value=mirror), \
+                mock.patch.object(bulk_pto_service.PTO, "iter_balances") as iter_balances:
+            self.assertEqual(bulk_pto_service.read_targeted(None, "E"), mirror.records.return_value)
+        mirror.records.assert_called_once_with("E")
+        iter_balances.assert_not_called()
+
+    def test_prefix_without_a_mirror_scans_only_its_id_range(self):
+        with mock.patch.object(bulk_pto_service, "ready_mirror", return_value=None), \
+                mock.patch.object(bulk_pto_service.PTO, "iter_balances", return_value=iter([("E1", 4)])) as scan:
+            records = bulk_pto_service.read_targeted(None, "E")
+        self.assertEqual(records, [{"employee_id": "E1", "pto_balance": 4}])
+        self.assertEqual((scan.call_args[1]["start_at"], scan.call_args[1]["end_before"]), ("E", "F"))
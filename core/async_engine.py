@@ -0,0 +1,542 @@
+"""
+asyncio-native consumer engine (PTO_SERVICE_MODE=asyncio).
+
+Four PTO handlers run as coroutines on one event loop. Messages are pulled
+with the async Pub/Sub GAPIC clients and Firestore is reached through
+AsyncClient. Acks are batched per subscription and dashboard publishes are
+batched across services. refresh_data events are the exception: they go
+through the shared dashboard publisher, so they are coalesced like the
+threaded workers' and ack their messages once published.
+
+One concurrency limit spans all services, and each pull asks for no more
+messages than there are free slots, so nothing pulled waits to start. Every
+message's lease is extended until it is acked or nacked. On shutdown the
+engine stops pulling and drains what it has pulled before cancelling
+anything.
+
+Bulk lookups are not reimplemented here: the threaded bulk_pto callback runs
+on a small thread pool, with its chunked streaming, snapshot deltas and
+coalesced scans, and acks or nacks through a message shim when it is done.
+
+Message parsing and dashboard payloads reuse the threaded services' helpers,
+so both engines share the same business rules.
+"""
+import os
+import json
+import time
+import asyncio
+import logging
+import signal
+from concurrent.futures import ThreadPoolExecutor
+
+from google.pubsub_v1.services.publisher import PublisherAsyncClient
+from google.pubsub_v1.services.subscriber import SubscriberAsyncClient
+from google.pubsub_v1.types import PubsubMessage
+
+import bulk_pto.scripts.process_messages as bulk_pto_service
+import pto_deduction.scripts.process_messages as pto_deduction_service
+import pto_update.scripts.process_messages as pto_update_service
+import pto_usage.scripts.process_messages as pto_usage_service
+import user_pto.scripts.process_messages as user_pto_service
+from pto_update import idempotency, ledger
+from pto_update.async_models import AsyncPTOStore
+from pto_update.mirror import start_mirror
+from pto_update.models import BalanceChange
+from utils import gcp_clients, metrics
+from utils.batch_envelope import batch_payload, invalid_result, item_result, operation_request_id, operations_of
+from utils.dashboard_events import build_dashboard_payload
+from utils.dashboard_publisher import dashboard_topic, get_dashboard_publisher
+from utils.subscriber_settings import executor_workers_for, max_lease_seconds_for
+from utils.supervision import health_registry, restart_delay
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+ASYNC_CONCURRENCY = int(os.getenv("PTO_ASYNC_CONCURRENCY", "1000"))
+ASYNC_PULL_MAX_MESSAGES = int(os.getenv("PTO_ASYNC_PULL_MAX_MESSAGES", "100"))
+ASYNC_FLUSH_INTERVAL_MS = int(os.getenv("PTO_ASYNC_FLUSH_INTERVAL_MS", "10"))
+# Unsettled messages have their ack deadline pushed out to ASYNC_LEASE_SECONDS
+# every ASYNC_LEASE_INTERVAL_SECONDS, up to the service's max lease.
+ASYNC_LEASE_SECONDS = int(os.getenv("PTO_ASYNC_LEASE_SECONDS", "60"))
+ASYNC_LEASE_INTERVAL_SECONDS = float(os.getenv("PTO_ASYNC_LEASE_INTERVAL_SECONDS", "5"))
+# modify_ack_deadline accepts at most this many ack IDs per call.
+MAX_ACK_IDS_PER_REQUEST = 2500
+# On shutdown, messages already pulled get this long to finish and be
+# settled before their handlers are cancelled; keep it under the pod's
+# termination grace period.
+ASYNC_DRAIN_TIMEOUT_SECONDS = float(os.getenv("PTO_ASYNC_DRAIN_TIMEOUT_SECONDS", "20"))
+
+# The event loop only keeps weak references to tasks, so fire-and-forget
+# tasks are held here until they finish.
+_background_tasks = set()
+
+
+def spawn(coro):
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+class _Batcher:
+    """Collects items and hands them to send(items) every interval or max_items."""
+
+    def __init__(self, send, max_items: int, interval: float):
+        self.send = send
+        self.max_items = max_items
+        self.interval = interval
+        self._items = []
+        self._full = asyncio.Event()
+
+    def add(self, item):
+        self._items.append(item)
+        if len(self._items) >= self.max_items:
+            self._full.set()
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            while self._items:
+                batch, self._items = self._items[:self.max_items], self._items[self.max_items:]
+                spawn(self.send(batch))
+
+
+class ThreadedHandler:
+    """
+    A threaded service callback(message) run from the engine on its own
+    thread pool. The callback owns ack/nack, which may come later and from
+    another thread.
+    """
+
+    def __init__(self, service: str, callback, start=None, stop=None):
+        self.service = service
+        self.callback = callback
+        self.start = start
+        self.stop = stop
+        self.executor = None
+
+
+class PulledMessage:
+    """A pulled message shaped like a streaming-pull Message for threaded callbacks."""
+
+    __slots__ = ("_engine", "_loop", "_subscription", "_ack_id", "data", "message_id", "attributes",
+                 "ordering_key", "publish_time")
+
+    def __init__(self, engine, loop, subscription: str, received):
+        self._engine = engine
+        self._loop = loop
+        self._subscription = subscription
+        self._ack_id = received.ack_id
+        message = received.message
+        self.data = message.data
+        self.message_id = message.message_id
+        self.attributes = dict(message.attributes)
+        self.ordering_key = message.ordering_key
+        self.publish_time = message.publish_time
+
+    def _call(self, fn, *args):
+        try:
+            self._loop.call_soon_threadsafe(fn, *args)
+        except RuntimeError:
+            # The loop has shut down; the message is redelivered.
+            pass
+
+    def ack(self):
+        self._call(self._engine.ack, self._subscription, self._ack_id)
+
+    def nack(self):
+        self._call(self._engine.nack_soon, self._subscription, self._ack_id)
+
+
+class AsyncEngine:
+    def __init__(self, concurrency: int = ASYNC_CONCURRENCY, store=None, subscriber=None, publisher=None,
+                 dashboard_publisher=None):
+        if ledger.LEDGER_MODE:
+            raise RuntimeError("PTO_LEDGER_MODE is not supported by the asyncio engine; use threads or processes.")
+        self.store = store or AsyncPTOStore()
+        self.subscriber = subscriber or SubscriberAsyncClient()
+        self.publisher = publisher or PublisherAsyncClient()
+        # refresh_data events go through the shared publisher, so they are
+        # coalesced with the threaded workers' (see utils.refresh_coalescer).
+        self.dashboard_publisher = dashboard_publisher or get_dashboard_publisher()
+        self.concurrency = concurrency
+        self.in_flight = 0
+        self._capacity = asyncio.Condition()
+        self.stopping = asyncio.Event()
+        interval = ASYNC_FLUSH_INTERVAL_MS / 1000.0
+        self.publishes = _Batcher(self._send_publishes, 100, interval)
+        self.ack_batchers = {}
+        self.interval = interval
+        # subscription -> {ack_id: monotonic time after which the lease is no longer extended}
+        self.leases = {}
+        # Tasks handling pulled messages, awaited on shutdown.
+        self.handling = set()
+
+    # -- Pub/Sub plumbing -------------------------------------------------
+
+    async def _send_publishes(self, batch):
+        try:
+            await self.publisher.publish(topic=dashboard_topic, messages=[message for message, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for _, future in batch:
+            if not future.done():
+                future.set_result(None)
+
+    async def publish(self, payload):
+        future = asyncio.get_running_loop().create_future()
+        self.publishes.add((PubsubMessage(data=json.dumps(payload).encode("utf-8")), future))
+        await future
+
+    def _ack_batcher(self, subscription: str) -> _Batcher:
+        batcher = self.ack_batchers.get(subscription)
+        if batcher is None:
+            async def send(ack_ids):
+                try:
+                    await self.subscriber.acknowledge(subscription=subscription, ack_ids=ack_ids)
+                except Exception:
+                    logger.exception(f"Failed to acknowledge {len(ack_ids)} messages on {subscription}")
+
+            batcher = self.ack_batchers[subscription] = _Batcher(send, 1000, self.interval)
+            spawn(batcher.run())
+        return batcher
+
+    def ack(self, subscription: str, ack_id: str):
+        self.release_lease(subscription, ack_id)
+        self._ack_batcher(subscription).add(ack_id)
+
+    def nack_soon(self, subscription: str, ack_id: str):
+        spawn(self.nack(subscription, ack_id))
+
+    async def nack(self, subscription: str, ack_id: str):
+        self.release_lease(subscription, ack_id)
+        try:
+            await self.subscriber.modify_ack_deadline(
+                subscription=subscription, ack_ids=[ack_id], ack_deadline_seconds=0
+            )
+        except Exception:
+            logger.exception(f"Failed to nack message on {subscription}")
+
+    # -- Leases and capacity ----------------------------------------------
+
+    def hold_lease(self, service: str, subscription: str, ack_id: str):
+        self.leases.setdefault(subscription, {})[ack_id] = time.monotonic() + max_lease_seconds_for(service)
+
+    def release_lease(self, subscription: str, ack_id: str):
+        self.leases.get(subscription, {}).pop(ack_id, None)
+
+    async def extend_leases(self):
+        """Push out the ack deadline of every message not yet acked or nacked."""
+        now = time.monotonic()
+        for subscription, held in self.leases.items():
+            for ack_id in [ack_id for ack_id, until in held.items() if until <= now]:
+                # Past the max lease: let Pub/Sub redeliver it.
+                del held[ack_id]
+            ack_ids = list(held)
+            for start in range(0, len(ack_ids), MAX_ACK_IDS_PER_REQUEST):
+                try:
+                    await self.subscriber.modify_ack_deadline(
+                        subscription=subscription,
+                        ack_ids=ack_ids[start:start + MAX_ACK_IDS_PER_REQUEST],
+                        ack_deadline_seconds=ASYNC_LEASE_SECONDS,
+                    )
+                except Exception:
+                    logger.exception(f"Failed to extend {len(ack_ids)} leases on {subscription}")
+
+    async def _lease_loop(self):
+        while True:
+            await asyncio.sleep(ASYNC_LEASE_INTERVAL_SECONDS)
+            await self.extend_leases()
+
+    async def reserve(self, limit: int) -> int:
+        """Wait for at least one free slot, then take up to limit of them."""
+        async with self._capacity:
+            await self._capacity.wait_for(lambda: self.in_flight < self.concurrency)
+            reserved = min(limit, self.concurrency - self.in_flight)
+            self.in_flight += reserved
+            return reserved
+
+    async def release(self, count: int = 1):
+        async with self._capacity:
+            self.in_flight -= count
+            self._capacity.notify_all()
+
+    # -- Message handling -------------------------------------------------
+
+    async def _handle_threaded(self, service: str, subscription: str, handler: ThreadedHandler, received):
+        loop = asyncio.get_running_loop()
+        message = metrics.InstrumentedMessage(PulledMessage(self, loop, subscription, received), service)
+        try:
+            await loop.run_in_executor(handler.executor, handler.callback, message)
+        except Exception:
+            logger.exception(f"Error handling message on {subscription}:")
+            message.nack()
+        finally:
+            # The slot is freed when the callback returns, even if the ack comes
+            # later (e.g. a trigger queued behind a scan); the lease stays held.
+            await self.release()
+
+    async def _handle(self, service: str, subscription: str, handler, received):
+        loop = asyncio.get_running_loop()
+        message = metrics.InstrumentedMessage(PulledMessage(self, loop, subscription, received), service)
+        try:
+            payloads = await handler(self, received.message)
+            refreshes = [payload for payload in payloads if payload.get("type") == "refresh_data"]
+            started = loop.time()
+            for payload in payloads:
+                if payload.get("type") != "refresh_data":
+                    await self.publish(payload)
+            metrics.STAGE_DURATION.labels("publish").observe(loop.time() - started)
+            if refreshes:
+                # Acked (or nacked) by the dashboard publisher, as in the threaded workers.
+                for payload in refreshes[:-1]:
+                    self.dashboard_publisher.publish(payload)
+                self.dashboard_publisher.publish(refreshes[-1], ack=message)
+            else:
+                message.ack()
+        except Exception:
+            logger.exception(f"Error handling message on {subscription}:")
+            message.nack()
+        finally:
+            await self.release()
+
+    async def consume(self, service: str, subscription: str, handler):
+        logger.info(f"Async consumer pulling from {subscription}")
+        handle = self._handle_threaded if isinstance(handler, ThreadedHandler) else self._handle
+        failing = False
+        while not self.stopping.is_set():
+            # Only pull what we have capacity to start right away.
+            reserved = await self.reserve(ASYNC_PULL_MAX_MESSAGES)
+            try:
+                response = await self.subscriber.pull(subscription=subscription, max_messages=reserved, timeout=30)
+            except asyncio.CancelledError:
+                await self.release(reserved)
+                raise
+            except Exception:
+                await self.release(reserved)
+                if not self.stopping.is_set():
+                    failing = True
+                    delay = restart_delay(service)
+                    logger.exception(f"Pull from {subscription} failed; retrying in {delay:.1f} seconds.")
+                    await asyncio.sleep(delay)
+                continue
+            if failing:
+                failing = False
+                health_registry.record_healthy(service)
+
+            received = list(response.received_messages)
+            if len(received) < reserved:
+                await self.release(reserved - len(received))
+            for message in received:
+                self.hold_lease(service, subscription, message.ack_id)
+                task = spawn(handle(service, subscription, handler, message))
+                self.handling.add(task)
+                task.add_done_callback(self.handling.discard)
+
+    def unsettled(self) -> int:
+        return sum(len(held) for held in self.leases.values())
+
+    async def drain(self, timeout: float = ASYNC_DRAIN_TIMEOUT_SECONDS):
+        """
+        Let pulled messages finish and be settled for up to timeout seconds,
+        then cancel what is left; those messages are redelivered.
+        """
+        deadline = time.monotonic() + timeout
+        if self.handling:
+            await asyncio.wait(set(self.handling), timeout=timeout)
+        # Publish pending refreshes now; their acks come back through the loop.
+        self.dashboard_publisher.flush()
+        while self.unsettled() and time.monotonic() < deadline:
+            await asyncio.sleep(self.interval)
+        if self.handling or self.unsettled():
+            logger.warning(
+                f"Shutting down with {len(self.handling)} handlers running and {self.unsettled()} messages unsettled."
+            )
+        for task in list(self.handling):
+            task.cancel()
+
+    async def run(self, consumers):
+        start_mirror()
+        threaded = [handler for _, _, handler in consumers if isinstance(handler, ThreadedHandler)]
+        for handler in threaded:
+            handler.executor = ThreadPoolExecutor(
+                max_workers=executor_workers_for(handler.service), thread_name_prefix=f"{handler.service}-callback"
+            )
+            if handler.start is not None:
+                handler.start()
+        spawn(self.publishes.run())
+        lease_task = spawn(self._lease_loop())
+        tasks = [
+            asyncio.create_task(self.consume(service, subscription, handler))
+            for service, subscription, handler in consumers
+        ]
+        await self.stopping.wait()
+        # Stop pulling, then let what was pulled finish before cancelling it.
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.drain()
+        lease_task.cancel()
+        for handler in threaded:
+            if handler.stop is not None:
+                handler.stop()
+            # Triggers still queued are redelivered once their leases lapse.
+            handler.executor.shutdown(wait=False)
+        # Let queued publishes and acks go out before returning.
+        await asyncio.sleep(self.interval * 2)
+
+
+# -- Handlers: one coroutine per service, each returning dashboard payloads --
+
+# Bulk lookups reuse the threaded service whole: see the module docstring.
+handle_bulk_lookup = ThreadedHandler(
+    "bulk_pto", bulk_pto_service.callback, bulk_pto_service.start_listeners, bulk_pto_service.stop_listeners
+)
+
+
+# Batch envelopes are handled like the threaded services' process_envelope:
+# one batched read and one commit per envelope, with operations on the same
+# employee merged into one change.
+
+def envelope_requests(service, message, operations, fields):
+    """(index, (key, employee_id, hours)) per valid operation, and results with the invalid ones filled in."""
+    requests = []
+    results = [None] * len(operations)
+    for index, operation in enumerate(operations):
+        try:
+            employee_id, hours, _ = fields(operation)
+        except Exception as e:
+            results[index] = invalid_result(operation, e)
+            continue
+        key = idempotency.key_for(service, message, operation_request_id(message, operation, index))
+        requests.append((index, (key, employee_id, hours)))
+    return requests, results
+
+
+async def handle_deduction(engine, message):
+    data = pto_deduction_service.decode_message(message)
+    operations = operations_of(data)
+    if operations is not None:
+        requests, results = envelope_requests(
+            "pto_deduction", message, operations, pto_deduction_service.deduction_fields
+        )
+        if requests:
+            outcomes = await engine.store.commit_deductions_once([request for _, request in requests])
+            for (index, (_, employee_id, _)), (_, balance, duplicate) in zip(requests, outcomes):
+                results[index] = item_result(employee_id, "duplicate" if duplicate else "ok", balance)
+        return [batch_payload("pto_deduction", data, results)]
+
+    employee_id, pto_deduction, request_id = pto_deduction_service.deduction_fields(data)
+    key = idempotency.key_for("pto_deduction", message, request_id)
+    _, new_balance, _ = await engine.store.deduct_once(key, employee_id, pto_deduction)
+    logger.info(f"[SUCCESS] PTO for employee {employee_id} updated. New balance: {new_balance}")
+    return [build_dashboard_payload(employee_id, "refresh_data", "Please refresh dashboard data.", {})]
+
+
+async def handle_update(engine, message):
+    data = pto_update_service.decode_message(message)
+    operations = operations_of(data)
+    if operations is not None:
+        # Later updates for the same employee overwrite earlier ones.
+        changes = {}
+        results = []
+        for operation in operations:
+            try:
+                employee_id, new_balance = pto_update_service.update_fields(operation)
+            except Exception as e:
+                results.append(invalid_result(operation, e))
+                continue
+            changes.setdefault(str(employee_id), BalanceChange()).set(new_balance)
+            results.append(item_result(employee_id, "ok", new_balance))
+        if changes:
+            await engine.store.commit_changes(changes)
+        return [batch_payload("pto_update", data, results)]
+
+    employee_id, new_balance = pto_update_service.update_fields(data)
+    await engine.store.set_balance(employee_id, new_balance)
+    logger.info(f"[SUCCESS] PTO for employee_id {employee_id} updated to {new_balance}")
+    return [build_dashboard_payload(employee_id, "refresh_data", "Time log created, please refresh dashboard data.")]
+
+
+async def handle_usage(engine, message):
+    data = pto_usage_service.decode_message(message)
+    operations = operations_of(data)
+    if operations is not None:
+        # Sufficient-balance checks for the whole envelope share one transaction.
+        requests, results = envelope_requests("pto_usage", message, operations, pto_usage_service.usage_fields)
+        if requests:
+            outcomes = await engine.store.deduct_many_once([request for _, request in requests])
+            for (index, (_, employee_id, _)), outcome in zip(requests, outcomes):
+                results[index] = pto_usage_service.usage_result(employee_id, *outcome)
+        return [batch_payload("pto_usage", data, results)]
+
+    employee_id, pto_hours, request_id = pto_usage_service.usage_fields(data)
+    key = idempotency.key_for("pto_usage", message, request_id)
+    applied, balance, _ = await engine.store.deduct_once(key, employee_id, pto_hours, require_sufficient=True)
+    return [pto_usage_service.build_result_payload(employee_id, pto_hours, applied, balance)]
+
+
+async def handle_user_lookup(engine, message):
+    data = user_pto_service.decode_message(message)
+    operations = operations_of(data)
+    if operations is not None:
+        # One batched read for every lookup; missing records are created at 0 in one batched write.
+        employee_ids = []
+        results = [None] * len(operations)
+        for index, operation in enumerate(operations):
+            try:
+                employee_ids.append((index, str(operation["employee_id"])))
+            except Exception as e:
+                results[index] = invalid_result(operation, e)
+        balances = await engine.store.get_many([employee_id for _, employee_id in employee_ids])
+        missing = [employee_id for employee_id, balance in balances.items() if balance is None]
+        created = set(await engine.store.create_many(missing)) if missing else set()
+        raced = [employee_id for employee_id in missing if employee_id not in created]
+        if raced:
+            balances.update(await engine.store.get_many(raced))
+        for index, employee_id in employee_ids:
+            status = "created" if employee_id in created else "ok"
+            results[index] = item_result(employee_id, status, balances[employee_id] or 0)
+        return [batch_payload("user_pto", data, results)]
+
+    employee_id = data["employee_id"]
+    balance = await engine.store.get_balance(employee_id)
+    created = False
+    if balance is None:
+        created = bool(await engine.store.create_many([employee_id]))
+        balance = 0 if created else await engine.store.get_balance(employee_id)
+    return [user_pto_service.build_lookup_payload(employee_id, balance, created)]
+
+
+CONSUMERS = [
+    ("bulk_pto", bulk_pto_service.subscription_path, handle_bulk_lookup),
+    ("pto_deduction", pto_deduction_service.subscription_path, handle_deduction),
+    ("pto_update", pto_update_service.subscription_path, handle_update),
+    ("pto_usage", pto_usage_service.subscription_path, handle_usage),
+    ("user_pto", user_pto_service.subscription_path, handle_user_lookup),
+]
+
+
+def run_async_engine():
+    gcp_clients.setup_cloud_logging()
+
+    async def main():
+        engine = AsyncEngine()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, engine.stopping.set)
+        logger.info(f"Starting asyncio PTO engine with concurrency {ASYNC_CONCURRENCY}.")
+        await engine.run(CONSUMERS)
+        logger.info("Asyncio PTO engine shut down.")
+
+    try:
+        asyncio.run(main())
+    finally:
+        gcp_clients.close_all()
@@ -0,0 +1,50 @@
+from django.core.management import BaseCommand, CommandError
+import logging
+
+from pto_update.accrual import AccrualRules, AccrualRun
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+class Command(BaseCommand):
+    help = 'Add one pay period of accrued PTO hours to every employee'
+
+    def add_arguments(self, parser):
+        parser.add_argument('period', help='Pay period identifier, e.g. 2026-10-15; a period is applied once')
+        parser.add_argument('--rules', help='Path to a JSON accrual rule set')
+        parser.add_argument('--hours', type=int, help='Flat accrual for every employee when no rule set is given')
+        parser.add_argument('--max-balance', type=int, help='Cap accruals at this balance (with --hours)')
+        parser.add_argument('--page-size', type=int, default=1000)
+        parser.add_argument('--checkpoint-every', type=int, default=5000, help='Writes between checkpoints')
+        parser.add_argument('--max-ops-per-second', type=int, default=10000)
+        parser.add_argument('--workers', type=int, default=8, help='Commits in flight at once')
+        parser.add_argument('--restart', action='store_true', help='Ignore the saved checkpoint and rescan')
+        parser.add_argument('--dry-run', action='store_true', help='Compute accruals without writing')
+
+    def handle(self, *args, **options):
+        if options['rules']:
+            rules = AccrualRules.from_file(options['rules'])
+        elif options['hours'] is not None:
+            rules = AccrualRules(options['hours'], options['max_balance'])
+        else:
+            raise CommandError('Pass --rules or --hours.')
+        if options['workers'] < 1 or options['max_ops_per_second'] < 1:
+            raise CommandError('--workers and --max-ops-per-second must be positive.')
+
+        run = AccrualRun(
+            options['period'],
+            rules,
+            page_size=options['page_size'],
+            checkpoint_every=options['checkpoint_every'],
+            dry_run=options['dry_run'],
+            max_ops_per_second=options['max_ops_per_second'],
+            workers=options['workers'],
+            report=lambda line: self.stdout.write(line),
+        )
+        try:
+            summary = run.run(resume=not options['restart'])
+        except RuntimeError as e:
+            raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS(f"Accrual run finished: {summary}"))
+        if summary['failed']:
+            raise CommandError(f"{summary['failed']} writes failed; rerun the command to retry them.")
@@ -0,0 +1,43 @@
+from django.core.management import BaseCommand, CommandError
+import logging
+
+from pto_update.export import FORMATS, BalanceExport
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+class Command(BaseCommand):
+    help = 'Export PTO balances to compressed CSV and/or Parquet files, partitioned by employee ID range'
+
+    def add_arguments(self, parser):
+        parser.add_argument('output_dir', help='Directory for the partition files and manifest.json')
+        parser.add_argument('--format', dest='formats', action='append', choices=FORMATS,
+                            help='csv (gzip) and/or parquet; may be repeated, defaults to csv')
+        parser.add_argument('--fields', default='balance', help='Comma-separated document fields to export')
+        parser.add_argument('--split-at', default='', help='Comma-separated employee IDs starting each new partition')
+        parser.add_argument('--page-size', type=int, default=1000)
+        parser.add_argument('--row-group-size', type=int, default=100000, help='Rows buffered per written row group')
+        parser.add_argument('--workers', type=int, default=4, help='Partitions exported in parallel')
+
+    def handle(self, *args, **options):
+        fields = [field.strip() for field in options['fields'].split(',') if field.strip()]
+        if not fields:
+            raise CommandError('--fields needs at least one field.')
+        if options['row_group_size'] < 1 or options['workers'] < 1:
+            raise CommandError('--row-group-size and --workers must be positive.')
+
+        export = BalanceExport(
+            options['output_dir'],
+            formats=options['formats'] or ['csv'],
+            fields=fields,
+            split_at=[employee_id.strip() for employee_id in options['split_at'].split(',') if employee_id.strip()],
+            page_size=options['page_size'],
+            row_group_size=options['row_group_size'],
+            workers=options['workers'],
+            report=lambda line: self.stdout.write(line),
+        )
+        try:
+            summary = export.run()
+        except RuntimeError as e:
+            raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS(f"Export finished: {summary}"))
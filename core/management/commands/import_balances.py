@@ -0,0 +1,44 @@
+from django.core.management import BaseCommand, CommandError
+import os
+import logging
+
+from pto_update.bulk_import import BalanceImport
+from pto_update.models import MAX_BATCH_WRITES
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+class Command(BaseCommand):
+    help = 'Set PTO balances from a JSONL or CSV file of employee_id/balance rows'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='JSONL file, or CSV file with an employee_id,balance header')
+        parser.add_argument('--format', choices=['jsonl', 'csv'], help='Defaults to the file extension')
+        parser.add_argument('--run-id', help='Checkpoint name; defaults to the file name')
+        parser.add_argument('--chunk-size', type=int, default=MAX_BATCH_WRITES, help='Rows per batched commit')
+        parser.add_argument('--workers', type=int, default=8, help='Chunks committed in parallel')
+        parser.add_argument('--restart', action='store_true', help='Ignore the saved checkpoint and start over')
+        parser.add_argument('--dry-run', action='store_true', help='Print how balances would change without writing')
+
+    def handle(self, *args, **options):
+        if not os.path.isfile(options['path']):
+            raise CommandError(f"No such file: {options['path']}")
+        if options['chunk_size'] < 1 or options['workers'] < 1:
+            raise CommandError('--chunk-size and --workers must be positive.')
+
+        run = BalanceImport(
+            options['path'],
+            options['run_id'] or os.path.basename(options['path']),
+            file_format=options['format'],
+            chunk_size=options['chunk_size'],
+            workers=options['workers'],
+            dry_run=options['dry_run'],
+            report=lambda line: self.stdout.write(line),
+        )
+        try:
+            summary = run.run(resume=not options['restart'])
+        except RuntimeError as e:
+            raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS(f"Import finished: {summary}"))
+        if summary['invalid']:
+            raise CommandError(f"{summary['invalid']} rows were invalid and skipped; fix them and import those rows again.")
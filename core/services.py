@@ -0,0 +1,179 @@
+from threading import Event, Lock, Thread, Timer, current_thread, main_thread
+from importlib import import_module
+import logging
+import queue
+import signal
+import time
+import os
+
+from utils import gcp_clients
+from utils.supervision import STABLE_AFTER_SECONDS, backoff_delay, health_registry
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# "threads" runs every service in this interpreter; "processes" runs each in
+# its own supervised child process (see core.supervisor); "asyncio" runs all
+# handlers as coroutines on one event loop (see core.async_engine).
+SERVICE_MODE = os.getenv("PTO_SERVICE_MODE", "threads")
+
+SERVICES = [
+    'bulk_pto.scripts.process_messages',
+    'pto_deduction.scripts.process_messages',
+    'pto_update.scripts.process_messages',
+    'pto_usage.scripts.process_messages',
+    'user_pto.scripts.process_messages',
+]
+
+
+def start_health_server():
+    import uvicorn
+
+    logger.info("Starting health check service on port 8080")
+    uvicorn.run("health:app", host="0.0.0.0", port=8080)
+
+
+def run_services(timings=None):
+    """
+    Start every PTO service in its own thread, plus the supervisor and health
+    server, and return the supervisor thread. When a timings dict is given,
+    the seconds spent importing each service and pre-warming clients are
+    recorded in it before the services start taking traffic.
+
+    Each service thread reports its own exit on a queue, so the supervisor
+    notices a dead service immediately and restarts it with exponential
+    backoff plus jitter. Services that keep failing are marked degraded in
+    the health registry, which /ready reports to Kubernetes.
+
+    SIGTERM and SIGINT are handled here, in the main thread, because the
+    services run in worker threads and cannot install handlers themselves.
+    A signal sets every service's shutdown event, and the supervisor thread
+    returns once all of them have exited.
+    """
+    timings = timings if timings is not None else {}
+    exits = queue.Queue()
+    stopping = Event()
+    running = {}
+    running_lock = Lock()
+
+    def service_key(service_name):
+        return service_name.split(".")[0]
+
+    def stop_services(sig=None, frame=None):
+        if not stopping.is_set():
+            logger.info("Shutdown signal received. Stopping all services...")
+        stopping.set()
+        with running_lock:
+            modules = list(running.values())
+        for module in modules:
+            module.signal_handler(sig, frame)
+
+    def launch_service(service_name):
+        logger.info(f"Launching service: {service_name}")
+        started = time.perf_counter()
+        module = import_module(service_name)
+        timings.setdefault(f"import {service_name}", time.perf_counter() - started)
+        with running_lock:
+            if stopping.is_set():
+                logger.info(f"Not starting {service_name}: shutting down.")
+                return
+            running[service_name] = module
+
+        def target():
+            started_at = time.monotonic()
+            try:
+                module.run()
+            except Exception:
+                logger.exception(f"Service {service_name} raised:")
+            finally:
+                exits.put((service_name, module, time.monotonic() - started_at))
+
+        Thread(target=target, name=service_name).start()
+        logger.info(f"Started {service_name}")
+
+    # Create the shared GCP clients once, before any service takes traffic
+    started = time.perf_counter()
+    gcp_clients.prewarm()
+    timings["prewarm GCP clients"] = time.perf_counter() - started
+
+    if current_thread() is main_thread():
+        signal.signal(signal.SIGINT, stop_services)
+        signal.signal(signal.SIGTERM, stop_services)
+
+    # Start all services
+    for service in SERVICES:
+        launch_service(service)
+
+    def supervise():
+        while True:
+            try:
+                service_name, module, uptime = exits.get(timeout=1.0)
+            except queue.Empty:
+                if stopping.is_set():
+                    # Re-signal services that were still subscribing when shutdown began.
+                    stop_services()
+                continue
+            with running_lock:
+                running.pop(service_name, None)
+                remaining = len(running)
+            if stopping.is_set() or module.shutdown_event.is_set():
+                logger.info(f"Service {service_name} shut down.")
+                if stopping.is_set() and not remaining:
+                    logger.info("All services shut down.")
+                    return
+                continue
+            key = service_key(service_name)
+            if uptime >= STABLE_AFTER_SECONDS:
+                health_registry.record_healthy(key)
+            delay = backoff_delay(health_registry.record_failure(key))
+            logger.warning(
+                f"Service thread {service_name} died after {uptime:.1f}s. Restarting in {delay:.1f}s."
+            )
+            restart = Timer(delay, launch_service, args=(service_name,))
+            restart.daemon = True
+            restart.start()
+
+    supervisor_thread = Thread(target=supervise, name="supervisor")
+    supervisor_thread.start()
+
+    # Start health check server in a separate thread (so it doesn’t block
+    # startup, nor keep the process alive once the services have stopped)
+    health_thread = Thread(target=start_health_server, name="health-server", daemon=True)
+    health_thread.start()
+
+    return supervisor_thread
+
+
+def wait_for_services(supervisor_thread):
+    # Block the main thread until every service has shut down. The join is
+    # interrupted by SIGTERM/SIGINT, so the handlers from run_services() run.
+    try:
+        supervisor_thread.join()
+    finally:
+        gcp_clients.close_all()
+
+
+def run_supervised(timings=None):
+    """Process mode: supervise one or more child processes per service."""
+    from core.supervisor import Supervisor
+
+    timings = timings if timings is not None else {}
+    started = time.perf_counter()
+    supervisor = Supervisor(SERVICES)
+    timings["create supervisor"] = time.perf_counter() - started
+
+    health_thread = Thread(target=start_health_server, name="health-server", daemon=True)
+    health_thread.start()
+    return supervisor
+
+
+def run_asyncio(timings=None):
+    """asyncio mode: every handler on one event loop; blocks until shutdown."""
+    timings = timings if timings is not None else {}
+    started = time.perf_counter()
+    from core.async_engine import run_async_engine
+    timings["import core.async_engine"] = time.perf_counter() - started
+
+    health_thread = Thread(target=start_health_server, name="health-server", daemon=True)
+    health_thread.start()
+    return run_async_engine
@@ -0,0 +1,198 @@
+import os
+import glob
+import time
+import signal
+import logging
+import threading
+import multiprocessing
+from importlib import import_module
+from multiprocessing.connection import wait
+
+from prometheus_client import multiprocess
+
+from utils import gcp_clients
+from utils.supervision import STABLE_AFTER_SECONDS, backoff_delay, health_registry
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+STATS_INTERVAL_SECONDS = float(os.getenv("PTO_SUPERVISOR_STATS_INTERVAL_SECONDS", "60"))
+# Where children write their metric samples for health.py to aggregate.
+DEFAULT_METRICS_DIR = "/tmp/pto-prometheus-multiproc"
+
+
+def prepare_metrics_dir() -> str:
+    """
+    Create (or empty) PROMETHEUS_MULTIPROC_DIR and export it, so children
+    spawned afterwards write their samples there. Files left by a previous
+    run would otherwise be aggregated as if their processes were alive.
+    """
+    path = os.getenv("PROMETHEUS_MULTIPROC_DIR") or DEFAULT_METRICS_DIR
+    os.makedirs(path, exist_ok=True)
+    for stale in glob.glob(os.path.join(path, "*.db")):
+        # Keep this process's own files: its metrics may already be open.
+        if not stale.endswith(f"_{os.getpid()}.db"):
+            os.remove(stale)
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = path
+    return path
+
+
+def processes_for(service_name: str) -> int:
+    # bulk_pto.scripts.process_messages -> BULK_PTO_PROCESSES
+    key = service_name.split(".")[0].upper()
+    return max(1, int(os.getenv(f"{key}_PROCESSES", "1")))
+
+
+def run_child(service_name: str):
+    """Entry point of a worker process: own clients, one service."""
+    module = import_module(service_name)
+    gcp_clients.prewarm()
+    try:
+        module.run()
+    finally:
+        gcp_clients.close_all()
+
+
+class ChildSlot:
+    """One supervised worker process for a service, restarted in place."""
+
+    def __init__(self, service_name: str, index: int):
+        self.service_name = service_name
+        self.index = index
+        self.process = None
+        self.started_at = None
+        self.starts = 0
+        self.consecutive_failures = 0
+        self.last_exitcode = None
+        self.restart_at = None
+
+    @property
+    def name(self) -> str:
+        return f"{self.service_name}[{self.index}]"
+
+    def stats(self) -> dict:
+        alive = self.process is not None and self.process.is_alive()
+        return {
+            "pid": self.process.pid if alive else None,
+            "alive": alive,
+            "starts": self.starts,
+            "restarts": max(0, self.starts - 1),
+            "consecutive_failures": self.consecutive_failures,
+            "last_exitcode": self.last_exitcode,
+            "uptime_seconds": round(time.monotonic() - self.started_at, 1) if alive else 0.0,
+        }
+
+
+class Supervisor:
+    """
+    Runs each service in one or more child processes so callback work is not
+    serialized on a single GIL. Child exits are noticed as soon as they
+    happen through the process sentinels, and each child is restarted with
+    exponential backoff plus jitter.
+    """
+
+    def __init__(self, services):
+        # spawn, not fork: children must not inherit gRPC state from the parent.
+        self.context = multiprocessing.get_context("spawn")
+        self.slots = [
+            ChildSlot(service_name, index)
+            for service_name in services
+            for index in range(processes_for(service_name))
+        ]
+        self.shutdown_event = threading.Event()
+        self.metrics_dir = None
+
+    def start_child(self, slot: ChildSlot):
+        slot.process = self.context.Process(target=run_child, args=(slot.service_name,), name=slot.name)
+        slot.process.start()
+        slot.started_at = time.monotonic()
+        slot.starts += 1
+        slot.restart_at = None
+        logger.info(f"Started {slot.name} as pid {slot.process.pid}")
+
+    def handle_exit(self, slot: ChildSlot):
+        slot.process.join()
+        slot.last_exitcode = slot.process.exitcode
+        if self.metrics_dir:
+            # Drop the dead child's live gauge samples (e.g. pto_messages_in_flight).
+            multiprocess.mark_process_dead(slot.process.pid, self.metrics_dir)
+        uptime = time.monotonic() - slot.started_at
+        if self.shutdown_event.is_set():
+            # Signalled along with the supervisor (e.g. SIGINT to the process group).
+            logger.info(f"{slot.name} exited with code {slot.last_exitcode} during shutdown.")
+            return
+        service = slot.service_name.split(".")[0]
+        if uptime >= STABLE_AFTER_SECONDS:
+            slot.consecutive_failures = 0
+            health_registry.record_healthy(service)
+        if slot.last_exitcode == 0:
+            # A clean exit is not a crash: restart after the base delay
+            # without growing the failure streak.
+            delay = backoff_delay(1)
+            slot.restart_at = time.monotonic() + delay
+            logger.info(f"{slot.name} (pid {slot.process.pid}) exited cleanly after {uptime:.1f}s. "
+                        f"Restarting in {delay:.1f}s.")
+            return
+        # Nonzero exit codes, and negative ones for children killed by a
+        # signal the supervisor did not send.
+        slot.consecutive_failures += 1
+        health_registry.record_failure(service)
+        delay = backoff_delay(slot.consecutive_failures)
+        slot.restart_at = time.monotonic() + delay
+        logger.warning(
+            f"{slot.name} (pid {slot.process.pid}) exited with code {slot.last_exitcode} "
+            f"after {uptime:.1f}s. Restarting in {delay:.1f}s."
+        )
+
+    def stats(self) -> dict:
+        return {slot.name: slot.stats() for slot in self.slots}
+
+    def stop(self, sig=None, frame=None):
+        self.shutdown_event.set()
+
+    def run(self):
+        if threading.current_thread() == threading.main_thread():
+            signal.signal(signal.SIGINT, self.stop)
+            signal.signal(signal.SIGTERM, self.stop)
+
+        self.metrics_dir = prepare_metrics_dir()
+        logger.info(f"Child metrics are aggregated from {self.metrics_dir}")
+        for slot in self.slots:
+            self.start_child(slot)
+
+        next_stats = time.monotonic() + STATS_INTERVAL_SECONDS
+        while not self.shutdown_event.is_set():
+            now = time.monotonic()
+            for slot in self.slots:
+                if slot.restart_at is not None and slot.restart_at <= now:
+                    self.start_child(slot)
+                elif slot.consecutive_failures and now - slot.started_at >= STABLE_AFTER_SECONDS:
+                    # Recovered: the restarted child has stayed up long enough.
+                    slot.consecutive_failures = 0
+                    health_registry.record_healthy(slot.service_name.split(".")[0])
+            if now >= next_stats:
+                logger.info(f"Supervisor process stats: {self.stats()}")
+                next_stats = now + STATS_INTERVAL_SECONDS
+
+            pending = [slot.restart_at for slot in self.slots if slot.restart_at is not None]
+            timeout = min([next_stats] + pending) - now
+            running = {slot.process.sentinel: slot for slot in self.slots if slot.restart_at is None}
+            # Wakes immediately when any child exits; capped so restarts and
+            # shutdown requests are picked up promptly.
+            for sentinel in wait(list(running), timeout=max(0.0, min(timeout, 1.0))):
+                self.handle_exit(running[sentinel])
+
+        self.terminate_children()
+
+    def terminate_children(self, timeout: float = 10.0):
+        alive = [slot.process for slot in self.slots if slot.process is not None and slot.process.is_alive()]
+        for process in alive:
+            process.terminate()
+        deadline = time.monotonic() + timeout
+        for process in alive:
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning(f"{process.name} did not exit after SIGTERM; killing it.")
+                process.kill()
+                process.join()
+        logger.info("All supervised service processes stopped.")
@@ -0,0 +1,769 @@
+import asyncio
+import json
+import logging
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from django.test import SimpleTestCase
+from google.cloud import firestore
+from google.cloud.firestore_v1.types import Value
+
+from core import services
+from core.supervisor import ChildSlot, Supervisor, prepare_metrics_dir
+from pto_update.async_models import AsyncPTOStore
+
+from utils.batch_envelope import batch_payload, invalid_result, item_result, operation_request_id, operations_of
+from utils.dashboard_events import build_dashboard_payload
+from utils.dashboard_publisher import DashboardPublisher
+from utils.metrics import DASHBOARD_PUBLISHES, DASHBOARD_REFRESH_SUPPRESSED
+from utils.micro_batch import MicroBatcher
+from utils.ordered_lanes import LaneDispatcher, employee_key
+from utils.refresh_coalescer import RefreshCoalescer
+from utils import structured_logging
+from utils.single_flight import SingleFlight
+from utils.structured_logging import level_for
+from utils.supervision import backoff_delay
+
+
+class FakeMessage:
+    def __init__(self, data=None, message_id=None):
+        self.data = data
+        self.message_id = message_id
+        self.acked = False
+        self.nacked = False
+
+    def ack(self):
+        self.acked = True
+
+    def nack(self):
+        self.nacked = True
+
+
+class MicroBatcherTests(SimpleTestCase):
+    def collecting_batcher(self, **kwargs):
+        batches = []
+        done = threading.Event()
+
+        def handler(batch):
+            batches.append(list(batch))
+            done.set()
+
+        batcher = MicroBatcher("test", handler, **kwargs)
+        batcher.start()
+        self.addCleanup(batcher.stop)
+        return batcher, batches, done
+
+    def test_full_batch_is_handed_over_without_waiting_for_latency(self):
+        batcher, batches, done = self.collecting_batcher(max_messages=3, max_latency_ms=60000)
+        messages = [FakeMessage() for _ in range(3)]
+        for message in messages:
+            batcher.submit(message)
+        self.assertTrue(done.wait(2))
+        self.assertEqual(batches, [messages])
+
+    def test_partial_batch_is_flushed_after_max_latency(self):
+        batcher, batches, done = self.collecting_batcher(max_messages=100, max_latency_ms=20)
+        messages = [FakeMessage(), FakeMessage()]
+        started = time.monotonic()
+        for message in messages:
+            batcher.submit(message)
+        self.assertTrue(done.wait(2))
+        self.assertGreaterEqual(time.monotonic() - started, 0.015)
+        self.assertEqual(batches, [messages])
+
+    def test_overflow_is_split_into_batches_of_max_messages(self):
+        batcher, batches, _ = self.collecting_batcher(max_messages=3, max_latency_ms=10)
+        messages = [FakeMessage() for _ in range(7)]
+        for message in messages:
+            batcher.submit(message)
+        deadline = time.monotonic() + 2
+        while sum(map(len, batches)) < 7 and time.monotonic() < deadline:
+            time.sleep(0.005)
+        self.assertTrue(all(len(batch) <= 3 for batch in batches))
+        self.assertEqual([message for batch in batches for message in batch], messages)
+
+    def test_failing_handler_nacks_every_message_of_the_batch(self):
+        handled = threading.Event()
+
+        def handler(batch):
+            handled.set()
+            raise RuntimeError("commit failed")
+
+        batcher = MicroBatcher("test", handler, max_messages=2, max_latency_ms=60000)
+        batcher.start()
+        messages = [FakeMessage(), FakeMessage()]
+        for message in messages:
+            batcher.submit(message)
+        self.assertTrue(handled.wait(2))
+        batcher.stop()
+        self.assertTrue(all(message.nacked for message in messages))
+
+    def test_stop_hands_over_pending_messages(self):
+        batcher, batches, _ = self.collecting_batcher(max_messages=100, max_latency_ms=60000)
+        message = FakeMessage()
+        batcher.submit(message)
+        batcher.stop()
+        self.assertEqual(batches, [[message]])
+
+
+class SingleFlightTests(SimpleTestCase):
+    def test_followers_share_the_leaders_result(self):
+        flight = SingleFlight()
+        started, release = threading.Event(), threading.Event()
+        calls, results = [], []
+
+        def scan():
+            calls.append(1)
+            started.set()
+            release.wait(2)
+            return "records"
+
+        leader = threading.Thread(target=lambda: results.append(flight.do("all", scan)))
+        leader.start()
+        self.assertTrue(started.wait(2))
+        follower = threading.Thread(target=lambda: results.append(flight.do("all", scan)))
+        follower.start()
+        while flight.coalesced < 1:
+            time.sleep(0.001)
+        release.set()
+        leader.join()
+        follower.join()
+        self.assertEqual(len(calls), 1)
+        self.assertCountEqual(results, [("records", False), ("records", True)])
+
+    def test_followers_see_the_leaders_exception(self):
+        flight = SingleFlight()
+        with self.assertRaises(RuntimeError):
+            flight.do("all", lambda: (_ for _ in ()).throw(RuntimeError("scan failed")))
+        # The failed call is forgotten, so the next caller leads again.
+        self.assertEqual(flight.do("all", lambda: 1), (1, False))
+
+    def test_run_or_queue_returns_at_once_and_answers_queued_waiters_in_one_more_run(self):
+        flight = SingleFlight()
+        started, release = threading.Event(), threading.Event()
+        runs = []
+
+        def run(waiters):
+            runs.append(list(waiters))
+            started.set()
+            release.wait(2)
+
+        leader = threading.Thread(target=flight.run_or_queue, args=("stream", "a", run))
+        leader.start()
+        self.assertTrue(started.wait(2))
+        self.assertFalse(flight.run_or_queue("stream", "b", run))
+        self.assertFalse(flight.run_or_queue("stream", "c", run))
+        release.set()
+        leader.join(2)
+        self.assertEqual(runs, [["a"], ["b", "c"]])
+        self.assertEqual(flight.coalesced, 2)
+
+    def test_run_or_queue_keeps_serving_after_a_failed_run(self):
+        flight = SingleFlight()
+        seen = []
+
+        def run(waiters):
+            seen.extend(waiters)
+            raise RuntimeError("publish failed")
+
+        self.assertTrue(flight.run_or_queue("stream", "a", run))
+        self.assertTrue(flight.run_or_queue("stream", "b", run))
+        self.assertEqual(seen, ["a", "b"])
+
+
+class FakeFuture:
+    def __init__(self, error=None):
+        self.error = error
+
+    def exception(self):
+        return self.error
+
+    def add_done_callback(self, fn):
+        fn(self)
+
+
+class FakePublisherClient:
+    def __init__(self, error=None):
+        self.error = error
+        self.published = []
+
+    def publish(self, topic, data, ordering_key=""):
+        self.published.append((topic, data))
+        return FakeFuture(self.error)
+
+    def resume_publish(self, topic, ordering_key):
+        pass
+
+
+class DashboardPublisherTests(SimpleTestCase):
+    def count(self, outcome):
+        return DASHBOARD_PUBLISHES.labels(outcome)._value.get()
+
+    def test_success_acks_and_is_exported(self):
+        before = self.count("success")
+        publisher = DashboardPublisher(client=FakePublisherClient(), topic="dashboard")
+        message = FakeMessage()
+        publisher.publish({"employee_id": 1}, ack=message)
+        self.assertTrue(message.acked)
+        self.assertEqual(self.count("success"), before + 1)
+        self.assertEqual(publisher.stats()["succeeded"], 1)
+
+    def test_failure_nacks_and_is_exported(self):
+        before = self.count("failure")
+        publisher = DashboardPublisher(client=FakePublisherClient(RuntimeError("unavailable")), topic="dashboard")
+        messages = [FakeMessage(), FakeMessage()]
+        publisher.publish({"employee_id": 1}, ack=messages)
+        self.assertTrue(all(message.nacked for message in messages))
+        self.assertEqual(self.count("failure"), before + 1)
+
+
+class BackoffDelayTests(SimpleTestCase):
+    def test_delay_doubles_per_failure_with_jitter_in_the_upper_half(self):
+        for failures, ceiling in ((1, 1), (2, 2), (3, 4), (5, 16)):
+            for _ in range(20):
+                delay = backoff_delay(failures, base=1, maximum=60)
+                self.assertGreaterEqual(delay, ceiling / 2)
+                self.assertLessEqual(delay, ceiling)
+
+    def test_delay_is_capped_at_maximum(self):
+        for _ in range(20):
+            self.assertLessEqual(backoff_delay(50, base=1, maximum=60), 60)
+            self.assertGreaterEqual(backoff_delay(50, base=1, maximum=60), 30)
+
+
+def fake_service(name):
+    """A module shaped like the services' process_messages scripts."""
+    module = types.ModuleType(name)
+    module.shutdown_event = threading.Event()
+    module.signal_handler = lambda sig, frame: module.shutdown_event.set()
+    module.run = lambda: module.shutdown_event.wait(10)
+    return module
+
+
+class RunServicesShutdownTests(SimpleTestCase):
+    def setUp(self):
+        self.modules = {name: fake_service(name) for name in ("fake_a.scripts.run", "fake_b.scripts.run")}
+        for name, module in self.modules.items():
+            patcher = mock.patch.dict(sys.modules, {name: module})
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        for target, value in (
+            ("SERVICES", list(self.modules)),
+            ("start_health_server", lambda: None),
+        ):
+            patcher = mock.patch.object(services, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(services.gcp_clients, "prewarm")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            self.addCleanup(signal.signal, sig, signal.getsignal(sig))
+
+    def test_sigterm_stops_every_service_and_the_supervisor_returns(self):
+        with mock.patch.object(services.gcp_clients, "close_all") as close_all:
+            supervisor_thread = services.run_services()
+            os.kill(os.getpid(), signal.SIGTERM)
+            services.wait_for_services(supervisor_thread)
+        self.assertTrue(all(module.shutdown_event.is_set() for module in self.modules.values()))
+        self.assertFalse(supervisor_thread.is_alive())
+        close_all.assert_called_once_with()
+
+    def test_worker_main_returns_after_sigterm_in_thread_mode(self):
+        from core import worker
+
+        with mock.patch.object(services.gcp_clients, "close_all") as close_all, \
+                mock.patch.object(services, "SERVICE_MODE", "threads"), \
+                mock.patch.object(worker, "print_startup_breakdown"):
+            threading.Timer(0.05, os.kill, args=(os.getpid(), signal.SIGTERM)).start()
+            worker.main()
+        close_all.assert_called_once_with()
+
+
+class FakeProcess:
+    def __init__(self, exitcode):
+        self.exitcode = exitcode
+        self.pid = 1234
+
+    def join(self, timeout=None):
+        pass
+
+
+class SupervisorExitTests(SimpleTestCase):
+    def exited_slot(self, exitcode, supervisor=None):
+        supervisor = supervisor or Supervisor([])
+        slot = ChildSlot("fake_service.scripts.run", 0)
+        slot.process = FakeProcess(exitcode)
+        slot.started_at = time.monotonic()
+        supervisor.handle_exit(slot)
+        return slot
+
+    def test_clean_exit_is_restarted_without_counting_a_failure(self):
+        slot = self.exited_slot(0)
+        self.assertEqual(slot.consecutive_failures, 0)
+        self.assertIsNotNone(slot.restart_at)
+
+    def test_nonzero_exit_and_unexpected_signal_count_as_failures(self):
+        for exitcode in (1, -signal.SIGKILL):
+            slot = self.exited_slot(exitcode)
+            self.assertEqual(slot.consecutive_failures, 1)
+            self.assertIsNotNone(slot.restart_at)
+
+    def test_exit_during_shutdown_is_neither_a_failure_nor_restarted(self):
+        supervisor = Supervisor([])
+        supervisor.stop()
+        slot = self.exited_slot(-signal.SIGINT, supervisor)
+        self.assertEqual(slot.consecutive_failures, 0)
+        self.assertIsNone(slot.restart_at)
+
+    def test_reaped_child_live_gauges_are_dropped(self):
+        supervisor = Supervisor([])
+        supervisor.metrics_dir = tempfile.mkdtemp()
+        live = os.path.join(supervisor.metrics_dir, "gauge_livesum_1234.db")
+        counter = os.path.join(supervisor.metrics_dir, "counter_1234.db")
+        for path in (live, counter):
+            open(path, "w").close()
+        self.exited_slot(1, supervisor)
+        self.assertFalse(os.path.exists(live))
+        self.assertTrue(os.path.exists(counter))
+
+
+class PrepareMetricsDirTests(SimpleTestCase):
+    def test_creates_clears_and_exports_the_directory(self):
+        path = os.path.join(tempfile.mkdtemp(), "metrics")
+        os.makedirs(path)
+        open(os.path.join(path, "counter_99.db"), "w").close()
+        with mock.patch.dict(os.environ, {"PROMETHEUS_MULTIPROC_DIR": path}):
+            self.assertEqual(prepare_metrics_dir(), path)
+            self.assertEqual(os.environ["PROMETHEUS_MULTIPROC_DIR"], path)
+        self.assertEqual(os.listdir(path), [])
+
+    def test_defaults_when_unset(self):
+        environ = {key: value for key, value in os.environ.items() if key != "PROMETHEUS_MULTIPROC_DIR"}
+        with mock.patch.dict(os.environ, environ, clear=True), \
+                mock.patch("core.supervisor.DEFAULT_METRICS_DIR", os.path.join(tempfile.mkdtemp(), "default")):
+            path = prepare_metrics_dir()
+            self.assertTrue(os.path.isdir(path))
+            self.assertEqual(os.environ["PROMETHEUS_MULTIPROC_DIR"], path)
+
+
+class RecordingPublisher:
+    def __init__(self):
+        self.published = []
+        self.flushed = threading.Event()
+
+    def publish(self, payload, ack=None):
+        self.published.append((payload, list(ack) if isinstance(ack, list) else ack))
+        self.flushed.set()
+
+    def stats(self):
+        return {}
+
+
+class RefreshCoalescerTests(SimpleTestCase):
+    def refresh(self, employee_id):
+        return {"employee_id": employee_id, "type": "refresh_data"}
+
+    def test_refreshes_within_the_window_are_published_once_with_every_message(self):
+        publisher = RecordingPublisher()
+        coalescer = RefreshCoalescer(publisher, window_ms=20)
+        suppressed = DASHBOARD_REFRESH_SUPPRESSED._value.get()
+        messages = [FakeMessage() for _ in range(3)]
+        for message in messages:
+            coalescer.publish(self.refresh(7), ack=message)
+        self.assertTrue(publisher.flushed.wait(2))
+        self.assertEqual(publisher.published, [(self.refresh(7), messages)])
+        self.assertEqual(DASHBOARD_REFRESH_SUPPRESSED._value.get(), suppressed + 2)
+        self.assertEqual(coalescer.stats()["refresh_suppressed"], 2)
+
+    def test_other_event_types_pass_straight_through(self):
+        publisher = RecordingPublisher()
+        coalescer = RefreshCoalescer(publisher, window_ms=60000)
+        message = FakeMessage()
+        coalescer.publish({"employee_id": 7, "type": "pto_lookup"}, ack=message)
+        self.assertEqual(publisher.published, [({"employee_id": 7, "type": "pto_lookup"}, message)])
+
+    def test_flush_publishes_pending_refreshes_before_their_deadline(self):
+        publisher = RecordingPublisher()
+        coalescer = RefreshCoalescer(publisher, window_ms=60000)
+        coalescer.publish(self.refresh(1), ack=FakeMessage())
+        coalescer.publish(self.refresh(2), ack=FakeMessage())
+        coalescer.flush()
+        self.assertEqual(sorted(payload["employee_id"] for payload, _ in publisher.published), [1, 2])
+        self.assertEqual(coalescer.stats()["refresh_pending"], 0)
+
+
+class EmployeeKeyTests(SimpleTestCase):
+    def test_prefers_ordering_key_then_attribute_then_payload(self):
+        message = FakeMessage(data=b'{"employee_id": 3}', message_id="m1")
+        self.assertEqual(employee_key(message), "3")
+        message.attributes = {"employee_id": "2"}
+        self.assertEqual(employee_key(message), "2")
+        message.ordering_key = "1"
+        self.assertEqual(employee_key(message), "1")
+
+    def test_double_encoded_payload(self):
+        self.assertEqual(employee_key(FakeMessage(data=b'"{\\"employee_id\\": 4}"')), "4")
+
+    def test_undecodable_message_falls_back_to_its_id(self):
+        self.assertEqual(employee_key(FakeMessage(data=b"not json", message_id="m9")), "m9")
+
+
+class LaneDispatcherTests(SimpleTestCase):
+    def test_one_employees_messages_run_in_order_and_one_at_a_time(self):
+        handled, active, overlaps = [], [], []
+        lock = threading.Lock()
+
+        def handler(message):
+            with lock:
+                if message.data in active:
+                    overlaps.append(message.data)
+                active.append(message.data)
+            time.sleep(0.001)
+            with lock:
+                active.remove(message.data)
+                handled.append(message)
+
+        lanes = LaneDispatcher("test", handler, lanes=4, key=lambda message: message.data)
+        lanes.start()
+        messages = [FakeMessage(data=employee, message_id=str(index))
+                    for index in range(20) for employee in ("a", "b", "c")]
+        for message in messages:
+            lanes.submit(message)
+        lanes.stop()
+        self.assertEqual(overlaps, [])
+        for employee in ("a", "b", "c"):
+            self.assertEqual(
+                [message.message_id for message in handled if message.data == employee],
+                [str(index) for index in range(20)],
+            )
+
+    def test_lane_for_is_stable_and_in_range(self):
+        lanes = LaneDispatcher("test", lambda message: None, lanes=8)
+        self.assertEqual(lanes.lane_for("12345"), lanes.lane_for("12345"))
+        self.assertTrue(all(0 <= lanes.lane_for(str(key)) < 8 for key in range(100)))
+
+    def test_failing_handler_nacks_and_the_lane_keeps_going(self):
+        handled = []
+
+        def handler(message):
+            if message.message_id == "bad":
+                raise RuntimeError("boom")
+            handled.append(message)
+
+        lanes = LaneDispatcher("test", handler, lanes=1, key=lambda message: "same")
+        lanes.start()
+        bad, good = FakeMessage(message_id="bad"), FakeMessage(message_id="good")
+        lanes.submit(bad)
+        lanes.submit(good)
+        lanes.stop()
+        self.assertTrue(bad.nacked)
+        self.assertEqual(handled, [good])
+
+
+def pulled(ack_id, data=b"{}"):
+    message = types.SimpleNamespace(data=data, message_id=ack_id, attributes={}, ordering_key="", publish_time=None)
+    return types.SimpleNamespace(ack_id=ack_id, message=message)
+
+
+class FakeSubscriberAsyncClient:
+    def __init__(self, messages=()):
+        self.messages = list(messages)
+        self.requested = []
+        self.acked = []
+        self.deadlines = []
+
+    async def pull(self, subscription, max_messages, timeout):
+        self.requested.append(max_messages)
+        received, self.messages = self.messages[:max_messages], self.messages[max_messages:]
+        if not received:
+            await asyncio.sleep(0.01)
+        return types.SimpleNamespace(received_messages=received)
+
+    async def acknowledge(self, subscription, ack_ids):
+        self.acked.extend(ack_ids)
+
+    async def modify_ack_deadline(self, subscription, ack_ids, ack_deadline_seconds):
+        self.deadlines.append((list(ack_ids), ack_deadline_seconds))
+
+
+class AsyncEngineTests(SimpleTestCase):
+    def engine(self, subscriber, concurrency=1000):
+        from core.async_engine import AsyncEngine
+
+        return AsyncEngine(
+            concurrency, store=object(), subscriber=subscriber, publisher=object(), dashboard_publisher=mock.Mock()
+        )
+
+    def test_pulls_no_more_than_free_slots_and_acks(self):
+        subscriber = FakeSubscriberAsyncClient([pulled(f"a{i}") for i in range(5)])
+
+        async def scenario():
+            engine = self.engine(subscriber, concurrency=3)
+            gate = asyncio.Event()
+
+            async def handler(engine, message):
+                await gate.wait()
+                return []
+
+            consumer = asyncio.ensure_future(engine.consume("user_pto", "sub", handler))
+            await asyncio.sleep(0.05)
+            # All three slots are busy, so nothing beyond them was pulled.
+            self.assertEqual(subscriber.requested, [3])
+            self.assertEqual(sorted(engine.leases["sub"]), ["a0", "a1", "a2"])
+            gate.set()
+            await asyncio.sleep(0.1)
+            engine.stopping.set()
+            consumer.cancel()
+            await asyncio.gather(consumer, return_exceptions=True)
+            self.assertEqual(engine.in_flight, 0)
+            self.assertEqual(engine.leases["sub"], {})
+
+        asyncio.run(scenario())
+        self.assertTrue(all(requested <= 3 for requested in subscriber.requested))
+        self.assertEqual(sorted(subscriber.acked), [f"a{i}" for i in range(5)])
+
+    def test_threaded_handler_settles_through_the_loop(self):
+        from core.async_engine import ThreadedHandler
+
+        subscriber = FakeSubscriberAsyncClient()
+
+        def callback(message):
+            if message.data == b"ok":
+                message.ack()
+            else:
+                message.nack()
+
+        async def scenario():
+            engine = self.engine(subscriber)
+            handler = ThreadedHandler("bulk_pto", callback)
+            handler.executor = ThreadPoolExecutor(max_workers=1)
+            for ack_id, data in (("good", b"ok"), ("bad", b"no")):
+                engine.in_flight += 1
+                engine.hold_lease("bulk_pto", "sub", ack_id)
+                await engine._handle_threaded("bulk_pto", "sub", handler, pulled(ack_id, data))
+            await asyncio.sleep(0.05)
+            handler.executor.shutdown()
+            self.assertEqual(engine.in_flight, 0)
+            self.assertEqual(engine.leases["sub"], {})
+
+        asyncio.run(scenario())
+        self.assertEqual(subscriber.acked, ["good"])
+        self.assertEqual(subscriber.deadlines, [(["bad"], 0)])
+
+    def test_extend_leases_skips_messages_past_max_lease(self):
+        subscriber = FakeSubscriberAsyncClient()
+
+        async def scenario():
+            engine = self.engine(subscriber)
+            engine.hold_lease("user_pto", "sub", "fresh")
+            engine.leases["sub"]["stale"] = time.monotonic() - 1
+            await engine.extend_leases()
+            self.assertEqual(list(engine.leases["sub"]), ["fresh"])
+
+        asyncio.run(scenario())
+        self.assertEqual(len(subscriber.deadlines), 1)
+        self.assertEqual(subscriber.deadlines[0][0], ["fresh"])
+
+
+class BatchEnvelopeTests(SimpleTestCase):
+    def test_operations_of_only_accepts_an_operations_list(self):
+        self.assertEqual(operations_of({"operations": [{"employee_id": "E1"}]}), [{"employee_id": "E1"}])
+        self.assertIsNone(operations_of({"employee_id": "E1"}))
+        self.assertIsNone(operations_of({"operations": "E1"}))
+
+    def test_operation_request_id_falls_back_to_message_and_index(self):
+        message = FakeMessage(message_id="m1")
+        self.assertEqual(operation_request_id(message, {"request_id": "r9"}, 3), "r9")
+        self.assertEqual(operation_request_id(message, {"employee_id": "E1"}, 3), "m1:3")
+
+    def test_batch_payload_summarises_statuses(self):
+        results = [
+            item_result("E1", "ok", 4),
+            item_result("E2", "ok", 2),
+            invalid_result({"employee_id": "E3"}, KeyError("hours")),
+        ]
+        payload = batch_payload("pto_update", {"batch_id": "b1"}, results)
+        self.assertEqual(payload["type"], "pto_update_batch_result")
+        self.assertEqual(payload["payload"], {
+            "message": "Processed 3 pto_update operations: 1 error, 2 ok.",
+            "batch_id": "b1",
+            "results": results,
+        })
+
+
+class FakeAsyncRef:
+    def __init__(self, collection, id):
+        self.id = id
+        self.parent = types.SimpleNamespace(id=collection)
+
+
+class FakeAsyncBatch:
+    def __init__(self, client):
+        self.client = client
+        self.writes = []
+
+    def set(self, ref, data, merge=False):
+        self.writes.append(("set", ref.parent.id, ref.id, data))
+
+    def create(self, ref, data):
+        self.writes.append(("create", ref.parent.id, ref.id, data))
+
+    async def commit(self):
+        self.client.commits.append(self.writes)
+        results = []
+        for kind, collection, id, data in self.writes:
+            transforms = []
+            if kind == "set" and isinstance(data.get("balance"), firestore.Increment):
+                balance = self.client.balances.get(id, 0) + data["balance"].value
+                self.client.balances[id] = balance
+                transforms = [Value(integer_value=balance)]
+            results.append(types.SimpleNamespace(transform_results=transforms))
+        return results
+
+
+class FakeAsyncFirestore:
+    """Just enough of firestore.AsyncClient for batched envelope writes."""
+
+    def __init__(self, balances=None, recorded=()):
+        self.balances = dict(balances or {})
+        self.recorded = set(recorded)
+        self.reads = []
+        self.commits = []
+
+    def collection(self, name):
+        return types.SimpleNamespace(document=lambda id: FakeAsyncRef(name, id))
+
+    def batch(self):
+        return FakeAsyncBatch(self)
+
+    async def get_all(self, refs, field_paths=None):
+        self.reads.append([ref.id for ref in refs])
+        for ref in refs:
+            yield types.SimpleNamespace(id=ref.id, exists=ref.id in self.recorded)
+
+
+class AsyncEnvelopeTests(SimpleTestCase):
+    def test_update_envelope_merges_each_employee_into_one_commit(self):
+        from core.async_engine import handle_update
+
+        store = mock.Mock()
+        store.commit_changes = mock.AsyncMock(return_value={})
+        operations = [
+            {"employee_id": "E1", "new_balance": 10},
+            {"employee_id": "E2", "new_balance": 5},
+            {"employee_id": "E1", "new_balance": 20},
+            {"employee_id": "E3"},
+        ]
+        message = FakeMessage(json.dumps({"operations": operations}).encode("utf-8"), "m1")
+        [payload] = asyncio.run(handle_update(types.SimpleNamespace(store=store), message))
+
+        store.commit_changes.assert_awaited_once()
+        changes = store.commit_changes.await_args[0][0]
+        self.assertEqual({employee_id: change.set_to for employee_id, change in changes.items()}, {"E1": 20, "E2": 5})
+        statuses = [result["status"] for result in payload["payload"]["results"]]
+        self.assertEqual(statuses, ["ok", "ok", "ok", "error"])
+
+    def test_deductions_read_records_once_and_commit_merged_increments(self):
+        client = FakeAsyncFirestore(balances={"E1": 40, "E2": 8}, recorded={"pto_deduction:r3"})
+        store = AsyncPTOStore(client)
+        requests = [("pto_deduction:r1", "E1", 2), ("pto_deduction:r2", "E1", 3), ("pto_deduction:r3", "E2", 1)]
+        with mock.patch.object(store, "get_balance", mock.AsyncMock(return_value=8)):
+            results = asyncio.run(store.commit_deductions_once(requests))
+
+        self.assertEqual(results, [(True, 35, False), (True, 35, False), (True, 8, True)])
+        self.assertEqual(client.reads, [["pto_deduction:r1", "pto_deduction:r2", "pto_deduction:r3"]])
+        [writes] = client.commits
+        self.assertEqual([(kind, id) for kind, _, id, _ in writes],
+                         [("set", "E1"), ("create", "pto_deduction:r1"), ("create", "pto_deduction:r2")])
+        self.assertEqual(writes[0][3]["balance"].value, -5)
+
+
+class LevelForTests(SimpleTestCase):
+    def test_service_level_overrides_the_default(self):
+        with mock.patch.dict(os.environ, {"PTO_USAGE_LOG_LEVEL": "debug"}):
+            self.assertEqual(level_for("pto_usage"), logging.DEBUG)
+
+    def test_unknown_level_falls_back_with_a_warning(self):
+        with mock.patch.dict(os.environ, {"PTO_USAGE_LOG_LEVEL": "LOUD"}), \
+                mock.patch.object(structured_logging, "DEFAULT_LOG_LEVEL", "WARNING"), \
+                self.assertLogs("utils.structured_logging", "WARNING"):
+            self.assertEqual(level_for("pto_usage"), logging.WARNING)
+
+    def test_unknown_default_falls_back_to_info(self):
+        with mock.patch.dict(os.environ, {"PTO_USAGE_LOG_LEVEL": "LOUD"}), \
+                mock.patch.object(structured_logging, "DEFAULT_LOG_LEVEL", "QUIET"), \
+                self.assertLogs("utils.structured_logging", "WARNING"):
+            self.assertEqual(level_for("pto_usage"), logging.INFO)
+
+
+class AsyncEngineShutdownTests(SimpleTestCase):
+    def engine(self, subscriber, dashboard_publisher=None):
+        from core.async_engine import AsyncEngine
+
+        return AsyncEngine(
+            store=object(), subscriber=subscriber, publisher=object(),
+            dashboard_publisher=dashboard_publisher or mock.Mock(),
+        )
+
+    def test_drain_lets_pulled_messages_finish_before_cancelling(self):
+        subscriber = FakeSubscriberAsyncClient([pulled("a1"), pulled("a2")])
+        finished = []
+
+        async def handler(engine, message):
+            await asyncio.sleep(0.05)
+            finished.append(message.message_id)
+            return []
+
+        async def scenario():
+            engine = self.engine(subscriber)
+            consumer = asyncio.ensure_future(engine.consume("user_pto", "sub", handler))
+            await asyncio.sleep(0.01)
+            engine.stopping.set()
+            consumer.cancel()
+            await asyncio.gather(consumer, return_exceptions=True)
+            await engine.drain(timeout=1)
+            self.assertEqual(engine.unsettled(), 0)
+            # Let the ack batcher send.
+            await asyncio.sleep(0.05)
+
+        asyncio.run(scenario())
+        self.assertEqual(sorted(finished), ["a1", "a2"])
+        self.assertEqual(sorted(subscriber.acked), ["a1", "a2"])
+
+    def test_refresh_events_are_acked_by_the_dashboard_publisher(self):
+        subscriber = FakeSubscriberAsyncClient([pulled("a1")])
+        dashboard_publisher = mock.Mock()
+
+        async def handler(engine, message):
+            return [build_dashboard_payload("E1", "refresh_data", "Please refresh dashboard data.")]
+
+        async def scenario():
+            engine = self.engine(subscriber, dashboard_publisher)
+            consumer = asyncio.ensure_future(engine.consume("pto_update", "sub", handler))
+            await asyncio.sleep(0.05)
+            self.assertEqual(subscriber.acked, [])
+            dashboard_publisher.publish.call_args[1]["ack"].ack()
+            await asyncio.sleep(0.05)
+            consumer.cancel()
+            await asyncio.gather(consumer, return_exceptions=True)
+
+        asyncio.run(scenario())
+        dashboard_publisher.publish.assert_called_once()
+        self.assertEqual(dashboard_publisher.publish.call_args[0][0]["type"], "refresh_data")
+        self.assertEqual(subscriber.acked, ["a1"])
+
+
+class AsyncPTOStoreTests(SimpleTestCase):
+    def test_missing_balance_field_reads_as_zero(self):
+        client = mock.Mock()
+        snapshot = types.SimpleNamespace(id="E1", exists=True, to_dict=lambda: {"name": "no balance"})
+        client.collection.return_value.document.return_value.get = mock.AsyncMock(return_value=snapshot)
+        self.assertEqual(asyncio.run(AsyncPTOStore(client).get_balance("E1")), 0)
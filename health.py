@@ -1,8 +1,43 @@
 # health.py
-from fastapi import FastAPI
+import os
+
+from fastapi import FastAPI, Response
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, generate_latest
+from prometheus_client import REGISTRY, multiprocess
+
+from pto_update.mirror import balance_mirror
+from utils.supervision import health_registry
 
 app = FastAPI()
 
 @app.get("/")
 def health_check():
     return {"status": "ok"}
+
+@app.get("/ready")
+def readiness_check(response: Response):
+    # Unready while any service keeps failing to stay up, so Kubernetes
+    # stops routing to (and eventually surfaces) a crash-looping pod.
+    degraded = health_registry.degraded()
+    if degraded:
+        response.status_code = 503
+    return {"status": "degraded" if degraded else "ready", "services": health_registry.status()}
+
+@app.get("/mirror")
+def mirror_status(response: Response):
+    # Size and staleness of the in-memory pto mirror (PTO_MIRROR_ENABLED) in
+    # this process; in process mode use the pto_mirror_* metrics instead.
+    if balance_mirror is None:
+        response.status_code = 404
+        return {"enabled": False}
+    return {"enabled": True, **balance_mirror.stats()}
+
+@app.get("/metrics")
+def metrics():
+    # In process mode every child writes its samples under
+    # PROMETHEUS_MULTIPROC_DIR and they are aggregated here.
+    registry = REGISTRY
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
@@ -4,61 +4,100 @@ import logging
 import threading
 import signal
 
-from google.cloud import pubsub_v1
+from pto_update import idempotency
 from utils.pto_update_manager import PTOUpdateManager
 from utils.dashboard_events import build_dashboard_payload
-from google.cloud import logging as cloud_logging
-
-# Google Cloud Logging setup
-cloud_log_client = cloud_logging.Client()
-cloud_log_client.setup_logging()
+from utils.batch_envelope import batch_payload, invalid_result, item_result, operation_request_id, operations_of
+from utils.dashboard_publisher import get_dashboard_publisher
+from utils.subscriber_settings import subscribe_options
+from utils.micro_batch import MicroBatcher, MICRO_BATCH_ENABLED
+from utils.ordered_lanes import LaneDispatcher, ORDERED_LANES_ENABLED
+from utils.supervision import await_stream, restart_delay
+from utils.structured_logging import level_for, log_payload
+from utils import gcp_clients, metrics
 
 # Standard logging
 logger = logging.getLogger("pto_deduction_worker")
-logger.setLevel(logging.INFO)
+logger.setLevel(level_for("pto_deduction"))
 
 # GCP configuration
-project_id = "hopkinstimesheetproj"
 subscription_name = "pto_deduction_sub"
-dashboard_topic = f"projects/{project_id}/topics/dashboard-queue"
 
-subscriber = pubsub_v1.SubscriberClient()
-publisher = pubsub_v1.PublisherClient()
-subscription_path = subscriber.subscription_path(project_id, subscription_name)
+dashboard_publisher = get_dashboard_publisher()
+subscription_path = gcp_clients.subscription_path(subscription_name)
 
 shutdown_event = threading.Event()
+streaming_pull_future = None
 
 def signal_handler(sig, frame):
     logger.info("Received shutdown signal. Preparing to exit...")
     shutdown_event.set()
+    if streaming_pull_future is not None:
+        streaming_pull_future.cancel()
+
+@metrics.timed_stage("decode")
+def decode_message(message):
+    raw_data = message.data.decode("utf-8")
+    log_payload(logger, "pto_deduction", raw_data)
+
+    update_data = json.loads(raw_data)
+    if isinstance(update_data, str):
+        update_data = json.loads(update_data)
+    return update_data
+
+def deduction_fields(update_data):
+    employee_id = update_data['employee_id']
+
+    pto_deduction = update_data.get('pto_deduction')
+    if pto_deduction is None:
+        pto_value = update_data.get("data", {}).get("pto_hours")
+        try:
+            pto_deduction = int(pto_value) if pto_value is not None else 0
+            logger.debug("Converted pto_hours to int: %d", pto_deduction)
+        except Exception as conv_error:
+            logger.error("Failed to convert pto_hours: %s", conv_error)
+            pto_deduction = 0
+
+    return employee_id, pto_deduction, update_data.get("request_id")
+
+def process_envelope(message, data, operations):
+    requests = []
+    results = [None] * len(operations)
+    for index, operation in enumerate(operations):
+        try:
+            employee_id, pto_deduction, _ = deduction_fields(operation)
+        except Exception as e:
+            results[index] = invalid_result(operation, e)
+            continue
+        request_id = operation_request_id(message, operation, index)
+        requests.append((index, (idempotency.key_for("pto_deduction", message, request_id), employee_id, pto_deduction)))
+
+    if requests:
+        outcomes = idempotency.commit_deductions_once([request for _, request in requests])
+        for (index, (_, employee_id, _)), (_, balance, duplicate) in zip(requests, outcomes):
+            results[index] = item_result(employee_id, "duplicate" if duplicate else "ok", balance)
+    logger.info(f"[SUCCESS] Batch envelope: {len(requests)} of {len(operations)} PTO deductions valid.")
+    dashboard_publisher.publish(batch_payload("pto_deduction", data, results), ack=message)
 
 def callback(message):
     try:
-        logger.info("Received new message on subscription.")
-        raw_data = message.data.decode("utf-8")
-        logger.info(f"Raw message received: {raw_data}")
-
-        update_data = json.loads(raw_data)
-        if isinstance(update_data, str):
-            update_data = json.loads(update_data)
-
-        employee_id = update_data['employee_id']
-
-        pto_deduction = update_data.get('pto_deduction')
-        if pto_deduction is None:
-            pto_value = update_data.get("data", {}).get("pto_hours")
-            try:
-                pto_deduction = int(pto_value) if pto_value is not None else 0
-                logger.info("Converted pto_hours to int: %d", pto_deduction)
-            except Exception as conv_error:
-                logger.error("Failed to convert pto_hours: %s", conv_error)
-                pto_deduction = 0
+        logger.debug("Received new message on subscription.")
+        data = decode_message(message)
+        operations = operations_of(data)
+        if operations is not None:
+            process_envelope(message, data, operations)
+            return
+        employee_id, pto_deduction, request_id = deduction_fields(data)
 
         updater = PTOUpdateManager(employee_id)
-        result = updater.subtract_pto(pto_deduction)
-        new_balance = updater.get_current_balance() if hasattr(updater, 'get_current_balance') else "unknown"
+        key = idempotency.key_for("pto_deduction", message, request_id)
+        result = updater.subtract_pto(pto_deduction, idempotency_key=key)
+        new_balance = result.get("balance", "unknown")
 
-        if result['result'] == "success":
+        if result['result'] == "success" and result["duplicate"]:
+            logger.info(f"[DUPLICATE] Deduction {key} for employee {employee_id} was already applied.")
+            payload = build_dashboard_payload(employee_id, "refresh_data", "Please refresh dashboard data.", {})
+        elif result['result'] == "success":
             msg = f"[SUCCESS] PTO for employee {employee_id} updated. New balance: {new_balance}"
             logger.info(msg)
             payload = build_dashboard_payload(employee_id, "refresh_data", "Please refresh dashboard data.", {})
@@ -67,26 +106,71 @@ def callback(message):
             logger.error(msg)
             payload = build_dashboard_payload(employee_id, "pto_updated", msg)
 
-        publisher.publish(dashboard_topic, json.dumps(payload).encode("utf-8"))
-        logger.info("Published update to dashboard topic.")
-        message.ack()
+        dashboard_publisher.publish(payload, ack=message)
+        logger.debug("Queued update to dashboard topic; ack deferred until publish completes.")
     except Exception as e:
         logger.exception("Error processing message:")
         message.nack()
 
-def listen_for_messages():
+def process_batch(messages):
+    # Deductions for the same employee collapse into one increment; each
+    # message's ledger record is created in the same commit.
+    requests = []
+    parsed = []
+    for message in messages:
+        try:
+            data = decode_message(message)
+            operations = operations_of(data)
+            if operations is not None:
+                process_envelope(message, data, operations)
+                continue
+            employee_id, pto_deduction, request_id = deduction_fields(data)
+        except Exception:
+            logger.exception("Error processing message:")
+            message.nack()
+            continue
+        requests.append((idempotency.key_for("pto_deduction", message, request_id), employee_id, pto_deduction))
+        parsed.append((message, employee_id))
+
+    if not parsed:
+        return
+
+    try:
+        results = idempotency.commit_deductions_once(requests)
+    except Exception:
+        logger.exception(f"Failed to commit batch of {len(parsed)} PTO deductions:")
+        for message, _ in parsed:
+            message.nack()
+        return
+
+    duplicates = sum(1 for _, _, duplicate in results if duplicate)
+    logger.info(f"[SUCCESS] Committed {len(parsed) - duplicates} PTO deductions ({duplicates} duplicates skipped).")
+    for message, employee_id in parsed:
+        payload = build_dashboard_payload(employee_id, "refresh_data", "Please refresh dashboard data.", {})
+        dashboard_publisher.publish(payload, ack=message)
+
+def listen_for_messages(message_callback=callback):
+    global streaming_pull_future
     logger.info(f"Listening to Pub/Sub subscription: {subscription_path}")
 
     while not shutdown_event.is_set():
         try:
-            future = subscriber.subscribe(subscription_path, callback=callback)
+            streaming_pull_future = future = gcp_clients.get_subscriber_client().subscribe(
+                subscription_path, callback=metrics.instrument("pto_deduction", message_callback),
+                **subscribe_options("pto_deduction")
+            )
             logger.info("PTO Deduction service is now actively listening for messages...")
-            future.result()
+            await_stream(future, "pto_deduction")
         except Exception as e:
-            logger.exception("Pub/Sub listener crashed. Restarting in 5 seconds...")
-            time.sleep(5)
+            if shutdown_event.is_set():
+                break
+            delay = restart_delay("pto_deduction")
+            logger.exception(f"Pub/Sub listener crashed. Restarting in {delay:.1f} seconds...")
+            shutdown_event.wait(delay)
 
 def run():
+    gcp_clients.setup_cloud_logging()
+
     if threading.current_thread() == threading.main_thread():
         signal.signal(signal.SIGINT, signal_handler)
         signal.signal(signal.SIGTERM, signal_handler)
@@ -100,15 +184,29 @@ def run():
 
     threading.Thread(target=heartbeat, daemon=True).start()
 
+    batcher = None
+    message_callback = callback
+    if MICRO_BATCH_ENABLED:
+        batcher = MicroBatcher("pto_deduction", process_batch)
+        batcher.start()
+        message_callback = batcher.submit
+    elif ORDERED_LANES_ENABLED:
+        batcher = LaneDispatcher("pto_deduction", callback)
+        batcher.start()
+        message_callback = batcher.submit
+
     try:
-        listen_for_messages()
+        listen_for_messages(message_callback)
     except Exception as e:
         logger.exception("Unhandled exception in run()")
     finally:
-        try:
-            subscriber.close()
-            logger.info("Subscriber client closed.")
-        except Exception as e:
-            logger.warning("Failed to close subscriber cleanly: %s", e)
+        if batcher:
+            batcher.stop()
+        # The subscriber client is shared; only this service's stream is cancelled here.
+        if streaming_pull_future is not None:
+            streaming_pull_future.cancel()
+            logger.info("Subscriber stream cancelled.")
+        # Publish refresh_data events the coalescer is still holding back.
+        dashboard_publisher.flush()
 
         logger.info("PTO Deduction microservice shut down.")
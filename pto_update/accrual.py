@@ -0,0 +1,306 @@
+"""
+Pay-period accrual run: stream the pto collection, work out each employee's
+accrual from a rule set and write the changes with parallel batched commits,
+instead of sending one update message per employee.
+
+A run is identified by its period (e.g. "2026-10-15"). Each employee's
+increment is committed together with the create() of a marker document,
+pto_accrual_runs/<period>/employees/<employee_id>, the way deductions are
+committed with their idempotency record. A retried or repeated write finds
+the marker and fails as a whole, so a period is never applied twice, even
+when a commit succeeded but its response was lost. In ledger mode the
+accrual is an entry named accrual-<period>, which is its own marker.
+Accrued records are also stamped with last_accrual_period, so a rescan
+skips them without writing. Progress is checkpointed in
+pto_accrual_runs/<period> so that an interrupted run resumes after the last
+checkpointed employee.
+
+Rules are JSON, e.g.:
+
+    {
+        "default_hours": 4,
+        "max_balance": 240,
+        "rules": [
+            {"employee_ids": ["E100", "E101"], "hours": 6},
+            {"prefix": "C", "hours": 0}
+        ]
+    }
+
+The first matching rule wins; accruals never take a balance past max_balance.
+In ledger mode that cap is checked against the folded balance (snapshot plus
+entries), which costs one extra read per employee while max_balance is set.
+"""
+import time
+import json
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Tuple
+
+from google.api_core.exceptions import AlreadyExists, GoogleAPICallError
+from google.cloud import firestore
+
+from pto_update import ledger
+from pto_update.models import MAX_BATCH_WRITES, PTO
+from utils.gcp_clients import get_firestore_client
+from utils.supervision import backoff_delay
+
+logger = logging.getLogger(__name__)
+
+RUNS_COLLECTION = "pto_accrual_runs"
+MARKERS = "employees"
+# A failed commit is retried with exponential backoff (0.5s, 1s, 2s, ...)
+# until it has been attempted this many times.
+MAX_WRITE_ATTEMPTS = 5
+RETRY_BASE_SECONDS = 0.5
+# Each accrual is an increment plus its marker.
+EMPLOYEES_PER_COMMIT = MAX_BATCH_WRITES // 2
+
+
+class AccrualRules:
+    def __init__(self, default_hours: int = 0, max_balance: Optional[int] = None, rules=None):
+        self.default_hours = default_hours
+        self.max_balance = max_balance
+        self.rules = rules or []
+
+    @staticmethod
+    def from_dict(data: dict) -> "AccrualRules":
+        return AccrualRules(data.get("default_hours", 0), data.get("max_balance"), data.get("rules", []))
+
+    @staticmethod
+    def from_file(path: str) -> "AccrualRules":
+        with open(path) as f:
+            return AccrualRules.from_dict(json.load(f))
+
+    def hours_for(self, employee_id: str, balance: int) -> int:
+        hours = self.default_hours
+        for rule in self.rules:
+            if employee_id in rule.get("employee_ids", ()) or (
+                rule.get("prefix") and employee_id.startswith(rule["prefix"])
+            ):
+                hours = rule.get("hours", 0)
+                break
+        if self.max_balance is not None:
+            hours = min(hours, self.max_balance - balance)
+        return max(0, hours)
+
+
+class AccrualRun:
+    """One accrual pass over the pto collection for a period."""
+
+    def __init__(self, period: str, rules: AccrualRules, page_size: int = 1000,
+                 checkpoint_every: int = 5000, dry_run: bool = False,
+                 max_ops_per_second: int = 10000, workers: int = 8,
+                 report: Callable[[str], None] = logger.info):
+        self.period = period
+        self.rules = rules
+        self.page_size = page_size
+        self.checkpoint_every = checkpoint_every
+        self.dry_run = dry_run
+        self.max_ops_per_second = max_ops_per_second
+        self.workers = workers
+        self.report = report
+        self.scanned = 0
+        self.skipped = 0
+        self.already_applied = 0
+        self.accrued = 0
+        self.hours = 0
+        self.written = 0
+        self.failed = 0
+        self.last_scanned = None
+        self._lock = threading.Lock()
+        self._next_send = 0.0
+
+    def _checkpoint_ref(self):
+        return get_firestore_client().collection(RUNS_COLLECTION).document(self.period)
+
+    def marker_ref(self, employee_id: str):
+        return self._checkpoint_ref().collection(MARKERS).document(employee_id)
+
+    def load_checkpoint(self) -> Optional[str]:
+        snapshot = self._checkpoint_ref().get()
+        if not snapshot.exists:
+            return None
+        data = snapshot.to_dict()
+        if data.get("completed"):
+            raise RuntimeError(f"Accrual for period {self.period} already completed at {data.get('completed_at')}.")
+        return data.get("last_employee_id")
+
+    def save_checkpoint(self, last_employee_id: Optional[str], completed: bool = False):
+        if self.dry_run:
+            return
+        if self.failed:
+            # Failed writes may lie behind last_employee_id; the next run
+            # rescans from the start and skips what was already accrued.
+            last_employee_id = None
+        state = {
+            "last_employee_id": last_employee_id,
+            "accrued": self.accrued,
+            "already_applied": self.already_applied,
+            "failed": self.failed,
+            "completed": completed,
+            "updated_at": firestore.SERVER_TIMESTAMP,
+        }
+        if completed:
+            state["completed_at"] = firestore.SERVER_TIMESTAMP
+        self._checkpoint_ref().set(state, merge=True)
+
+    def balance_for(self, employee_id: str, data: dict) -> int:
+        """The balance max_balance is checked against."""
+        if ledger.LEDGER_MODE and self.rules.max_balance is not None:
+            # The scanned snapshot lags the entries written since compaction.
+            return ledger.read_balance(employee_id)[1]
+        return data.get("balance", 0)
+
+    def _add_writes(self, batch, employee_id: str, hours: int):
+        if ledger.LEDGER_MODE:
+            batch.create(
+                ledger.entry_ref(employee_id, f"accrual-{self.period}"),
+                ledger.new_entry("accrual", delta=hours),
+            )
+            return
+        batch.set(
+            get_firestore_client().collection("pto").document(employee_id),
+            {"balance": firestore.Increment(hours), "last_accrual_period": self.period},
+            merge=True,
+        )
+        batch.create(self.marker_ref(employee_id), {"hours": hours, "applied_at": firestore.SERVER_TIMESTAMP})
+
+    def _commit_with_retry(self, accruals: List[Tuple[str, int]]):
+        """Commit accruals in one batch; AlreadyExists means some were applied before."""
+        attempt = 1
+        while True:
+            batch = get_firestore_client().batch()
+            for employee_id, hours in accruals:
+                self._add_writes(batch, employee_id, hours)
+            try:
+                batch.commit()
+                return
+            except AlreadyExists:
+                raise
+            except GoogleAPICallError:
+                # Safe to resend: if the lost attempt did commit, the markers
+                # now exist and this one fails with AlreadyExists instead.
+                if attempt >= MAX_WRITE_ATTEMPTS:
+                    raise
+                time.sleep(backoff_delay(attempt, base=RETRY_BASE_SECONDS))
+                attempt += 1
+
+    def _record(self, accruals: List[Tuple[str, int]]):
+        with self._lock:
+            self.accrued += len(accruals)
+            self.hours += sum(hours for _, hours in accruals)
+            self.written += len(accruals)
+
+    def _commit(self, accruals: List[Tuple[str, int]]):
+        try:
+            self._commit_with_retry(accruals)
+            self._record(accruals)
+            return
+        except AlreadyExists:
+            if len(accruals) == 1:
+                with self._lock:
+                    self.already_applied += 1
+                return
+        except GoogleAPICallError as e:
+            with self._lock:
+                self.failed += len(accruals)
+            logger.error(f"Accrual commit for {len(accruals)} employees from {accruals[0][0]} failed: {e}")
+            return
+        # One marker in the batch already existed; find it by committing each accrual alone.
+        for accrual in accruals:
+            self._commit([accrual])
+
+    def _pace(self, writes: int):
+        # Keep the sustained write rate at or below max_ops_per_second.
+        now = time.monotonic()
+        self._next_send = max(self._next_send, now)
+        if self._next_send > now:
+            time.sleep(self._next_send - now)
+        self._next_send += writes / self.max_ops_per_second
+
+    def _progress(self, started: float):
+        elapsed = max(time.monotonic() - started, 1e-9)
+        self.report(
+            f"Accrual {self.period}: scanned {self.scanned} ({self.scanned / elapsed:.0f} records/s), "
+            f"accrued {self.accrued} employees / {self.hours} hours, skipped {self.skipped}, "
+            f"already applied {self.already_applied}, written {self.written}, failed {self.failed}"
+        )
+
+    def _accruals(self, start_after: Optional[str]):
+        """Yield (employee_id, hours) for every employee due an accrual."""
+        fields = ["balance"] if ledger.LEDGER_MODE else ["balance", "last_accrual_period"]
+        for employee_id, data in PTO.iter_documents(fields, self.page_size, start_after=start_after):
+            self.scanned += 1
+            self.last_scanned = employee_id
+            if data.get("last_accrual_period") == self.period:
+                self.skipped += 1
+                continue
+            hours = self.rules.hours_for(employee_id, self.balance_for(employee_id, data))
+            if hours:
+                yield employee_id, hours
+
+    def run(self, resume: bool = True) -> dict:
+        start_after = self.load_checkpoint() if resume else None
+        if start_after:
+            self.report(f"Resuming accrual {self.period} after employee {start_after}.")
+
+        started = time.monotonic()
+        self.last_scanned = start_after
+        last_checkpoint = start_after
+        since_checkpoint = 0
+        writes_per_accrual = 1 if ledger.LEDGER_MODE else 2
+        # (future, accruals, last employee scanned) per commit in flight, oldest first.
+        in_flight = deque()
+
+        def finish_oldest():
+            nonlocal last_checkpoint, since_checkpoint
+            future, accruals, last_employee_id = in_flight.popleft()
+            future.result()
+            since_checkpoint += len(accruals)
+            if since_checkpoint >= self.checkpoint_every:
+                # Every earlier commit has finished, so everything up to here is durable.
+                last_checkpoint = last_employee_id
+                self.save_checkpoint(last_checkpoint)
+                since_checkpoint = 0
+                self._progress(started)
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="pto-accrual") as executor:
+            chunk = []
+
+            def submit():
+                while len(in_flight) >= self.workers:
+                    finish_oldest()
+                self._pace(len(chunk) * writes_per_accrual)
+                in_flight.append((executor.submit(self._commit, list(chunk)), list(chunk), self.last_scanned))
+                chunk.clear()
+
+            for employee_id, hours in self._accruals(start_after):
+                if self.dry_run:
+                    self.accrued += 1
+                    self.hours += hours
+                    continue
+                chunk.append((employee_id, hours))
+                if len(chunk) >= EMPLOYEES_PER_COMMIT:
+                    submit()
+            if chunk:
+                submit()
+            while in_flight:
+                finish_oldest()
+
+        self.save_checkpoint(self.last_scanned, completed=self.failed == 0)
+        self._progress(started)
+        elapsed = time.monotonic() - started
+        return {
+            "period": self.period,
+            "scanned": self.scanned,
+            "accrued": self.accrued,
+            "hours": self.hours,
+            "skipped": self.skipped,
+            "already_applied": self.already_applied,
+            "written": self.written,
+            "failed": self.failed,
+            "seconds": round(elapsed, 2),
+            "records_per_second": round(self.scanned / elapsed, 1) if elapsed else 0.0,
+        }
@@ -0,0 +1,239 @@
+import asyncio
+from typing import Dict, List, Optional, Tuple
+
+from google.api_core.exceptions import AlreadyExists
+from google.cloud import firestore
+
+from pto_update.idempotency import (
+    LEDGER_COLLECTION, ledger_record, plan_commits, plan_deductions, recall, recorded_result, settle,
+    settle_commits, _split_remembered,
+)
+from pto_update.models import (
+    GET_MANY_CHUNK_SIZE, MAX_BATCH_WRITES, BalanceChange, add_change_writes, balance_cache, change_chunks,
+    committed_balances, mirror_lookup, plan_deduction, record_write, stored_balance, _decode_number,
+)
+from utils.gcp_clients import get_async_firestore_client
+
+# The deduction planning is shared with pto_update.models and
+# pto_update.idempotency; only the awaited reads and writes live here.
+
+
+@firestore.async_transactional
+async def _deduct_in_transaction(transaction, doc_ref, hours: int) -> Tuple[bool, int]:
+    snapshot = await doc_ref.get(transaction=transaction)
+    applied, balance, write = plan_deduction(snapshot.exists, stored_balance(snapshot), hours)
+    if write:
+        transaction.set(doc_ref, {"balance": balance})
+    return applied, balance
+
+
+@firestore.async_transactional
+async def _deduct_once_in_transaction(transaction, doc_ref, record_ref, hours: int) -> Tuple[bool, int, bool]:
+    record = await record_ref.get(transaction=transaction)
+    if record.exists:
+        return recorded_result(record)
+    snapshot = await doc_ref.get(transaction=transaction)
+    applied, balance, write = plan_deduction(snapshot.exists, stored_balance(snapshot), hours)
+    if write:
+        transaction.set(doc_ref, {"balance": balance})
+    transaction.create(record_ref, ledger_record(doc_ref.id, hours, applied, balance))
+    return applied, balance, False
+
+
+@firestore.async_transactional
+async def _deduct_many_once_in_transaction(transaction, client, requests) -> List[Tuple[bool, int, bool]]:
+    refs = {employee_id: client.collection("pto").document(employee_id) for _, employee_id, _ in requests}
+    record_refs = {key: client.collection(LEDGER_COLLECTION).document(key) for key, _, _ in requests if key is not None}
+    snapshots = [
+        snapshot
+        async for snapshot in client.get_all(list(refs.values()) + list(record_refs.values()), transaction=transaction)
+    ]
+    results, writes, creates = plan_deductions(requests, snapshots)
+    for key, record in creates:
+        transaction.create(record_refs[key], record)
+    for employee_id, balance in writes.items():
+        transaction.set(refs[employee_id], {"balance": balance})
+    return results
+
+
+class AsyncPTOStore:
+    """
+    Coroutine counterparts of the PTO model operations, backed by Firestore's
+    AsyncClient. Writes go through the same balance cache and change
+    listeners as the synchronous model. The client is the shared one from
+    utils.gcp_clients, closed by close_all().
+    """
+
+    def __init__(self, client: Optional[firestore.AsyncClient] = None):
+        self.client = client or get_async_firestore_client()
+
+    def _doc(self, employee_id: str):
+        return self.client.collection("pto").document(str(employee_id))
+
+    def _record_ref(self, key: str):
+        return self.client.collection(LEDGER_COLLECTION).document(key)
+
+    async def get_balance(self, employee_id: str) -> Optional[int]:
+        employee_id = str(employee_id)
+        balance = mirror_lookup([employee_id]).get(employee_id)
+        if balance is None:
+            balance = balance_cache.get(employee_id)
+        if balance is not None:
+            return balance
+        snapshot = await self._doc(employee_id).get()
+        if not snapshot.exists:
+            return None
+        balance = stored_balance(snapshot)
+        balance_cache.put(employee_id, balance)
+        return balance
+
+    async def get_many(self, employee_ids: List[str]) -> Dict[str, Optional[int]]:
+        """Coroutine counterpart of PTO.get_many; the get_all chunks run concurrently."""
+        employee_ids = list(map(str, employee_ids))
+        balances = mirror_lookup(employee_ids)
+        missing = []
+        for employee_id in employee_ids:
+            if employee_id in balances:
+                continue
+            balances[employee_id] = balance_cache.get(employee_id)
+            if balances[employee_id] is None:
+                missing.append(employee_id)
+
+        async def read_chunk(chunk: List[str]):
+            refs = [self._doc(employee_id) for employee_id in chunk]
+            return [
+                (snapshot.id, stored_balance(snapshot))
+                async for snapshot in self.client.get_all(refs, field_paths=["balance"]) if snapshot.exists
+            ]
+
+        chunks = [missing[start:start + GET_MANY_CHUNK_SIZE] for start in range(0, len(missing), GET_MANY_CHUNK_SIZE)]
+        for chunk_results in await asyncio.gather(*(read_chunk(chunk) for chunk in chunks)):
+            for employee_id, balance in chunk_results:
+                balances[employee_id] = balance
+                balance_cache.put(employee_id, balance)
+        return balances
+
+    async def set_balance(self, employee_id: str, balance: int):
+        await self._doc(employee_id).set({"balance": balance})
+        record_write(str(employee_id), balance)
+
+    async def adjust_balance(self, employee_id: str, delta: int) -> int:
+        write_result = await self._doc(employee_id).set({"balance": firestore.Increment(delta)}, merge=True)
+        balance = _decode_number(write_result.transform_results[0])
+        record_write(str(employee_id), balance)
+        return balance
+
+    async def deduct(self, employee_id: str, hours: int, require_sufficient: bool = False) -> Tuple[bool, int]:
+        if not require_sufficient:
+            return True, await self.adjust_balance(employee_id, -hours)
+        applied, balance = await _deduct_in_transaction(self.client.transaction(), self._doc(employee_id), hours)
+        record_write(str(employee_id), balance)
+        return applied, balance
+
+    async def deduct_once(self, key: Optional[str], employee_id: str, hours: int,
+                          require_sufficient: bool = False) -> Tuple[bool, int, bool]:
+        """Coroutine counterpart of pto_update.idempotency.deduct_once."""
+        if key is None:
+            applied, balance = await self.deduct(employee_id, hours, require_sufficient)
+            return applied, balance, False
+
+        recalled = recall(key)
+        if recalled is not None:
+            return recalled
+
+        employee_id = str(employee_id)
+        record_ref = self._record_ref(key)
+        if require_sufficient:
+            result = await _deduct_once_in_transaction(
+                self.client.transaction(), self._doc(employee_id), record_ref, hours
+            )
+        else:
+            # The create fails if the key was recorded, and takes the increment down with it.
+            batch = self.client.batch()
+            batch.set(self._doc(employee_id), {"balance": firestore.Increment(-hours)}, merge=True)
+            batch.create(record_ref, ledger_record(employee_id, hours, True, None))
+            try:
+                write_results = await batch.commit()
+            except AlreadyExists:
+                result = True, (await self.get_balance(employee_id)) or 0, True
+            else:
+                result = True, _decode_number(write_results[0].transform_results[0]), False
+        return settle(key, employee_id, result)
+
+    async def create_many(self, employee_ids: List[str], balance: int = 0) -> List[str]:
+        """Coroutine counterpart of PTO.create_many."""
+        employee_ids = list(map(str, employee_ids))
+        created = []
+
+        async def commit(chunk: List[str]):
+            batch = self.client.batch()
+            for employee_id in chunk:
+                batch.create(self._doc(employee_id), {"balance": balance})
+            await batch.commit()
+            for employee_id in chunk:
+                record_write(employee_id, balance)
+            created.extend(chunk)
+
+        for start in range(0, len(employee_ids), MAX_BATCH_WRITES):
+            chunk = employee_ids[start:start + MAX_BATCH_WRITES]
+            try:
+                await commit(chunk)
+            except AlreadyExists:
+                for employee_id in chunk:
+                    try:
+                        await commit([employee_id])
+                    except AlreadyExists:
+                        pass
+        return created
+
+    async def commit_changes(self, changes: Dict[str, BalanceChange],
+                             creates: Optional[Dict[str, list]] = None) -> Dict[str, int]:
+        """Coroutine counterpart of PTO.commit_changes; an envelope's changes usually fit one commit."""
+        creates = creates or {}
+
+        async def commit(chunk):
+            batch = self.client.batch()
+            result_index = add_change_writes(batch, self.client.collection("pto"), chunk, creates)
+            return committed_balances(chunk, result_index, await batch.commit())
+
+        balances = {}
+        for chunk_balances in await asyncio.gather(*(commit(chunk) for chunk in change_chunks(changes, creates))):
+            balances.update(chunk_balances)
+        return balances
+
+    async def commit_deductions_once(self, requests: List[Tuple[Optional[str], str, int]]
+                                     ) -> List[Tuple[bool, int, bool]]:
+        """Coroutine counterpart of pto_update.idempotency.commit_deductions_once."""
+        requests = [(key, str(employee_id), hours) for key, employee_id, hours in requests]
+        results, pending = _split_remembered(requests)
+
+        recorded = set()
+        keys = [requests[index][0] for index in pending if requests[index][0] is not None]
+        if keys:
+            refs = [self._record_ref(key) for key in keys]
+            recorded = {snapshot.id async for snapshot in self.client.get_all(refs, field_paths=["applied"])
+                        if snapshot.exists}
+
+        changes, creates, applying, duplicates = plan_commits(requests, pending, recorded, self._record_ref)
+        balances = await self.commit_changes(changes, creates=creates) if changes else {}
+        for index in duplicates:
+            employee_id = requests[index][1]
+            if employee_id not in balances:
+                balances[employee_id] = (await self.get_balance(employee_id)) or 0
+        settle_commits(requests, results, applying, duplicates, balances)
+        return results
+
+    async def deduct_many_once(self, requests: List[Tuple[Optional[str], str, int]]
+                               ) -> List[Tuple[bool, int, bool]]:
+        """Coroutine counterpart of pto_update.idempotency.deduct_many_once."""
+        requests = [(key, str(employee_id), hours) for key, employee_id, hours in requests]
+        results, pending = _split_remembered(requests)
+        # Each request may write its balance and its ledger record.
+        chunk_size = MAX_BATCH_WRITES // 2
+        for start in range(0, len(pending), chunk_size):
+            indexes = pending[start:start + chunk_size]
+            chunk = [requests[index] for index in indexes]
+            chunk_results = await _deduct_many_once_in_transaction(self.client.transaction(), self.client, chunk)
+            for index, (key, employee_id, _), result in zip(indexes, chunk, chunk_results):
+                results[index] = settle(key, employee_id, result)
+        return results
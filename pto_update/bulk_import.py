@@ -0,0 +1,246 @@
+"""
+Bulk balance import: stream a JSONL or CSV file of employee_id/balance rows,
+validate each row and set the balances with parallel batched commits,
+instead of sending one pto_update message per employee.
+
+    {"employee_id": "E100", "balance": 40}
+
+or, as CSV with a header row:
+
+    employee_id,balance
+    E100,40
+
+The file is read one chunk at a time and at most `workers` chunks are in
+flight, so memory stays bounded whatever the file size. Chunks are committed
+through PTO.commit_changes. A chunk that shares an employee with a chunk
+still in flight waits for it, so the last row for an employee always wins.
+Progress is checkpointed in pto_import_runs/<run_id> as the last line
+committed with every earlier line; an interrupted import resumes after it.
+Setting a balance is idempotent, so lines committed past the checkpoint are
+simply written again.
+"""
+import csv
+import json
+import time
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, Optional, Tuple
+
+from google.cloud import firestore
+
+from pto_update.models import MAX_BATCH_WRITES, PTO, BalanceChange
+from utils.gcp_clients import get_firestore_client
+
+logger = logging.getLogger(__name__)
+
+RUNS_COLLECTION = "pto_import_runs"
+# Invalid rows and dry-run differences printed before the rest are only counted.
+MAX_REPORTED_ROWS = 50
+
+
+def read_rows(path: str, file_format: Optional[str] = None) -> Iterator[Tuple[int, object]]:
+    """Yield (line_number, row) from a JSONL or CSV file, one line at a time."""
+    file_format = file_format or ("csv" if path.lower().endswith(".csv") else "jsonl")
+    with open(path, newline="" if file_format == "csv" else None) as f:
+        if file_format == "csv":
+            reader = csv.DictReader(f)
+            for row in reader:
+                yield reader.line_num, row
+            return
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                yield line_number, json.loads(line)
+            except ValueError as e:
+                yield line_number, e
+
+
+def validate_row(row) -> Tuple[str, int]:
+    """Return (employee_id, balance) for a row or raise ValueError."""
+    if isinstance(row, Exception):
+        raise ValueError(f"not valid JSON ({row})")
+    if not isinstance(row, dict):
+        raise ValueError("expected an object with employee_id and balance")
+    employee_id = str(row.get("employee_id") or "").strip()
+    if not employee_id:
+        raise ValueError("missing employee_id")
+    if "/" in employee_id:
+        raise ValueError(f"employee_id {employee_id!r} may not contain '/'")
+    balance = row.get("balance")
+    if isinstance(balance, str):
+        balance = balance.strip()
+        if not (balance[1:] if balance.startswith("-") else balance).isdigit():
+            raise ValueError(f"balance {balance!r} is not a whole number of hours")
+        balance = int(balance)
+    if isinstance(balance, bool) or not isinstance(balance, int):
+        raise ValueError(f"balance {balance!r} is not a whole number of hours")
+    return employee_id, balance
+
+
+class BalanceImport:
+    """One import of a balance file, identified by run_id."""
+
+    def __init__(self, path: str, run_id: str, file_format: Optional[str] = None,
+                 chunk_size: int = MAX_BATCH_WRITES, workers: int = 8, dry_run: bool = False,
+                 report: Callable[[str], None] = logger.info):
+        self.path = path
+        self.run_id = run_id
+        self.file_format = file_format
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.dry_run = dry_run
+        self.report = report
+        self.read = 0
+        self.invalid = 0
+        self.written = 0
+        self.unchanged = 0
+        self.changed = 0
+        self.new = 0
+
+    def _checkpoint_ref(self):
+        return get_firestore_client().collection(RUNS_COLLECTION).document(self.run_id)
+
+    def load_checkpoint(self) -> int:
+        snapshot = self._checkpoint_ref().get()
+        if not snapshot.exists:
+            return 0
+        data = snapshot.to_dict()
+        if data.get("completed"):
+            raise RuntimeError(f"Import {self.run_id} already completed at {data.get('completed_at')}.")
+        return data.get("last_line", 0)
+
+    def save_checkpoint(self, last_line: int, completed: bool = False):
+        if self.dry_run:
+            return
+        state = {
+            "path": self.path,
+            "last_line": last_line,
+            "written": self.written,
+            "invalid": self.invalid,
+            "completed": completed,
+            "updated_at": firestore.SERVER_TIMESTAMP,
+        }
+        if completed:
+            state["completed_at"] = firestore.SERVER_TIMESTAMP
+        self._checkpoint_ref().set(state, merge=True)
+
+    def _reject(self, line_number: int, error: ValueError):
+        self.invalid += 1
+        if self.invalid <= MAX_REPORTED_ROWS:
+            self.report(f"Line {line_number}: skipped, {error}")
+
+    def _diff(self, chunk: dict):
+        # Dry run: compare against the stored balances instead of writing.
+        current = PTO.get_many(list(chunk))
+        for employee_id, balance in chunk.items():
+            if current[employee_id] is None:
+                self.new += 1
+                change = f"{employee_id}: new record, {balance}"
+            elif current[employee_id] != balance:
+                self.changed += 1
+                change = f"{employee_id}: {current[employee_id]} -> {balance}"
+            else:
+                self.unchanged += 1
+                continue
+            if self.new + self.changed <= MAX_REPORTED_ROWS:
+                self.report(change)
+
+    def _commit(self, chunk: dict) -> int:
+        changes = {}
+        for employee_id, balance in chunk.items():
+            changes[employee_id] = BalanceChange()
+            changes[employee_id].set(balance)
+        PTO.commit_changes(changes)
+        return len(changes)
+
+    def _progress(self, started: float):
+        elapsed = max(time.monotonic() - started, 1e-9)
+        outcome = (
+            f"{self.new} new, {self.changed} changed, {self.unchanged} unchanged"
+            if self.dry_run else f"written {self.written}"
+        )
+        self.report(
+            f"Import {self.run_id}: read {self.read} rows ({self.read / elapsed:.0f} rows/s), "
+            f"{outcome}, invalid {self.invalid}"
+        )
+
+    def _chunks(self, start_after: int) -> Iterator[Tuple[dict, int]]:
+        """Yield ({employee_id: balance}, last line number) per chunk of valid rows."""
+        chunk = {}
+        last_line = start_after
+        for line_number, row in read_rows(self.path, self.file_format):
+            if line_number <= start_after:
+                continue
+            self.read += 1
+            last_line = line_number
+            try:
+                employee_id, balance = validate_row(row)
+            except ValueError as e:
+                self._reject(line_number, e)
+                continue
+            # A later row for the same employee replaces the earlier one.
+            chunk.pop(employee_id, None)
+            chunk[employee_id] = balance
+            if len(chunk) >= self.chunk_size:
+                yield chunk, last_line
+                chunk = {}
+        if chunk or last_line > start_after:
+            yield chunk, last_line
+
+    def run(self, resume: bool = True) -> dict:
+        start_after = self.load_checkpoint() if resume else 0
+        if start_after:
+            self.report(f"Resuming import {self.run_id} after line {start_after}.")
+
+        started = time.monotonic()
+        last_line = start_after
+        # (future, employee IDs, last line) per chunk in flight, oldest first.
+        in_flight = deque()
+
+        def finish_oldest():
+            nonlocal last_line
+            future, _, chunk_last_line = in_flight.popleft()
+            self.written += future.result()
+            # Every earlier chunk has finished, so everything up to here is durable.
+            last_line = chunk_last_line
+            self.save_checkpoint(last_line)
+            self._progress(started)
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="pto-import") as executor:
+            try:
+                for chunk, chunk_last_line in self._chunks(start_after):
+                    if self.dry_run:
+                        self._diff(chunk)
+                        last_line = chunk_last_line
+                        self._progress(started)
+                        continue
+                    employee_ids = set(chunk)
+                    while in_flight and (
+                        len(in_flight) >= self.workers
+                        or any(employee_ids & pending for _, pending, _ in in_flight)
+                    ):
+                        finish_oldest()
+                    in_flight.append((executor.submit(self._commit, chunk), employee_ids, chunk_last_line))
+                while in_flight:
+                    finish_oldest()
+            except Exception:
+                for future, _, _ in in_flight:
+                    future.cancel()
+                raise
+
+        self.save_checkpoint(last_line, completed=True)
+        elapsed = time.monotonic() - started
+        return {
+            "run_id": self.run_id,
+            "read": self.read,
+            "invalid": self.invalid,
+            "written": self.written,
+            "new": self.new,
+            "changed": self.changed,
+            "unchanged": self.unchanged,
+            "last_line": last_line,
+            "seconds": round(elapsed, 2),
+            "rows_per_second": round(self.read / elapsed, 1) if elapsed else 0.0,
+        }
@@ -0,0 +1,195 @@
+"""
+Columnar export of the pto collection for reconciliation scripts, which can
+load the files instead of scanning Firestore.
+
+The collection is streamed with field projection, a page at a time, and
+written as gzip-compressed CSV and/or Parquet (Parquet needs pyarrow
+installed). Rows are buffered into row groups of at most row_group_size, so
+memory stays bounded by one row group per partition.
+
+The ID space is split into partitions at the given employee IDs, e.g.
+split_at=["E2000", "E5000"] gives [start, E2000), [E2000, E5000) and
+[E5000, end). The partitions are exported in parallel, one file per
+partition and format. A manifest.json next to the files lists each file's
+ID range and row count. In ledger mode the balances are the compacted
+snapshots, as for PTO.iter_balances.
+"""
+import os
+import csv
+import gzip
+import json
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional
+
+from pto_update.models import PTO
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ("csv", "parquet")
+
+
+class CsvPartitionWriter:
+    extension = "csv.gz"
+
+    def __init__(self, path: str, columns: List[str]):
+        self._file = gzip.open(path, "wt", newline="")
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(columns)
+
+    def write_rows(self, rows: List[list]):
+        self._writer.writerows(rows)
+
+    def close(self):
+        self._file.close()
+
+
+def as_float(value) -> Optional[float]:
+    """A balance as float64, or None (null) when it is missing or not a number."""
+    if value is None or isinstance(value, bool):
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class ParquetPartitionWriter:
+    extension = "parquet"
+
+    def __init__(self, path: str, columns: List[str]):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError("Parquet export needs pyarrow; install it or export CSV only.")
+        self._pyarrow = pyarrow
+        self._columns = columns
+        # A fixed schema keeps every row group alike even when a field is
+        # missing from a whole group. Balances may be fractional, so they
+        # are float64; other fields are strings.
+        self._schema = pyarrow.schema([
+            (column, pyarrow.float64() if column == "balance" else pyarrow.string()) for column in columns
+        ])
+        self._writer = pyarrow.parquet.ParquetWriter(path, self._schema, compression="zstd")
+
+    def write_rows(self, rows: List[list]):
+        # Each call is one row group.
+        columns = {}
+        for index, column in enumerate(self._columns):
+            values = [row[index] for row in rows]
+            if column == "balance":
+                values = [as_float(value) for value in values]
+            else:
+                values = [None if value is None else str(value) for value in values]
+            columns[column] = values
+        self._writer.write_table(self._pyarrow.table(columns, schema=self._schema))
+
+    def close(self):
+        self._writer.close()
+
+
+WRITERS = {"csv": CsvPartitionWriter, "parquet": ParquetPartitionWriter}
+
+
+class BalanceExport:
+    """One export of the pto collection into output_dir."""
+
+    def __init__(self, output_dir: str, formats=("csv",), fields=("balance",),
+                 split_at: Optional[List[str]] = None, page_size: int = 1000,
+                 row_group_size: int = 100000, workers: int = 4,
+                 report: Callable[[str], None] = logger.info):
+        self.output_dir = output_dir
+        self.formats = list(dict.fromkeys(formats))
+        self.fields = list(fields)
+        self.split_at = sorted(set(split_at or []))
+        self.page_size = page_size
+        self.row_group_size = row_group_size
+        self.workers = workers
+        self.report = report
+        self.rows = 0
+        self._lock = threading.Lock()
+
+    def partitions(self) -> List[tuple]:
+        """(start_at, end_before) per partition; None leaves that end open."""
+        bounds = [None] + self.split_at + [None]
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def _export_partition(self, number: int, start_at: Optional[str], end_before: Optional[str],
+                          started: float) -> dict:
+        columns = ["employee_id"] + self.fields
+        paths = {
+            file_format: os.path.join(self.output_dir, f"pto-{number:05d}.{WRITERS[file_format].extension}")
+            for file_format in self.formats
+        }
+        writers = []
+        rows = 0
+        buffer = []
+        try:
+            for file_format, path in paths.items():
+                writers.append(WRITERS[file_format](path, columns))
+            documents = PTO.iter_documents(
+                self.fields, self.page_size, start_at=start_at, end_before=end_before
+            )
+            for employee_id, data in documents:
+                buffer.append([employee_id] + [data.get(field) for field in self.fields])
+                if len(buffer) >= self.row_group_size:
+                    for writer in writers:
+                        writer.write_rows(buffer)
+                    rows += len(buffer)
+                    self._count(len(buffer), started)
+                    buffer = []
+            if buffer:
+                for writer in writers:
+                    writer.write_rows(buffer)
+                rows += len(buffer)
+                self._count(len(buffer), started)
+        finally:
+            for writer in writers:
+                writer.close()
+        return {
+            "files": {file_format: os.path.basename(path) for file_format, path in paths.items()},
+            "start_at": start_at,
+            "end_before": end_before,
+            "rows": rows,
+        }
+
+    def _count(self, rows: int, started: float):
+        with self._lock:
+            self.rows += rows
+            total = self.rows
+        elapsed = max(time.monotonic() - started, 1e-9)
+        self.report(f"Export: {total} rows ({total / elapsed:.0f} rows/s)")
+
+    def run(self) -> dict:
+        os.makedirs(self.output_dir, exist_ok=True)
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="pto-export") as executor:
+            futures = [
+                executor.submit(self._export_partition, number, start_at, end_before, started)
+                for number, (start_at, end_before) in enumerate(self.partitions())
+            ]
+            partitions = [future.result() for future in futures]
+
+        elapsed = time.monotonic() - started
+        size = sum(
+            os.path.getsize(os.path.join(self.output_dir, name))
+            for partition in partitions for name in partition["files"].values()
+        )
+        manifest = {
+            "columns": ["employee_id"] + self.fields,
+            "formats": self.formats,
+            "rows": self.rows,
+            "partitions": partitions,
+        }
+        with open(os.path.join(self.output_dir, "manifest.json"), "w") as f:
+            json.dump(manifest, f, indent=2)
+        return {
+            "rows": self.rows,
+            "partitions": len(partitions),
+            "bytes": size,
+            "seconds": round(elapsed, 2),
+            "rows_per_second": round(self.rows / elapsed, 1) if elapsed else 0.0,
+        }
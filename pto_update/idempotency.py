@@ -0,0 +1,313 @@
+"""
+Idempotency ledger for PTO deductions.
+
+Pub/Sub delivers at least once, so a nacked or lease-expired message comes
+back. Every deduction is keyed by the producer's request_id when the payload
+carries one, otherwise by the Pub/Sub message ID. A record under that key in
+the pto_idempotency collection is written in the same commit as the balance
+change. A redelivered request finds its record and is answered from it
+without writing the balance document again. A per-process LRU of recently
+applied keys answers most redeliveries without any Firestore call.
+
+Records carry an expires_at timestamp. Enable a Firestore TTL policy on it so
+they are deleted once Pub/Sub can no longer redeliver:
+
+    gcloud firestore fields ttls update expires_at \
+        --collection-group=pto_idempotency --enable-ttl
+
+In ledger mode (see pto_update.ledger) the key is the ID of the deduction's
+ledger entry instead, and no separate record is written.
+"""
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+
+from google.api_core.exceptions import AlreadyExists
+from google.cloud import firestore
+
+from pto_update import ledger
+from pto_update.models import (
+    MAX_BATCH_WRITES, PTO, BalanceCache, BalanceChange, _decode_number, _pto_collection, plan_deduction,
+    record_write, stored_balance,
+)
+from utils.gcp_clients import get_firestore_client
+from utils.metrics import DUPLICATES_SKIPPED, firestore_call
+
+IDEMPOTENCY_ENABLED = os.getenv("PTO_IDEMPOTENCY_ENABLED", "True") == "True"
+# Pub/Sub keeps unacknowledged messages for at most 7 days.
+IDEMPOTENCY_TTL_SECONDS = float(os.getenv("PTO_IDEMPOTENCY_TTL_SECONDS", str(7 * 24 * 3600)))
+RECENT_MAX_ENTRIES = int(os.getenv("PTO_IDEMPOTENCY_RECENT_MAX_ENTRIES", "100000"))
+RECENT_TTL_SECONDS = float(os.getenv("PTO_IDEMPOTENCY_RECENT_TTL_SECONDS", "600"))
+
+LEDGER_COLLECTION = "pto_idempotency"
+
+# key -> (applied, balance) for requests this process has already answered.
+recent_results = BalanceCache(RECENT_MAX_ENTRIES, RECENT_TTL_SECONDS)
+
+
+def key_for(service: str, message, request_id: Optional[str] = None) -> Optional[str]:
+    """Ledger key for a request, or None when idempotency is disabled."""
+    if not IDEMPOTENCY_ENABLED:
+        return None
+    request_id = request_id or getattr(message, "message_id", None)
+    if not request_id:
+        return None
+    # "/" would be read as a path separator in a document ID.
+    return f"{service}:{request_id}".replace("/", "_")
+
+
+def ledger_ref(key: str):
+    return get_firestore_client().collection(LEDGER_COLLECTION).document(key)
+
+
+def ledger_record(employee_id: str, hours: int, applied: bool, balance: Optional[int]) -> dict:
+    return {
+        "employee_id": str(employee_id),
+        "hours": hours,
+        "applied": applied,
+        "balance": balance,
+        "processed_at": firestore.SERVER_TIMESTAMP,
+        "expires_at": datetime.now(timezone.utc) + timedelta(seconds=IDEMPOTENCY_TTL_SECONDS),
+    }
+
+
+def remember(key: Optional[str], applied: bool, balance: int, duplicate: bool = False):
+    if key is None:
+        return
+    recent_results.put(key, (applied, balance))
+    if duplicate:
+        DUPLICATES_SKIPPED.labels(key.split(":", 1)[0]).inc()
+
+
+def recall(key: str) -> Optional[Tuple[bool, int, bool]]:
+    """The (applied, balance, duplicate) result of a key this process answered recently, or None."""
+    remembered = recent_results.get(key)
+    if remembered is None:
+        return None
+    remember(key, *remembered, duplicate=True)
+    return remembered[0], remembered[1], True
+
+
+def settle(key: Optional[str], employee_id: str, result: Tuple[bool, int, bool]) -> Tuple[bool, int, bool]:
+    """Record a deduction's outcome in the balance cache and the recent-key LRU."""
+    applied, balance, duplicate = result
+    if not duplicate:
+        record_write(employee_id, balance)
+    remember(key, applied, balance, duplicate)
+    return result
+
+
+def recorded_result(record) -> Tuple[bool, int, bool]:
+    """The (applied, balance, duplicate) result stored in an existing ledger record."""
+    data = record.to_dict() or {}
+    return data.get("applied", True), data.get("balance"), True
+
+
+def _current_balance(employee_id: str) -> int:
+    pto = PTO.get_by_employee_id(employee_id)
+    return pto.balance if pto else 0
+
+
+@firestore.transactional
+def _deduct_once_in_transaction(transaction, doc_ref, record_ref, hours: int) -> Tuple[bool, int, bool]:
+    record = record_ref.get(transaction=transaction)
+    if record.exists:
+        return recorded_result(record)
+    snapshot = doc_ref.get(transaction=transaction)
+    applied, balance, write = plan_deduction(snapshot.exists, stored_balance(snapshot), hours)
+    if write:
+        transaction.set(doc_ref, {"balance": balance})
+    transaction.create(record_ref, ledger_record(doc_ref.id, hours, applied, balance))
+    return applied, balance, False
+
+
+def deduct_once(key: Optional[str], employee_id: str, hours: int,
+                require_sufficient: bool = False) -> Tuple[bool, int, bool]:
+    """
+    PTO.deduct that applies at most once per key. Returns (applied, balance,
+    duplicate); a duplicate reports the outcome recorded for the key and
+    leaves the balance untouched. Without a key this is a plain PTO.deduct.
+    """
+    if key is None:
+        applied, balance = PTO.deduct(employee_id, hours, require_sufficient=require_sufficient)
+        return applied, balance, False
+
+    recalled = recall(key)
+    if recalled is not None:
+        return recalled
+
+    employee_id = str(employee_id)
+    doc_ref = _pto_collection().document(employee_id)
+    if ledger.LEDGER_MODE:
+        # The key names the ledger entry itself.
+        result = ledger.deduct(employee_id, hours, require_sufficient, entry_id=key)
+    elif require_sufficient:
+        with firestore_call("transaction", "firestore_write"):
+            result = _deduct_once_in_transaction(get_firestore_client().transaction(), doc_ref, ledger_ref(key), hours)
+    else:
+        # The create fails if the key was recorded, and takes the increment down with it.
+        batch = get_firestore_client().batch()
+        batch.set(doc_ref, {"balance": firestore.Increment(-hours)}, merge=True)
+        batch.create(ledger_ref(key), ledger_record(employee_id, hours, True, None))
+        try:
+            with firestore_call("batch_commit", "firestore_write", expected=(AlreadyExists,)):
+                write_results = batch.commit()
+        except AlreadyExists:
+            result = True, _current_balance(employee_id), True
+        else:
+            result = True, _decode_number(write_results[0].transform_results[0]), False
+    return settle(key, employee_id, result)
+
+
+def _split_remembered(requests) -> Tuple[list, list]:
+    """Answer requests seen recently by this process; return (results, indexes still pending)."""
+    results = [None] * len(requests)
+    pending = []
+    for index, (key, _, _) in enumerate(requests):
+        recalled = recall(key) if key is not None else None
+        if recalled is not None:
+            results[index] = recalled
+        else:
+            pending.append(index)
+    return results, pending
+
+
+def plan_deductions(requests, snapshots) -> Tuple[list, dict, list]:
+    """
+    Plan sufficient-balance deductions for (key, employee_id, hours) requests
+    in arrival order from the pto and ledger-record snapshots read in one
+    transaction. Returns ((applied, balance, duplicate) per request,
+    {employee_id: balance to set}, [(key, ledger record to create)]).
+    """
+    balances = {employee_id: 0 for _, employee_id, _ in requests}
+    recorded = {}
+    for snapshot in snapshots:
+        if not snapshot.exists:
+            continue
+        if snapshot.reference.parent.id == LEDGER_COLLECTION:
+            recorded[snapshot.id] = recorded_result(snapshot)
+        else:
+            balances[snapshot.id] = stored_balance(snapshot)
+
+    results = []
+    changed = set()
+    creates = []
+    for key, employee_id, hours in requests:
+        if key in recorded:
+            results.append(recorded[key])
+            continue
+        # Every requested employee is written, so a missing record is created at 0.
+        applied, balances[employee_id], _ = plan_deduction(True, balances[employee_id], hours)
+        changed.add(employee_id)
+        results.append((applied, balances[employee_id], False))
+        if key is not None:
+            recorded[key] = (applied, balances[employee_id], True)
+            creates.append((key, ledger_record(employee_id, hours, applied, balances[employee_id])))
+    return results, {employee_id: balances[employee_id] for employee_id in changed}, creates
+
+
+@firestore.transactional
+def _deduct_many_once_in_transaction(transaction, requests) -> List[Tuple[bool, int, bool]]:
+    refs = {employee_id: _pto_collection().document(employee_id) for _, employee_id, _ in requests}
+    record_refs = {key: ledger_ref(key) for key, _, _ in requests if key is not None}
+    db = get_firestore_client()
+    snapshots = db.get_all(list(refs.values()) + list(record_refs.values()), transaction=transaction)
+    results, writes, creates = plan_deductions(requests, snapshots)
+    for key, record in creates:
+        transaction.create(record_refs[key], record)
+    for employee_id, balance in writes.items():
+        transaction.set(refs[employee_id], {"balance": balance})
+    return results
+
+
+def deduct_many_once(requests: List[Tuple[Optional[str], str, int]]) -> List[Tuple[bool, int, bool]]:
+    """
+    Sufficient-balance deductions for (key, employee_id, hours) requests,
+    applied in arrival order inside one transaction per chunk and at most
+    once per key. Returns (applied, balance, duplicate) per request.
+    """
+    requests = [(key, str(employee_id), hours) for key, employee_id, hours in requests]
+    results, pending = _split_remembered(requests)
+    # Each request may write its balance and its ledger record.
+    chunk_size = MAX_BATCH_WRITES // 2
+    for start in range(0, len(pending), chunk_size):
+        indexes = pending[start:start + chunk_size]
+        chunk = [requests[index] for index in indexes]
+        if ledger.LEDGER_MODE:
+            chunk_results = ledger.deduct_many(chunk)
+        else:
+            with firestore_call("transaction", "firestore_write"):
+                chunk_results = _deduct_many_once_in_transaction(get_firestore_client().transaction(), chunk)
+        for index, (key, employee_id, _), result in zip(indexes, chunk, chunk_results):
+            results[index] = settle(key, employee_id, result)
+    return results
+
+
+def plan_commits(requests, pending: List[int], recorded: set, record_ref) -> Tuple[dict, dict, list, list]:
+    """
+    Merge the pending unconditional deductions per employee. Keys already in
+    recorded are duplicates; the others get their ledger record, built with
+    record_ref(key), created with the employee's change. Returns (changes,
+    creates, indexes applying, indexes of duplicates).
+    """
+    recorded = set(recorded)
+    changes = {}
+    creates = {}
+    applying = []
+    duplicates = []
+    for index in pending:
+        key, employee_id, hours = requests[index]
+        if key is not None and key in recorded:
+            duplicates.append(index)
+            continue
+        changes.setdefault(employee_id, BalanceChange()).add(-hours)
+        if key is not None:
+            recorded.add(key)
+            creates.setdefault(employee_id, []).append((record_ref(key), ledger_record(employee_id, hours, True, None)))
+        applying.append(index)
+    return changes, creates, applying, duplicates
+
+
+def settle_commits(requests, results: list, applying: List[int], duplicates: List[int], balances: Dict[str, int]):
+    """Fill in results from the committed balances, which must cover the duplicates' employees too."""
+    for index in applying:
+        key, employee_id, _ = requests[index]
+        results[index] = (True, balances[employee_id], False)
+        remember(key, True, balances[employee_id])
+    for index in duplicates:
+        key, employee_id, _ = requests[index]
+        results[index] = (True, balances[employee_id], True)
+        remember(key, True, balances[employee_id], duplicate=True)
+
+
+def commit_deductions_once(requests: List[Tuple[Optional[str], str, int]]) -> List[Tuple[bool, int, bool]]:
+    """
+    Unconditional deductions for (key, employee_id, hours) requests, merged
+    per employee into batched increments the way PTO.commit_changes does,
+    with each key's ledger record created in the same commit. Returns
+    (applied, balance, duplicate) per request.
+    """
+    requests = [(key, str(employee_id), hours) for key, employee_id, hours in requests]
+    results, pending = _split_remembered(requests)
+    if ledger.LEDGER_MODE:
+        ledger_results = ledger.deduct_many([requests[index] for index in pending], require_sufficient=False)
+        for index, result in zip(pending, ledger_results):
+            key, employee_id, _ = requests[index]
+            results[index] = settle(key, employee_id, result)
+        return results
+
+    recorded = set()
+    keys = [requests[index][0] for index in pending if requests[index][0] is not None]
+    if keys:
+        with firestore_call("get_all", "firestore_read"):
+            snapshots = get_firestore_client().get_all([ledger_ref(key) for key in keys], field_paths=["applied"])
+            recorded = {snapshot.id for snapshot in snapshots if snapshot.exists}
+
+    changes, creates, applying, duplicates = plan_commits(requests, pending, recorded, ledger_ref)
+    balances = PTO.commit_changes(changes, creates=creates) if changes else {}
+    for index in duplicates:
+        employee_id = requests[index][1]
+        if employee_id not in balances:
+            balances[employee_id] = _current_balance(employee_id)
+    settle_commits(requests, results, applying, duplicates, balances)
+    return results
@@ -0,0 +1,371 @@
+"""
+Event-sourced PTO balances (PTO_LEDGER_MODE=True).
+
+Every change is appended as an entry under pto/{employee_id}/entries instead
+of overwriting the balance. Concurrent writers for one employee therefore no
+longer contend on a single document, and every change is kept as an audit
+trail. The pto/{employee_id} document becomes a snapshot: the balance as of
+snapshot_at, the commit time of the last entry folded into it. A balance is
+read as the snapshot plus the entries after it. LedgerCompactor periodically
+folds new entries into their snapshots to keep that tail short.
+
+Entry kinds:
+  - "update" sets the balance.
+  - "deduction" and "accrual" add delta, which is negative for deductions.
+  - A refused sufficient-balance deduction is still recorded, with applied
+    False and delta 0.
+
+When an idempotency key is given it becomes the entry's document ID, so a
+redelivered request finds its own entry instead of appending a second one.
+
+The compactor finds recently written employees with a collection-group query
+on entries.created_at. That query needs a collection-group single-field index
+on created_at.
+"""
+import os
+import time
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+
+from google.api_core.exceptions import AlreadyExists
+from google.cloud import firestore
+
+from utils.gcp_clients import get_firestore_client
+from utils.metrics import firestore_call
+
+logger = logging.getLogger(__name__)
+
+LEDGER_MODE = os.getenv("PTO_LEDGER_MODE", "False") == "True"
+COMPACT_INTERVAL_SECONDS = float(os.getenv("PTO_LEDGER_COMPACT_INTERVAL_SECONDS", "60"))
+# How far back the first compaction pass after startup looks for new entries.
+COMPACT_LOOKBACK_SECONDS = float(os.getenv("PTO_LEDGER_COMPACT_LOOKBACK_SECONDS", "3600"))
+
+ENTRIES = "entries"
+# Firestore caps a single commit at 500 writes.
+MAX_BATCH_WRITES = 500
+
+
+def snapshot_ref(employee_id: str):
+    return get_firestore_client().collection("pto").document(str(employee_id))
+
+
+def entry_ref(employee_id: str, entry_id: Optional[str] = None):
+    entries = snapshot_ref(employee_id).collection(ENTRIES)
+    return entries.document(entry_id) if entry_id else entries.document()
+
+
+def new_entry(kind: str, delta: int = 0, set_to: Optional[int] = None,
+              applied: bool = True, balance: Optional[int] = None) -> dict:
+    entry = {"kind": kind, "delta": delta, "applied": applied, "created_at": firestore.SERVER_TIMESTAMP}
+    if set_to is not None:
+        entry["set_to"] = set_to
+    if balance is not None:
+        # Balance after this entry, when the writer knew it.
+        entry["balance"] = balance
+    return entry
+
+
+def fold(balance: int, entries) -> int:
+    for entry in entries:
+        entry = entry or {}
+        if entry.get("set_to") is not None:
+            balance = entry["set_to"]
+        else:
+            balance += entry.get("delta", 0)
+    return balance
+
+
+def recorded_outcome(snapshot) -> Tuple[bool, Optional[int]]:
+    """
+    (applied, balance) of an existing entry. Entries appended without a
+    sufficient-balance check carry no balance; it is None for those.
+    """
+    data = snapshot.to_dict() or {}
+    return data.get("applied", True), data.get("balance")
+
+
+def _tail_query(employee_id: str, snapshot_at=None):
+    # Entries written in one commit share created_at; the document ID breaks
+    # the tie so every reader folds them in the same order.
+    query = snapshot_ref(employee_id).collection(ENTRIES).order_by("created_at").order_by("__name__")
+    if snapshot_at is not None:
+        query = query.where("created_at", ">", snapshot_at)
+    return query
+
+
+def read_balance(employee_id: str, transaction=None) -> Tuple[bool, int]:
+    """Return (exists, balance): the snapshot folded with the entries after it."""
+    snapshot = snapshot_ref(employee_id).get(transaction=transaction)
+    data = (snapshot.to_dict() or {}) if snapshot.exists else {}
+    tail = [doc.to_dict() for doc in _tail_query(employee_id, data.get("snapshot_at")).stream(transaction=transaction)]
+    return snapshot.exists or bool(tail), fold(data.get("balance", 0), tail)
+
+
+def get_balance(employee_id: str) -> Optional[int]:
+    with firestore_call("ledger_read", "firestore_read"):
+        exists, balance = read_balance(employee_id)
+    return balance if exists else None
+
+
+def set_balance(employee_id: str, balance: int):
+    with firestore_call("ledger_append", "firestore_write"):
+        entry_ref(employee_id).create(new_entry("update", set_to=balance, balance=balance))
+
+
+def adjust_balance(employee_id: str, delta: int) -> int:
+    """
+    Append a deduction or accrual and return the resulting balance. That is
+    three round-trips (append, snapshot read, tail query) against one for a
+    balance-document update; the price of never contending on the snapshot.
+    """
+    kind = "accrual" if delta > 0 else "deduction"
+    with firestore_call("ledger_append", "firestore_write"):
+        entry_ref(employee_id).create(new_entry(kind, delta=delta))
+    with firestore_call("ledger_read", "firestore_read"):
+        return read_balance(employee_id)[1]
+
+
+@firestore.transactional
+def _deduct_in_transaction(transaction, employee_id: str, hours: int,
+                           entry_id: Optional[str]) -> Tuple[bool, int, bool]:
+    ref = entry_ref(employee_id, entry_id)
+    if entry_id:
+        existing = ref.get(transaction=transaction)
+        if existing.exists:
+            applied, balance = recorded_outcome(existing)
+            if balance is None:
+                balance = read_balance(employee_id, transaction=transaction)[1]
+            return applied, balance, True
+    _, balance = read_balance(employee_id, transaction=transaction)
+    applied = balance >= hours
+    if applied:
+        balance -= hours
+    transaction.create(ref, new_entry("deduction", delta=-hours if applied else 0, applied=applied, balance=balance))
+    return applied, balance, False
+
+
+def deduct(employee_id: str, hours: int, require_sufficient: bool = False,
+           entry_id: Optional[str] = None) -> Tuple[bool, int, bool]:
+    """
+    Append a deduction and return (applied, balance, duplicate). A duplicate
+    is a request whose entry_id was already recorded; nothing is appended.
+    Like adjust_balance() this costs three round-trips, or one transaction
+    with require_sufficient.
+    """
+    employee_id = str(employee_id)
+    if require_sufficient:
+        with firestore_call("ledger_transaction", "firestore_write"):
+            return _deduct_in_transaction(get_firestore_client().transaction(), employee_id, hours, entry_id)
+
+    duplicate = False
+    try:
+        with firestore_call("ledger_append", "firestore_write", expected=(AlreadyExists,)):
+            entry_ref(employee_id, entry_id).create(new_entry("deduction", delta=-hours))
+    except AlreadyExists:
+        duplicate = True
+    with firestore_call("ledger_read", "firestore_read"):
+        return True, read_balance(employee_id)[1], duplicate
+
+
+def append_entries(items: List[Tuple[str, Optional[str], dict]]) -> Dict[str, int]:
+    """
+    Create (employee_id, entry_id, entry) items in batched commits and return
+    the resulting balance of every employee touched. A batch fails if any of
+    its entry IDs already exists.
+    """
+    for start in range(0, len(items), MAX_BATCH_WRITES):
+        batch = get_firestore_client().batch()
+        for employee_id, entry_id, entry in items[start:start + MAX_BATCH_WRITES]:
+            batch.create(entry_ref(employee_id, entry_id), entry)
+        with firestore_call("ledger_batch_append", "firestore_write"):
+            batch.commit()
+
+    balances = {}
+    with firestore_call("ledger_read", "firestore_read"):
+        for employee_id, _, _ in items:
+            if employee_id not in balances:
+                balances[employee_id] = read_balance(employee_id)[1]
+    return balances
+
+
+def existing_entries(requests: List[Tuple[Optional[str], str, int]]) -> Dict[str, dict]:
+    """Already-recorded entries for the keyed (entry_id, employee_id, hours) requests, by entry_id."""
+    refs = [entry_ref(employee_id, entry_id) for entry_id, employee_id, _ in requests if entry_id]
+    if not refs:
+        return {}
+    with firestore_call("get_all", "firestore_read"):
+        return {
+            snapshot.id: snapshot.to_dict()
+            for snapshot in get_firestore_client().get_all(refs) if snapshot.exists
+        }
+
+
+@firestore.transactional
+def _deduct_many_in_transaction(transaction, requests) -> List[Tuple[bool, int, bool]]:
+    refs = {}
+    for entry_id, employee_id, _ in requests:
+        if entry_id:
+            refs.setdefault(entry_id, entry_ref(employee_id, entry_id))
+    recorded = {}
+    if refs:
+        for snapshot in get_firestore_client().get_all(list(refs.values()), transaction=transaction):
+            if snapshot.exists:
+                recorded[snapshot.id] = recorded_outcome(snapshot)
+
+    balances = {}
+    for _, employee_id, _ in requests:
+        if employee_id not in balances:
+            balances[employee_id] = read_balance(employee_id, transaction=transaction)[1]
+    for entry_id, (applied, balance) in list(recorded.items()):
+        if balance is None:
+            recorded[entry_id] = (applied, balances[refs[entry_id].parent.parent.id])
+
+    results = []
+    for entry_id, employee_id, hours in requests:
+        if entry_id in recorded:
+            results.append((recorded[entry_id][0], recorded[entry_id][1], True))
+            continue
+        applied = balances[employee_id] >= hours
+        if applied:
+            balances[employee_id] -= hours
+        results.append((applied, balances[employee_id], False))
+        if entry_id:
+            recorded[entry_id] = (applied, balances[employee_id])
+        transaction.create(
+            refs.get(entry_id) or entry_ref(employee_id),
+            new_entry("deduction", delta=-hours if applied else 0, applied=applied, balance=balances[employee_id]),
+        )
+    return results
+
+
+def deduct_many(requests: List[Tuple[Optional[str], str, int]],
+                require_sufficient: bool = True) -> List[Tuple[bool, int, bool]]:
+    """
+    Deductions for (entry_id, employee_id, hours) requests in arrival order;
+    returns (applied, balance, duplicate) for each. Sufficient-balance checks
+    share one transaction per chunk; unconditional deductions are plain
+    batched appends.
+    """
+    requests = [(entry_id, str(employee_id), hours) for entry_id, employee_id, hours in requests]
+    if require_sufficient:
+        results = []
+        for start in range(0, len(requests), MAX_BATCH_WRITES):
+            with firestore_call("ledger_transaction", "firestore_write"):
+                results.extend(_deduct_many_in_transaction(
+                    get_firestore_client().transaction(), requests[start:start + MAX_BATCH_WRITES]
+                ))
+        return results
+
+    recorded = set(existing_entries(requests))
+    items = []
+    duplicate = []
+    for entry_id, employee_id, hours in requests:
+        duplicate.append(entry_id in recorded)
+        if entry_id not in recorded:
+            if entry_id:
+                recorded.add(entry_id)
+            items.append((employee_id, entry_id, new_entry("deduction", delta=-hours)))
+    balances = append_entries(items) if items else {}
+    for _, employee_id, _ in requests:
+        if employee_id not in balances:
+            with firestore_call("ledger_read", "firestore_read"):
+                balances[employee_id] = read_balance(employee_id)[1]
+    return [
+        (True, balances[employee_id], is_duplicate)
+        for (_, employee_id, _), is_duplicate in zip(requests, duplicate)
+    ]
+
+
+def delete(employee_id: str):
+    """Delete the snapshot and every entry, so the balance cannot reappear."""
+    entries = snapshot_ref(employee_id).collection(ENTRIES)
+    with firestore_call("ledger_delete", "firestore_write"):
+        while True:
+            docs = list(entries.select([]).limit(MAX_BATCH_WRITES).stream())
+            if not docs:
+                break
+            batch = get_firestore_client().batch()
+            for doc in docs:
+                batch.delete(doc.reference)
+            batch.commit()
+        snapshot_ref(employee_id).delete()
+
+
+@firestore.transactional
+def _compact_in_transaction(transaction, employee_id: str) -> Tuple[int, int]:
+    ref = snapshot_ref(employee_id)
+    snapshot = ref.get(transaction=transaction)
+    data = (snapshot.to_dict() or {}) if snapshot.exists else {}
+    docs = list(_tail_query(employee_id, data.get("snapshot_at")).stream(transaction=transaction))
+    if not docs:
+        return 0, data.get("balance", 0)
+    balance = fold(data.get("balance", 0), [doc.to_dict() for doc in docs])
+    transaction.set(ref, {
+        "balance": balance,
+        "snapshot_at": docs[-1].get("created_at"),
+        "snapshot_entries": firestore.Increment(len(docs)),
+    }, merge=True)
+    return len(docs), balance
+
+
+def compact(employee_id: str) -> Tuple[int, int]:
+    """Fold the entries after the snapshot into it; returns (entries folded, balance)."""
+    with firestore_call("ledger_compact", "firestore_write"):
+        return _compact_in_transaction(get_firestore_client().transaction(), str(employee_id))
+
+
+class LedgerCompactor:
+    """
+    Every interval, finds employees with entries written since the previous
+    pass and folds those entries into their snapshots. Compaction is
+    transactional and repeatable, so several pods may run it at once.
+    """
+
+    def __init__(self, interval: float = COMPACT_INTERVAL_SECONDS, lookback: float = COMPACT_LOOKBACK_SECONDS):
+        self.interval = interval
+        self.watermark = datetime.now(timezone.utc) - timedelta(seconds=lookback)
+        self.passes = 0
+        self.employees = 0
+        self.entries_folded = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def run_once(self) -> int:
+        # Anything committed after this instant is picked up by the next pass.
+        started = datetime.now(timezone.utc)
+        query = get_firestore_client().collection_group(ENTRIES).where("created_at", ">", self.watermark)
+        with firestore_call("ledger_scan", "firestore_read"):
+            employees = {doc.reference.parent.parent.id for doc in query.select([]).stream()}
+        folded = 0
+        for employee_id in employees:
+            folded += compact(employee_id)[0]
+        self.watermark = started
+        self.passes += 1
+        self.employees += len(employees)
+        self.entries_folded += folded
+        return folded
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            started = time.monotonic()
+            try:
+                folded = self.run_once()
+                if folded:
+                    logger.info(f"Ledger compaction folded {folded} entries in {time.monotonic() - started:.2f}s.")
+            except Exception:
+                logger.exception("Ledger compaction pass failed; retrying next interval.")
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="ledger-compactor", daemon=True)
+        self._thread.start()
+        logger.info(f"Ledger compactor running every {self.interval:.0f}s.")
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def stats(self) -> dict:
+        return {"passes": self.passes, "employees": self.employees, "entries_folded": self.entries_folded}
@@ -0,0 +1,196 @@
+"""
+Optional in-memory mirror of the whole pto collection, kept current by a
+Firestore on_snapshot listener (see pto_update.watch), so lookups and bulk
+responses are served without reads.
+
+Whole-number balances live in one array of 64-bit integers, indexed through
+a single employee_id -> slot dict, instead of an object or dict per record.
+The few that are not (fractional hours, or values too large for int64) are
+kept exactly as stored in a side dict that overrides their slot. Slots
+freed by deletions are reused. Writes made by this process are applied at
+once through the PTO change listeners; everything else arrives through the
+listener.
+
+The mirror is ready only while its listener stream is up and has delivered
+the full collection. If the stream dies it stops answering until a new
+subscription has resynced it. Only employees present in the mirror are
+answered from it. A miss falls back to a read, so a record created moments
+ago by another pod is never mistaken for a missing one. The mirror is not
+used in ledger mode, where pto documents are compacted snapshots that lag
+the ledger.
+"""
+import os
+import time
+import logging
+import threading
+from array import array
+from typing import Iterable, List, Optional, Tuple
+
+from pto_update import ledger
+from pto_update.models import PTO
+from pto_update.watch import PTOWatch
+from utils.metrics import MIRROR_LAST_UPDATE, MIRROR_RECORDS
+
+logger = logging.getLogger(__name__)
+
+MIRROR_ENABLED = os.getenv("PTO_MIRROR_ENABLED", "False") == "True"
+
+INT64_MIN, INT64_MAX = -2 ** 63, 2 ** 63 - 1
+
+
+def _fits_array(balance) -> bool:
+    return type(balance) is int and INT64_MIN <= balance <= INT64_MAX
+
+
+class BalanceMirror:
+    __slots__ = ("_slots", "_balances", "_exact", "_free", "_lock", "_watch")
+
+    def __init__(self):
+        self._slots = {}
+        self._balances = array("q")
+        # employee_id -> balance for values the int64 array cannot hold exactly.
+        self._exact = {}
+        self._free = []
+        self._lock = threading.Lock()
+        self._watch = PTOWatch("Balance mirror", self.load, self.apply)
+
+    @property
+    def ready(self) -> bool:
+        """
+        True while the listener is up and has delivered the full collection.
+        A listener whose stream has died is resubscribed here.
+        """
+        return self._watch.ensure_running()
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def start(self):
+        self._watch.start()
+
+    def stop(self):
+        self._watch.stop()
+
+    def _set(self, employee_id: str, balance):
+        if _fits_array(balance):
+            self._exact.pop(employee_id, None)
+            stored = balance
+        else:
+            self._exact[employee_id] = balance
+            stored = 0
+        slot = self._slots.get(employee_id)
+        if slot is not None:
+            self._balances[slot] = stored
+        elif self._free:
+            slot = self._free.pop()
+            self._balances[slot] = stored
+            self._slots[employee_id] = slot
+        else:
+            self._slots[employee_id] = len(self._balances)
+            self._balances.append(stored)
+
+    def _remove(self, employee_id: str):
+        slot = self._slots.pop(employee_id, None)
+        if slot is not None:
+            self._free.append(slot)
+            self._exact.pop(employee_id, None)
+
+    def _value(self, employee_id: str, slot: int):
+        if employee_id in self._exact:
+            return self._exact[employee_id]
+        return self._balances[slot]
+
+    def _updated(self):
+        MIRROR_RECORDS.set(len(self._slots))
+        MIRROR_LAST_UPDATE.set(time.time())
+
+    def load(self, records: Iterable[Tuple[str, object]]):
+        """Replace the contents with a full snapshot of the collection."""
+        with self._lock:
+            self._slots = {}
+            self._balances = array("q")
+            self._exact = {}
+            self._free = []
+            for employee_id, balance in records:
+                self._set(employee_id, balance)
+            size = len(self._slots)
+            self._updated()
+        logger.info(f"Balance mirror loaded {size} records.")
+
+    def apply(self, employee_id: str, balance):
+        """Apply one changed record, from the listener or a PTO write; balance None means deleted."""
+        with self._lock:
+            if balance is None:
+                self._remove(employee_id)
+            else:
+                self._set(employee_id, balance)
+            self._updated()
+
+    def get(self, employee_id: str):
+        with self._lock:
+            slot = self._slots.get(employee_id)
+            return None if slot is None else self._value(employee_id, slot)
+
+    def records(self, prefix: Optional[str] = None) -> List[dict]:
+        """Every mirrored balance as pto_records entries, optionally only IDs starting with prefix."""
+        with self._lock:
+            return [
+                {"employee_id": employee_id, "pto_balance": self._value(employee_id, slot)}
+                for employee_id, slot in self._slots.items()
+                if not prefix or employee_id.startswith(prefix)
+            ]
+
+    def staleness(self) -> Optional[float]:
+        """
+        Seconds since the listener last delivered a snapshot, or None before
+        the first one. The listener only calls back on changes, so a quiet
+        collection ages too.
+        """
+        return self._watch.staleness()
+
+    def stats(self) -> dict:
+        staleness = self.staleness()
+        ready = self.ready
+        read_time = self._watch.last_read_time
+        with self._lock:
+            return {
+                "ready": ready,
+                "size": len(self._slots),
+                "free_slots": len(self._free),
+                "exact_values": len(self._exact),
+                "balance_bytes": self._balances.itemsize * len(self._balances),
+                "events": self._watch.events,
+                "restarts": self._watch.restarts,
+                "staleness_seconds": None if staleness is None else round(staleness, 3),
+                "read_time": read_time.isoformat() if read_time else None,
+            }
+
+
+balance_mirror = BalanceMirror() if MIRROR_ENABLED else None
+_start_lock = threading.Lock()
+_started = False
+
+
+def start_mirror() -> Optional[BalanceMirror]:
+    """Start this process's mirror if PTO_MIRROR_ENABLED; safe to call from every service."""
+    global _started
+    if balance_mirror is None:
+        return None
+    with _start_lock:
+        if _started:
+            return balance_mirror
+        if ledger.LEDGER_MODE:
+            logger.warning("PTO_MIRROR_ENABLED is ignored in ledger mode.")
+            return None
+        _started = True
+        PTO.add_change_listener(balance_mirror.apply)
+        PTO.attach_mirror(balance_mirror)
+        balance_mirror.start()
+    return balance_mirror
+
+
+def ready_mirror() -> Optional[BalanceMirror]:
+    """This process's mirror while it holds a live, full copy, else None."""
+    if balance_mirror is not None and _started and balance_mirror.ready:
+        return balance_mirror
+    return None
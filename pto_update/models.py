@@ -1,7 +1,244 @@
+import os
+import sys
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from google.api_core.exceptions import AlreadyExists
 from google.cloud import firestore
-from typing import Optional, List
+from typing import Optional, List, Tuple, Dict, Iterator
+
+from pto_update import ledger
+from utils.gcp_clients import get_firestore_client
+from utils.metrics import firestore_call
+
+# Firestore caps a single commit at 500 writes.
+MAX_BATCH_WRITES = 500
+
+# PTO.get_many reads IDs in chunks of GET_MANY_CHUNK_SIZE, up to
+# GET_MANY_WORKERS chunks at a time.
+GET_MANY_CHUNK_SIZE = int(os.getenv("PTO_GET_MANY_CHUNK_SIZE", "100"))
+GET_MANY_WORKERS = int(os.getenv("PTO_GET_MANY_WORKERS", "4"))
+
+# The balance cache only sees writes made by this process, so with several
+# replicas (or process mode) a lookup can return a balance up to the TTL old.
+# It is off by default; enable it only where that staleness is acceptable.
+PTO_CACHE_MAX_ENTRIES = int(os.getenv("PTO_CACHE_MAX_ENTRIES", "0"))
+PTO_CACHE_TTL_SECONDS = float(os.getenv("PTO_CACHE_TTL_SECONDS", "30"))
+
+
+class BalanceCache:
+    """
+    Bounded LRU of employee_id -> balance with a per-entry TTL. Writes made by
+    this process keep it current; the TTL bounds staleness from other pods.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0 and self.ttl_seconds > 0
+
+    def get(self, employee_id: str) -> Optional[int]:
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(employee_id)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self._entries[employee_id]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(employee_id)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, employee_id: str, balance: int):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._entries[employee_id] = (balance, time.monotonic() + self.ttl_seconds)
+            self._entries.move_to_end(employee_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, employee_id: str):
+        with self._lock:
+            self._entries.pop(employee_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+balance_cache = BalanceCache(PTO_CACHE_MAX_ENTRIES, PTO_CACHE_TTL_SECONDS)
+
+def _pto_collection():
+    return get_firestore_client().collection("pto")
+
+
+# Callables invoked as listener(employee_id, balance) after every write made
+# through this model; balance is None when the record was deleted.
+_change_listeners = []
+
+
+# In-memory mirror of the collection (see pto_update.mirror), once attached.
+_mirror = None
+
+
+def mirror_lookup(employee_ids: List[str]) -> Dict[str, int]:
+    """Balances the attached mirror holds for these employees; empty until it is ready."""
+    if _mirror is None or not _mirror.ready:
+        return {}
+    balances = {}
+    for employee_id in employee_ids:
+        balance = _mirror.get(employee_id)
+        if balance is not None:
+            balances[employee_id] = balance
+    return balances
+
+
+def record_write(employee_id: str, balance: Optional[int]):
+    if balance is None:
+        balance_cache.invalidate(employee_id)
+    else:
+        balance_cache.put(employee_id, balance)
+    for listener in _change_listeners:
+        listener(employee_id, balance)
+
+
+def id_prefix_range(prefix: str) -> Tuple[str, Optional[str]]:
+    """
+    (start_at, end_before) bounds covering every document ID that starts
+    with prefix. end_before is None when no ID sorts after them, i.e. the
+    prefix is made of the highest code point only.
+    """
+    stem = prefix.rstrip(chr(sys.maxunicode))
+    if not stem:
+        return prefix, None
+    following = ord(stem[-1]) + 1
+    if 0xD800 <= following <= 0xDFFF:
+        # Surrogates cannot occur in UTF-8 document IDs (or be sent in a query).
+        following = 0xE000
+    return prefix, stem[:-1] + chr(following)
+
+
+def _decode_number(value) -> int:
+    # Transform results come back as raw Firestore Value protos.
+    kind = type(value).pb(value).WhichOneof("value_type")
+    return getattr(value, kind) if kind in ("integer_value", "double_value") else 0
+
+
+def stored_balance(snapshot) -> int:
+    """A pto snapshot's balance; 0 when the document or its balance field is missing."""
+    if not snapshot.exists:
+        return 0
+    return (snapshot.to_dict() or {}).get("balance", 0)
+
+
+def plan_deduction(exists: bool, balance: int, hours: int) -> Tuple[bool, int, bool]:
+    """
+    (applied, resulting balance, write) for a sufficient-balance deduction
+    from a balance read in a transaction. write says whether the balance
+    document must be set: always when applied, and to create a zero record
+    when it did not exist.
+    """
+    applied = balance >= hours
+    if applied:
+        balance -= hours
+    return applied, balance, applied or not exists
+
+
+@firestore.transactional
+def _deduct_in_transaction(transaction, doc_ref, hours: int) -> Tuple[bool, int]:
+    snapshot = doc_ref.get(transaction=transaction)
+    applied, balance, write = plan_deduction(snapshot.exists, stored_balance(snapshot), hours)
+    if write:
+        transaction.set(doc_ref, {"balance": balance})
+    return applied, balance
+
+
+class BalanceChange:
+    """Net effect of a run of update/deduction operations on one balance."""
+
+    __slots__ = ("set_to", "delta")
+
+    def __init__(self):
+        self.set_to = None
+        self.delta = 0
+
+    def set(self, balance: int):
+        self.set_to = balance
+        self.delta = 0
+
+    def add(self, delta: int):
+        self.delta += delta
+
+
+def change_chunks(changes: Dict[str, BalanceChange],
+                  creates: Dict[str, List[Tuple[firestore.DocumentReference, dict]]]
+                  ) -> Iterator[List[Tuple[str, BalanceChange]]]:
+    """Split merged changes into commits of at most MAX_BATCH_WRITES writes, creates included."""
+    chunk = []
+    writes = 0
+    for employee_id, change in changes.items():
+        needed = 1 + len(creates.get(employee_id, ()))
+        if chunk and writes + needed > MAX_BATCH_WRITES:
+            yield chunk
+            chunk = []
+            writes = 0
+        chunk.append((employee_id, change))
+        writes += needed
+    if chunk:
+        yield chunk
+
+
+def add_change_writes(batch, collection, chunk, creates) -> List[int]:
+    """Add a chunk's writes to batch; returns the position of each balance write among the write results."""
+    result_index = []
+    position = 0
+    for employee_id, change in chunk:
+        doc_ref = collection.document(str(employee_id))
+        result_index.append(position)
+        position += 1 + len(creates.get(employee_id, ()))
+        if change.set_to is not None:
+            batch.set(doc_ref, {"balance": change.set_to + change.delta})
+        else:
+            batch.set(doc_ref, {"balance": firestore.Increment(change.delta)}, merge=True)
+        for create_ref, document in creates.get(employee_id, ()):
+            batch.create(create_ref, document)
+    return result_index
+
+
+def committed_balances(chunk, result_index: List[int], write_results) -> Dict[str, int]:
+    """Resulting balances of a committed chunk, recorded as this process's writes."""
+    balances = {}
+    for (employee_id, change), index in zip(chunk, result_index):
+        if change.set_to is not None:
+            balances[employee_id] = change.set_to + change.delta
+        else:
+            balances[employee_id] = _decode_number(write_results[index].transform_results[0])
+        record_write(str(employee_id), balances[employee_id])
+    return balances
 
-db = firestore.Client()
 
 class PTO:
     def __init__(self, employee_id: str, balance: int = 0):
@@ -21,23 +258,262 @@ class PTO:
         )
 
     def save(self):
-        doc_ref = db.collection("pto").document(self.employee_id)
-        doc_ref.set(self.to_dict())
+        if ledger.LEDGER_MODE:
+            ledger.set_balance(self.employee_id, self.balance)
+            record_write(self.employee_id, self.balance)
+            return
+        doc_ref = _pto_collection().document(self.employee_id)
+        with firestore_call("set", "firestore_write"):
+            doc_ref.set(self.to_dict())
+        record_write(self.employee_id, self.balance)
 
     @staticmethod
     def get_by_employee_id(employee_id: str) -> Optional["PTO"]:
-        doc = db.collection("pto").document(str(employee_id)).get()
+        employee_id = str(employee_id)
+        balance = mirror_lookup([employee_id]).get(employee_id)
+        if balance is None:
+            balance = balance_cache.get(employee_id)
+        if balance is not None:
+            return PTO(employee_id=employee_id, balance=balance)
+
+        if ledger.LEDGER_MODE:
+            balance = ledger.get_balance(employee_id)
+            if balance is None:
+                return None
+            balance_cache.put(employee_id, balance)
+            return PTO(employee_id=employee_id, balance=balance)
+
+        with firestore_call("get", "firestore_read"):
+            doc = _pto_collection().document(employee_id).get()
         if doc.exists:
-            return PTO.from_dict(doc.id, doc.to_dict())
+            pto = PTO.from_dict(doc.id, doc.to_dict())
+            balance_cache.put(pto.employee_id, pto.balance)
+            return pto
         return None
 
+    @staticmethod
+    def get_many(employee_ids: List[str]) -> Dict[str, Optional[int]]:
+        """
+        Balances for many employees: mirrored and cached ones first, the rest
+        with get_all reads of GET_MANY_CHUNK_SIZE IDs, several chunks in
+        parallel. Employees without a record map to None.
+        """
+        employee_ids = list(map(str, employee_ids))
+        balances = mirror_lookup(employee_ids)
+        missing = []
+        for employee_id in employee_ids:
+            if employee_id in balances:
+                continue
+            balances[employee_id] = balance_cache.get(employee_id)
+            if balances[employee_id] is None:
+                missing.append(employee_id)
+
+        def read_chunk(chunk: List[str]) -> List[Tuple[str, Optional[int]]]:
+            if ledger.LEDGER_MODE:
+                return [(employee_id, ledger.get_balance(employee_id)) for employee_id in chunk]
+            refs = [_pto_collection().document(employee_id) for employee_id in chunk]
+            with firestore_call("get_all", "firestore_read"):
+                snapshots = get_firestore_client().get_all(refs, field_paths=["balance"])
+                return [(snapshot.id, stored_balance(snapshot)) for snapshot in snapshots if snapshot.exists]
+
+        chunks = [missing[start:start + GET_MANY_CHUNK_SIZE] for start in range(0, len(missing), GET_MANY_CHUNK_SIZE)]
+        if len(chunks) > 1 and GET_MANY_WORKERS > 1:
+            with ThreadPoolExecutor(max_workers=min(GET_MANY_WORKERS, len(chunks))) as executor:
+                results = list(executor.map(read_chunk, chunks))
+        else:
+            results = [read_chunk(chunk) for chunk in chunks]
+        for chunk_results in results:
+            for employee_id, balance in chunk_results:
+                balances[employee_id] = balance
+                if balance is not None:
+                    balance_cache.put(employee_id, balance)
+        return balances
+
     @staticmethod
     def all() -> List["PTO"]:
-        docs = db.collection("pto").stream()
-        return [PTO.from_dict(doc.id, doc.to_dict()) for doc in docs]
+        with firestore_call("stream", "firestore_read"):
+            docs = _pto_collection().stream()
+            return [PTO.from_dict(doc.id, doc.to_dict()) for doc in docs]
+
+    @staticmethod
+    def iter_balances(page_size: int = 1000, start_after: Optional[str] = None,
+                      end_before: Optional[str] = None, start_at: Optional[str] = None
+                      ) -> Iterator[Tuple[str, int]]:
+        """
+        Yield (employee_id, balance) in document-ID order, reading one
+        cursor-paginated page of balance-only projections at a time. In
+        ledger mode these are snapshot balances, which lag the entries by up
+        to one compaction interval.
+        """
+        for employee_id, data in PTO.iter_documents(["balance"], page_size, start_after, end_before, start_at):
+            yield employee_id, data.get("balance", 0)
+
+    @staticmethod
+    def iter_documents(fields: List[str], page_size: int = 1000, start_after: Optional[str] = None,
+                       end_before: Optional[str] = None, start_at: Optional[str] = None
+                       ) -> Iterator[Tuple[str, dict]]:
+        """
+        Yield (employee_id, data) projected to fields, paginated as in
+        iter_balances. start_at includes the given ID where start_after skips it.
+        """
+        collection = _pto_collection()
+        # The document-ID field path (FieldPath.document_id()).
+        document_id = "__name__"
+        query = collection.select(fields).order_by(document_id).limit(page_size)
+        if end_before is not None:
+            query = query.end_before({document_id: collection.document(str(end_before))})
+
+        first_page = query
+        cursor = None
+        if start_after is not None:
+            cursor = {document_id: collection.document(str(start_after))}
+        elif start_at is not None:
+            first_page = query.start_at({document_id: collection.document(str(start_at))})
+        while True:
+            page = query.start_after(cursor) if cursor is not None else first_page
+            last = None
+            count = 0
+            for doc in page.stream():
+                last = doc
+                count += 1
+                yield doc.id, doc.to_dict() or {}
+            if count < page_size:
+                return
+            cursor = last
+
+    @staticmethod
+    def adjust_balance(employee_id: str, delta: int) -> int:
+        """
+        Atomically add delta (negative to deduct) to the stored balance with a
+        server-side increment and return the resulting balance. A missing
+        record is treated as a zero balance.
+        """
+        if ledger.LEDGER_MODE:
+            balance = ledger.adjust_balance(str(employee_id), delta)
+            record_write(str(employee_id), balance)
+            return balance
+        doc_ref = _pto_collection().document(str(employee_id))
+        with firestore_call("increment", "firestore_write"):
+            write_result = doc_ref.set({"balance": firestore.Increment(delta)}, merge=True)
+        balance = _decode_number(write_result.transform_results[0])
+        record_write(str(employee_id), balance)
+        return balance
+
+    @staticmethod
+    def deduct(employee_id: str, hours: int, require_sufficient: bool = False) -> Tuple[bool, int]:
+        """
+        Deduct hours from the employee's balance and return (applied, balance).
+
+        With require_sufficient the read and write run in one transaction so
+        concurrent deductions cannot overdraw the balance; a refused deduction
+        leaves the stored balance untouched (creating a zero record if needed).
+        """
+        if ledger.LEDGER_MODE:
+            applied, balance, _ = ledger.deduct(employee_id, hours, require_sufficient)
+            record_write(str(employee_id), balance)
+            return applied, balance
+        if not require_sufficient:
+            return True, PTO.adjust_balance(employee_id, -hours)
+        doc_ref = _pto_collection().document(str(employee_id))
+        with firestore_call("transaction", "firestore_write"):
+            applied, balance = _deduct_in_transaction(get_firestore_client().transaction(), doc_ref, hours)
+        record_write(str(employee_id), balance)
+        return applied, balance
+
+    @staticmethod
+    def create_many(employee_ids: List[str], balance: int = 0) -> List[str]:
+        """
+        Create a record at balance for each employee with batched create()s
+        and return the IDs created. A record that appeared after the caller
+        read it as missing is left as it is: the batch holding it fails with
+        AlreadyExists and its employees are created one at a time. In ledger
+        mode the created record is the snapshot, which folds any entries
+        already appended.
+        """
+        employee_ids = list(map(str, employee_ids))
+        created = []
+
+        def commit(chunk: List[str]):
+            batch = get_firestore_client().batch()
+            for employee_id in chunk:
+                batch.create(_pto_collection().document(employee_id), {"balance": balance})
+            with firestore_call("batch_commit", "firestore_write", expected=(AlreadyExists,)):
+                batch.commit()
+            for employee_id in chunk:
+                record_write(employee_id, balance)
+            created.extend(chunk)
+
+        for start in range(0, len(employee_ids), MAX_BATCH_WRITES):
+            chunk = employee_ids[start:start + MAX_BATCH_WRITES]
+            try:
+                commit(chunk)
+            except AlreadyExists:
+                for employee_id in chunk:
+                    try:
+                        commit([employee_id])
+                    except AlreadyExists:
+                        pass
+        return created
+
+    @staticmethod
+    def commit_changes(changes: Dict[str, BalanceChange],
+                       creates: Optional[Dict[str, List[Tuple[firestore.DocumentReference, dict]]]] = None
+                       ) -> Dict[str, int]:
+        """
+        Write merged per-employee changes with batched commits and return the
+        resulting balance for each employee. creates maps an employee_id to
+        extra documents that must be created in the same commit as that
+        employee's change; the commit fails if any of them already exists.
+        """
+        if ledger.LEDGER_MODE:
+            return PTO._append_changes(changes)
+        creates = creates or {}
+        balances = {}
+        for chunk in change_chunks(changes, creates):
+            batch = get_firestore_client().batch()
+            result_index = add_change_writes(batch, _pto_collection(), chunk, creates)
+            with firestore_call("batch_commit", "firestore_write"):
+                write_results = batch.commit()
+            balances.update(committed_balances(chunk, result_index, write_results))
+        return balances
+
+    @staticmethod
+    def _append_changes(changes: Dict[str, BalanceChange]) -> Dict[str, int]:
+        # Ledger mode: one entry per employee for the merged change.
+        items = []
+        for employee_id, change in changes.items():
+            if change.set_to is not None:
+                entry = ledger.new_entry("update", set_to=change.set_to + change.delta)
+            else:
+                entry = ledger.new_entry("accrual" if change.delta > 0 else "deduction", delta=change.delta)
+            items.append((str(employee_id), None, entry))
+        balances = ledger.append_entries(items)
+        for employee_id, balance in balances.items():
+            record_write(employee_id, balance)
+        return balances
+
+    @staticmethod
+    def add_change_listener(listener):
+        _change_listeners.append(listener)
+
+    @staticmethod
+    def attach_mirror(mirror):
+        """Answer reads from mirror (a pto_update.mirror.BalanceMirror) wherever it holds the record."""
+        global _mirror
+        _mirror = mirror
+
+    @staticmethod
+    def cache_stats() -> dict:
+        return balance_cache.stats()
 
     def delete(self):
-        db.collection("pto").document(self.employee_id).delete()
+        if ledger.LEDGER_MODE:
+            ledger.delete(self.employee_id)
+            record_write(self.employee_id, None)
+            return
+        with firestore_call("delete", "firestore_write"):
+            _pto_collection().document(self.employee_id).delete()
+        record_write(self.employee_id, None)
 
     def __str__(self):
         return f"PTO balance for employee {self.employee_id}: {self.balance} hours"
@@ -4,47 +4,79 @@ import logging
 import threading
 import signal
 
-from google.cloud import pubsub_v1
+from pto_update import ledger
+from pto_update.models import PTO, BalanceChange
 from utils.pto_update_manager import PTOUpdateManager
 from utils.dashboard_events import build_dashboard_payload
-from google.cloud import logging as cloud_logging
-
-# Google Cloud Logging setup
-cloud_log_client = cloud_logging.Client()
-cloud_log_client.setup_logging()
+from utils.batch_envelope import batch_payload, invalid_result, item_result, operations_of
+from utils.dashboard_publisher import get_dashboard_publisher
+from utils.subscriber_settings import subscribe_options
+from utils.micro_batch import MicroBatcher, MICRO_BATCH_ENABLED
+from utils.ordered_lanes import LaneDispatcher, ORDERED_LANES_ENABLED
+from utils.supervision import await_stream, restart_delay
+from utils.structured_logging import level_for, log_payload
+from utils import gcp_clients, metrics
 
 # Standard Python logging
 logger = logging.getLogger("pto_update_worker")
-logger.setLevel(logging.INFO)
+logger.setLevel(level_for("pto_update"))
 
 # GCP configuration
-project_id = "hopkinstimesheetproj"
 subscription_name = "pto_update_processing_sub"
-dashboard_topic = f"projects/{project_id}/topics/dashboard-queue"
 
-subscriber = pubsub_v1.SubscriberClient()
-publisher = pubsub_v1.PublisherClient()
-subscription_path = subscriber.subscription_path(project_id, subscription_name)
+dashboard_publisher = get_dashboard_publisher()
+subscription_path = gcp_clients.subscription_path(subscription_name)
 
 # Shutdown event
 shutdown_event = threading.Event()
+streaming_pull_future = None
 
 def signal_handler(sig, frame):
     logger.info("Received shutdown signal. Preparing to exit...")
     shutdown_event.set()
+    if streaming_pull_future is not None:
+        streaming_pull_future.cancel()
+
+@metrics.timed_stage("decode")
+def decode_message(message):
+    raw_data = message.data.decode("utf-8")
+    log_payload(logger, "pto_update", raw_data)
+
+    update_data = json.loads(raw_data)
+    if isinstance(update_data, str):
+        update_data = json.loads(update_data)
+    return update_data
+
+def update_fields(update_data):
+    return update_data['employee_id'], update_data['new_balance']
+
+def process_envelope(message, data, operations):
+    # Later updates for the same employee overwrite earlier ones.
+    changes = {}
+    results = []
+    for operation in operations:
+        try:
+            employee_id, new_balance = update_fields(operation)
+        except Exception as e:
+            results.append(invalid_result(operation, e))
+            continue
+        changes.setdefault(str(employee_id), BalanceChange()).set(new_balance)
+        results.append(item_result(employee_id, "ok", new_balance))
+
+    if changes:
+        PTO.commit_changes(changes)
+    logger.info(f"[SUCCESS] Batch envelope: {len(operations)} PTO updates for {len(changes)} employees.")
+    dashboard_publisher.publish(batch_payload("pto_update", data, results), ack=message)
 
 def callback(message):
     try:
-        logger.info("Received new message on subscription.")
-        raw_data = message.data.decode("utf-8")
-        logger.info(f"Raw message received: {raw_data}")
-
-        update_data = json.loads(raw_data)
-        if isinstance(update_data, str):
-            update_data = json.loads(update_data)
-
-        employee_id = update_data['employee_id']
-        new_balance = update_data['new_balance']
+        logger.debug("Received new message on subscription.")
+        data = decode_message(message)
+        operations = operations_of(data)
+        if operations is not None:
+            process_envelope(message, data, operations)
+            return
+        employee_id, new_balance = update_fields(data)
 
         update_manager = PTOUpdateManager(employee_id, new_balance)
         result = update_manager.update_pto()
@@ -60,49 +92,117 @@ def callback(message):
             logger.error(msg)
             dashboard_payload = build_dashboard_payload(employee_id, "pto_updated", msg)
 
-        publisher.publish(dashboard_topic, json.dumps(dashboard_payload).encode("utf-8"))
-        logger.info("Published update to dashboard Pub/Sub topic.")
-        message.ack()
-        logger.info("Message acknowledged.")
+        dashboard_publisher.publish(dashboard_payload, ack=message)
+        logger.debug("Queued update to dashboard Pub/Sub topic; ack deferred until publish completes.")
 
     except Exception as e:
         logger.exception("Error processing message:")
         message.nack()
 
-def listen_for_messages():
+def process_batch(messages):
+    # Later updates for the same employee overwrite earlier ones.
+    changes = {}
+    parsed = []
+    for message in messages:
+        try:
+            data = decode_message(message)
+            operations = operations_of(data)
+            if operations is not None:
+                process_envelope(message, data, operations)
+                continue
+            employee_id, new_balance = update_fields(data)
+        except Exception:
+            logger.exception("Error processing message:")
+            message.nack()
+            continue
+        changes.setdefault(str(employee_id), BalanceChange()).set(new_balance)
+        parsed.append((message, employee_id))
+
+    if not parsed:
+        return
+
+    try:
+        PTO.commit_changes(changes)
+    except Exception:
+        logger.exception(f"Failed to commit batch of {len(parsed)} PTO updates:")
+        for message, _ in parsed:
+            message.nack()
+        return
+
+    logger.info(f"[SUCCESS] Committed {len(parsed)} PTO updates for {len(changes)} employees.")
+    for message, employee_id in parsed:
+        dashboard_payload = build_dashboard_payload(
+            employee_id, "refresh_data", "Time log created, please refresh dashboard data."
+        )
+        dashboard_publisher.publish(dashboard_payload, ack=message)
+
+def listen_for_messages(message_callback=callback):
+    global streaming_pull_future
     logger.info(f"Listening to Pub/Sub subscription: {subscription_path}")
     while not shutdown_event.is_set():
         try:
-            future = subscriber.subscribe(subscription_path, callback=callback)
+            streaming_pull_future = future = gcp_clients.get_subscriber_client().subscribe(
+                subscription_path, callback=metrics.instrument("pto_update", message_callback),
+                **subscribe_options("pto_update")
+            )
             logger.info("PTO Update worker is now actively listening for messages...")
-            future.result()
+            await_stream(future, "pto_update")
         except Exception as e:
-            logger.exception("Pub/Sub listener crashed. Restarting in 5 seconds...")
-            time.sleep(5)
+            if shutdown_event.is_set():
+                break
+            delay = restart_delay("pto_update")
+            logger.exception(f"Pub/Sub listener crashed. Restarting in {delay:.1f} seconds...")
+            shutdown_event.wait(delay)
 
 def run():
+    gcp_clients.setup_cloud_logging()
+
     if threading.current_thread() == threading.main_thread():
         signal.signal(signal.SIGINT, signal_handler)
         signal.signal(signal.SIGTERM, signal_handler)
 
     logger.info("Starting PTO Update microservice...")
 
+    compactor = None
+    if ledger.LEDGER_MODE:
+        compactor = ledger.LedgerCompactor()
+        compactor.start()
+
     def heartbeat():
         while not shutdown_event.is_set():
-            logger.info("Heartbeat: PTO Update microservice is alive")
+            if compactor:
+                logger.info(f"Heartbeat: PTO Update microservice is alive. Ledger compaction: {compactor.stats()}")
+            else:
+                logger.info("Heartbeat: PTO Update microservice is alive")
             time.sleep(300)
 
     threading.Thread(target=heartbeat, daemon=True).start()
 
+    batcher = None
+    message_callback = callback
+    if MICRO_BATCH_ENABLED:
+        batcher = MicroBatcher("pto_update", process_batch)
+        batcher.start()
+        message_callback = batcher.submit
+    elif ORDERED_LANES_ENABLED:
+        batcher = LaneDispatcher("pto_update", callback)
+        batcher.start()
+        message_callback = batcher.submit
+
     try:
-        listen_for_messages()
+        listen_for_messages(message_callback)
     except Exception as e:
         logger.exception("Unhandled exception in run()")
     finally:
-        try:
-            subscriber.close()
-            logger.info("Subscriber client closed.")
-        except Exception as e:
-            logger.warning("Failed to close subscriber cleanly: %s", e)
+        if batcher:
+            batcher.stop()
+        if compactor:
+            compactor.stop()
+        # The subscriber client is shared; only this service's stream is cancelled here.
+        if streaming_pull_future is not None:
+            streaming_pull_future.cancel()
+            logger.info("Subscriber stream cancelled.")
+        # Publish refresh_data events the coalescer is still holding back.
+        dashboard_publisher.flush()
 
         logger.info("PTO Update microservice shut down.")
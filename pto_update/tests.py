@@ -1,3 +1,783 @@
-from django.test import TestCase
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase
+from google.api_core.exceptions import AlreadyExists, ServiceUnavailable
+from google.cloud import firestore
+from google.cloud.firestore_v1.types import Value
+
+from pto_update import accrual, idempotency, ledger, models
+from pto_update.bulk_import import validate_row
+from pto_update.export import ParquetPartitionWriter
+from pto_update.mirror import BalanceMirror
+from pto_update.models import BalanceCache
+from pto_update.watch import PTOWatch
+
+
+class BalanceCacheTests(SimpleTestCase):
+    def test_disabled_without_entries_or_ttl(self):
+        for cache in (BalanceCache(0, 30), BalanceCache(10, 0)):
+            cache.put("E1", 40)
+            self.assertFalse(cache.enabled)
+            self.assertIsNone(cache.get("E1"))
+
+    def test_put_and_get(self):
+        cache = BalanceCache(10, 30)
+        cache.put("E1", 40)
+        self.assertEqual(cache.get("E1"), 40)
+        self.assertEqual(cache.stats()["hits"], 1)
+
+    def test_entries_expire_after_ttl(self):
+        cache = BalanceCache(10, 0.01)
+        cache.put("E1", 40)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get("E1"))
+        self.assertEqual(cache.stats()["size"], 0)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = BalanceCache(2, 30)
+        cache.put("E1", 1)
+        cache.put("E2", 2)
+        cache.get("E1")
+        cache.put("E3", 3)
+        self.assertIsNone(cache.get("E2"))
+        self.assertEqual(cache.get("E1"), 1)
+        self.assertEqual(cache.get("E3"), 3)
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_invalidate_and_clear(self):
+        cache = BalanceCache(10, 30)
+        cache.put("E1", 1)
+        cache.put("E2", 2)
+        cache.invalidate("E1")
+        self.assertIsNone(cache.get("E1"))
+        cache.clear()
+        self.assertIsNone(cache.get("E2"))
+
+
+class FakeDocument:
+    def __init__(self, employee_id, data):
+        self.id = employee_id
+        self._data = data
+
+    def to_dict(self):
+        return self._data
+
+
+class FakeChange:
+    def __init__(self, kind, document):
+        self.type = mock.Mock()
+        self.type.name = kind
+        self.document = document
+
+
+class FakeWatch:
+    def __init__(self, callback):
+        self.callback = callback
+        self.is_active = True
+        self.unsubscribed = False
+
+    def unsubscribe(self):
+        self.unsubscribed = True
+        self.is_active = False
+
+
+class FakeListenerTestCase(SimpleTestCase):
+    """Routes pto on_snapshot subscriptions to FakeWatch objects in self.watches."""
+
+    def setUp(self):
+        self.watches = []
+        client = mock.Mock()
+
+        def on_snapshot(callback):
+            self.watches.append(FakeWatch(callback))
+            return self.watches[-1]
+
+        client.collection.return_value.on_snapshot.side_effect = on_snapshot
+        patcher = mock.patch("pto_update.watch.get_firestore_client", return_value=client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def deliver(self, documents, changes):
+        self.watches[-1].callback(documents, changes, None)
+
+
+class PTOWatchTests(FakeListenerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.resets = []
+        self.changes = []
+        self.watch = PTOWatch("test", self.resets.append, lambda *change: self.changes.append(change))
+
+    def test_first_snapshot_resets_and_later_ones_are_changes(self):
+        self.watch.start()
+        self.assertFalse(self.watch.healthy())
+        self.deliver([FakeDocument("E1", {"balance": 10}), FakeDocument("E2", {"balance": 7.5})], [])
+        self.assertEqual(self.resets, [[("E1", 10), ("E2", 7.5)]])
+        self.assertTrue(self.watch.healthy())
+
+        self.deliver([], [
+            FakeChange("MODIFIED", FakeDocument("E1", {"balance": 12})),
+            FakeChange("REMOVED", FakeDocument("E2", None)),
+        ])
+        self.assertEqual(self.changes, [("E1", 12), ("E2", None)])
+
+    def test_dead_stream_is_unhealthy_and_resubscribes_with_a_fresh_reset(self):
+        self.watch.start()
+        self.deliver([FakeDocument("E1", {"balance": 10})], [])
+        self.watches[-1].is_active = False
+        self.assertFalse(self.watch.healthy())
+
+        self.assertFalse(self.watch.ensure_running())
+        self.assertEqual(len(self.watches), 2)
+        self.assertTrue(self.watches[0].unsubscribed)
+        self.deliver([FakeDocument("E1", {"balance": 11})], [])
+        self.assertEqual(self.resets[-1], [("E1", 11)])
+        self.assertTrue(self.watch.ensure_running())
+
+    def test_failed_callback_marks_the_watch_unhealthy(self):
+        self.watch.on_reset = mock.Mock(side_effect=RuntimeError("boom"))
+        self.watch.start()
+        with self.assertLogs("pto_update.watch", "ERROR"):
+            self.deliver([FakeDocument("E1", {"balance": 10})], [])
+        self.assertFalse(self.watch.healthy())
+
+
+class BalanceMirrorTests(FakeListenerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.mirror = BalanceMirror()
+        self.mirror.start()
+
+    def test_balances_are_kept_exactly(self):
+        self.deliver([
+            FakeDocument("E1", {"balance": 10}),
+            FakeDocument("E2", {"balance": 7.5}),
+            FakeDocument("E3", {"balance": 2 ** 70}),
+        ], [])
+        self.assertEqual(self.mirror.get("E1"), 10)
+        self.assertEqual(self.mirror.get("E2"), 7.5)
+        self.assertEqual(self.mirror.get("E3"), 2 ** 70)
+        self.deliver([], [FakeChange("MODIFIED", FakeDocument("E2", {"balance": 8}))])
+        self.mirror.apply("E1", 0.25)
+        self.assertEqual(self.mirror.get("E2"), 8)
+        self.assertEqual(self.mirror.get("E1"), 0.25)
+        self.assertEqual(
+            sorted((record["employee_id"], record["pto_balance"]) for record in self.mirror.records("E")),
+            [("E1", 0.25), ("E2", 8), ("E3", 2 ** 70)],
+        )
+
+    def test_removed_slots_are_reused(self):
+        self.deliver([FakeDocument("E1", {"balance": 1.5}), FakeDocument("E2", {"balance": 2})], [])
+        self.deliver([], [FakeChange("REMOVED", FakeDocument("E1", None))])
+        self.assertIsNone(self.mirror.get("E1"))
+        self.mirror.apply("E9", 3)
+        self.assertEqual(self.mirror.stats()["free_slots"], 0)
+        self.assertEqual(self.mirror.get("E9"), 3)
+
+    def test_ready_only_while_the_listener_is_live_and_synced(self):
+        self.assertFalse(self.mirror.ready)
+        self.deliver([FakeDocument("E1", {"balance": 10})], [])
+        self.assertTrue(self.mirror.ready)
+
+        self.watches[-1].is_active = False
+        self.assertFalse(self.mirror.ready)
+        self.assertEqual(len(self.watches), 2)
+        # The new subscription's first snapshot replaces the old contents.
+        self.deliver([FakeDocument("E2", {"balance": 5})], [])
+        self.assertTrue(self.mirror.ready)
+        self.assertIsNone(self.mirror.get("E1"))
+        self.assertEqual(self.mirror.get("E2"), 5)
+
+    def test_stop_clears_ready(self):
+        self.deliver([FakeDocument("E1", {"balance": 10})], [])
+        self.mirror.stop()
+        self.assertFalse(self.mirror.ready)
+
+
+class LedgerFoldTests(SimpleTestCase):
+    def test_deltas_add_to_the_snapshot_balance(self):
+        self.assertEqual(ledger.fold(10, [{"delta": 5}, {"delta": -3}]), 12)
+
+    def test_update_entries_reset_the_balance(self):
+        self.assertEqual(ledger.fold(10, [{"delta": 5}, {"set_to": 40}, {"delta": -8}]), 32)
+
+    def test_refused_deductions_and_sparse_entries_change_nothing(self):
+        refused = ledger.new_entry("deduction", delta=0, applied=False, balance=10)
+        self.assertEqual(ledger.fold(10, [refused, {}, None, {"set_to": None, "delta": 2}]), 12)
+
+    def test_recorded_outcome_without_a_balance_field(self):
+        applied, balance = ledger.recorded_outcome(FakeDocument("e1", {"kind": "deduction", "delta": -4}))
+        self.assertTrue(applied)
+        self.assertIsNone(balance)
+        self.assertEqual(
+            ledger.recorded_outcome(FakeDocument("e1", {"applied": False, "balance": 3})), (False, 3)
+        )
+        self.assertEqual(ledger.recorded_outcome(FakeDocument("e1", None)), (True, None))
+
+    def test_tail_is_ordered_by_created_at_then_document_id(self):
+        query = mock.Mock()
+        collection = mock.Mock()
+        collection.order_by.return_value = query
+        query.order_by.return_value = query
+        with mock.patch.object(ledger, "snapshot_ref") as snapshot_ref:
+            snapshot_ref.return_value.collection.return_value = collection
+            ledger._tail_query("7", snapshot_at="t")
+        collection.order_by.assert_called_once_with("created_at")
+        query.order_by.assert_called_once_with("__name__")
+        query.where.assert_called_once_with("created_at", ">", "t")
+
+
+class AccrualRulesTests(SimpleTestCase):
+    def setUp(self):
+        self.rules = accrual.AccrualRules.from_dict({
+            "default_hours": 4,
+            "max_balance": 240,
+            "rules": [
+                {"employee_ids": ["E100", "C7"], "hours": 6},
+                {"prefix": "C", "hours": 0},
+            ],
+        })
+
+    def test_first_matching_rule_wins(self):
+        self.assertEqual(self.rules.hours_for("E100", 0), 6)
+        self.assertEqual(self.rules.hours_for("C7", 0), 6)
+        self.assertEqual(self.rules.hours_for("C8", 0), 0)
+        self.assertEqual(self.rules.hours_for("E200", 0), 4)
+
+    def test_accrual_stops_at_max_balance(self):
+        self.assertEqual(self.rules.hours_for("E100", 237), 3)
+        self.assertEqual(self.rules.hours_for("E100", 240), 0)
+        self.assertEqual(self.rules.hours_for("E100", 300), 0)
+
+    def test_no_cap_without_max_balance(self):
+        self.assertEqual(accrual.AccrualRules(8).hours_for("E1", 10 ** 6), 8)
+
+
+class FakeRef:
+    def __init__(self, path):
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    def collection(self, name):
+        return FakeRef(f"{self.path}/{name}")
+
+    def document(self, name):
+        return FakeRef(f"{self.path}/{name}")
+
+    def get(self):
+        return mock.Mock(exists=False)
+
+    def set(self, data, merge=False):
+        pass
+
+
+class FakeFirestore:
+    """Batches that fail as a whole when one of their create() targets exists."""
+
+    def __init__(self, existing=(), unavailable=0):
+        self.existing = set(existing)
+        self.unavailable = unavailable
+        self.increments = {}
+        self.commits = 0
+
+    def collection(self, name):
+        return FakeRef(name)
+
+    def batch(self):
+        return FakeBatch(self)
+
+
+class FakeBatch:
+    def __init__(self, db):
+        self.db = db
+        self.creates = []
+        self.sets = []
+
+    def create(self, ref, data):
+        self.creates.append(ref.path)
+
+    def set(self, ref, data, merge=False):
+        self.sets.append((ref.id, data["balance"].value))
+
+    def commit(self):
+        self.db.commits += 1
+        if self.db.unavailable:
+            self.db.unavailable -= 1
+            raise ServiceUnavailable("try again")
+        if any(path in self.db.existing for path in self.creates):
+            raise AlreadyExists("marker exists")
+        self.db.existing.update(self.creates)
+        for employee_id, hours in self.sets:
+            self.db.increments[employee_id] = self.db.increments.get(employee_id, 0) + hours
+
+
+class AccrualCommitTests(SimpleTestCase):
+    def run_commit(self, db, accruals):
+        run = accrual.AccrualRun("2026-10-15", accrual.AccrualRules(4))
+        with mock.patch.object(accrual, "get_firestore_client", return_value=db), \
+                mock.patch.object(accrual.ledger, "LEDGER_MODE", False), \
+                mock.patch.object(accrual, "backoff_delay", return_value=0):
+            run._commit(accruals)
+        return run
+
+    def test_increment_and_marker_commit_together(self):
+        db = FakeFirestore()
+        run = self.run_commit(db, [("E1", 4), ("E2", 6)])
+        self.assertEqual(db.increments, {"E1": 4, "E2": 6})
+        self.assertIn("pto_accrual_runs/2026-10-15/employees/E1", db.existing)
+        self.assertEqual((run.accrued, run.hours, run.already_applied), (2, 10, 0))
+
+    def test_already_applied_employees_are_skipped_and_counted_separately(self):
+        db = FakeFirestore(existing={"pto_accrual_runs/2026-10-15/employees/E1"})
+        run = self.run_commit(db, [("E1", 4), ("E2", 4)])
+        self.assertEqual(db.increments, {"E2": 4})
+        self.assertEqual((run.accrued, run.hours, run.already_applied), (1, 4, 1))
+
+    def test_retry_after_a_lost_commit_never_applies_twice(self):
+        db = FakeFirestore()
+        run = self.run_commit(db, [("E1", 4)])
+        self.run_commit(db, [("E1", 4)])
+        self.assertEqual(db.increments, {"E1": 4})
+        self.assertEqual(run.accrued, 1)
+
+    def test_transient_errors_are_retried(self):
+        db = FakeFirestore(unavailable=2)
+        run = self.run_commit(db, [("E1", 4)])
+        self.assertEqual(db.increments, {"E1": 4})
+        self.assertEqual((run.accrued, run.failed, db.commits), (1, 0, 3))
+
+    def test_persistent_errors_count_as_failed(self):
+        db = FakeFirestore(unavailable=accrual.MAX_WRITE_ATTEMPTS)
+        run = self.run_commit(db, [("E1", 4), ("E2", 4)])
+        self.assertEqual(db.increments, {})
+        self.assertEqual((run.accrued, run.failed), (0, 2))
+
+    def test_ledger_mode_caps_against_the_folded_balance(self):
+        run = accrual.AccrualRun("2026-10-15", accrual.AccrualRules(8, max_balance=100))
+        with mock.patch.object(accrual.ledger, "LEDGER_MODE", True), \
+                mock.patch.object(accrual.ledger, "read_balance", return_value=(True, 96)):
+            self.assertEqual(run.balance_for("E1", {"balance": 50}), 96)
+
+    def test_run_accrues_each_due_employee_once(self):
+        db = FakeFirestore()
+        documents = [
+            ("E1", {"balance": 10}),
+            ("E2", {"balance": 10, "last_accrual_period": "2026-10-15"}),
+            ("E3", {"balance": 99}),
+            ("E4", {"balance": 0}),
+        ]
+        run = accrual.AccrualRun(
+            "2026-10-15", accrual.AccrualRules(4, max_balance=100), checkpoint_every=1, workers=2,
+            report=lambda line: None,
+        )
+        with mock.patch.object(accrual, "get_firestore_client", return_value=db), \
+                mock.patch.object(accrual.ledger, "LEDGER_MODE", False), \
+                mock.patch.object(accrual, "EMPLOYEES_PER_COMMIT", 1), \
+                mock.patch.object(accrual.PTO, "iter_documents", return_value=iter(documents)):
+            summary = run.run()
+        self.assertEqual(db.increments, {"E1": 4, "E3": 1, "E4": 4})
+        self.assertEqual(
+            {key: summary[key] for key in ("scanned", "skipped", "accrued", "hours", "failed")},
+            {"scanned": 4, "skipped": 1, "accrued": 3, "hours": 9, "failed": 0},
+        )
+
+
+class FakeQuery:
+    """A cursor-paginated query over sorted document IDs; every stream() is logged."""
+
+    def __init__(self, ids, log, limit=None, start=None, end_before=None):
+        self.ids = ids
+        self.log = log
+        self._limit = limit
+        self._start = start
+        self._end_before = end_before
+
+    def _with(self, **changes):
+        state = {"limit": self._limit, "start": self._start, "end_before": self._end_before}
+        state.update(changes)
+        return FakeQuery(self.ids, self.log, **state)
+
+    @staticmethod
+    def _id(cursor):
+        return cursor["__name__"].id if isinstance(cursor, dict) else cursor.id
+
+    def select(self, fields):
+        return self
+
+    def order_by(self, field):
+        assert field == "__name__"
+        return self
+
+    def limit(self, count):
+        return self._with(limit=count)
+
+    def start_after(self, cursor):
+        return self._with(start=(self._id(cursor), False))
+
+    def start_at(self, cursor):
+        return self._with(start=(self._id(cursor), True))
+
+    def end_before(self, cursor):
+        return self._with(end_before=self._id(cursor))
+
+    def stream(self):
+        ids = self.ids
+        if self._start is not None:
+            start, inclusive = self._start
+            ids = [id for id in ids if id > start or (inclusive and id == start)]
+        if self._end_before is not None:
+            ids = [id for id in ids if id < self._end_before]
+        ids = ids[:self._limit]
+        self.log.append(ids)
+        return [FakeDocument(id, {"balance": len(id)}) for id in ids]
+
+
+class IdPrefixRangeTests(SimpleTestCase):
+    def covers(self, prefix, employee_id):
+        start_at, end_before = models.id_prefix_range(prefix)
+        return start_at <= employee_id and (end_before is None or employee_id < end_before)
+
+    def test_upper_bound_increments_the_last_character(self):
+        self.assertEqual(models.id_prefix_range("E1"), ("E1", "E2"))
+        self.assertTrue(self.covers("E1", "E1"))
+        self.assertTrue(self.covers("E1", "E19999"))
+        self.assertFalse(self.covers("E1", "E2"))
+        self.assertFalse(self.covers("E1", "E0"))
+
+    def test_trailing_max_code_points_carry_into_the_previous_character(self):
+        top = chr(sys.maxunicode)
+        self.assertEqual(models.id_prefix_range("E" + top), ("E" + top, "F"))
+        self.assertEqual(models.id_prefix_range("E" + top + top), ("E" + top + top, "F"))
+        self.assertTrue(self.covers("E" + top, "E" + top + "x"))
+        self.assertFalse(self.covers("E" + top, "F"))
+
+    def test_prefix_of_only_max_code_points_has_no_upper_bound(self):
+        top = chr(sys.maxunicode)
+        self.assertEqual(models.id_prefix_range(top), (top, None))
+        self.assertTrue(self.covers(top, top + "anything"))
+
+    def test_upper_bound_skips_the_surrogate_range(self):
+        self.assertEqual(models.id_prefix_range("\ud7ff"), ("\ud7ff", "\ue000"))
+
+
+class IterDocumentsTests(SimpleTestCase):
+    def scan(self, ids, **kwargs):
+        log = []
+        collection = mock.Mock()
+        collection.select.return_value = FakeQuery(sorted(ids), log)
+        collection.document.side_effect = lambda id: mock.Mock(id=id)
+        with mock.patch.object(models, "_pto_collection", return_value=collection):
+            documents = list(models.PTO.iter_documents(["balance"], page_size=2, **kwargs))
+        return [employee_id for employee_id, _ in documents], log
+
+    def test_pages_follow_the_cursor_across_page_boundaries(self):
+        ids, pages = self.scan(["E1", "E2", "E3", "E4", "E5"])
+        self.assertEqual(ids, ["E1", "E2", "E3", "E4", "E5"])
+        self.assertEqual(pages, [["E1", "E2"], ["E3", "E4"], ["E5"]])
+
+    def test_a_full_last_page_costs_one_empty_read(self):
+        ids, pages = self.scan(["E1", "E2", "E3", "E4"])
+        self.assertEqual(ids, ["E1", "E2", "E3", "E4"])
+        self.assertEqual(pages[-1], [])
+
+    def test_start_after_skips_and_start_at_includes_the_id(self):
+        self.assertEqual(self.scan(["E1", "E2", "E3"], start_after="E1")[0], ["E2", "E3"])
+        self.assertEqual(self.scan(["E1", "E2", "E3"], start_at="E2")[0], ["E2", "E3"])
+
+    def test_end_before_bounds_every_page(self):
+        ids, pages = self.scan(["A1", "B1", "B2", "B3", "C1"], start_at="B", end_before="C")
+        self.assertEqual(ids, ["B1", "B2", "B3"])
+        self.assertEqual(pages, [["B1", "B2"], ["B3"]])
+
+    def test_iter_balances_defaults_a_missing_balance_to_zero(self):
+        with mock.patch.object(models.PTO, "iter_documents", return_value=iter([("E1", {}), ("E2", {"balance": 4})])):
+            self.assertEqual(list(models.PTO.iter_balances()), [("E1", 0), ("E2", 4)])
+
+
+class IncrementResultTests(SimpleTestCase):
+    def adjust(self, transform_result, delta=-4):
+        doc_ref = mock.Mock()
+        doc_ref.set.return_value = mock.Mock(transform_results=[transform_result])
+        db = mock.Mock()
+        db.collection.return_value.document.return_value = doc_ref
+        with mock.patch.object(models, "get_firestore_client", return_value=db), \
+                mock.patch.object(models.ledger, "LEDGER_MODE", False), \
+                mock.patch.object(models, "record_write") as record_write:
+            balance = models.PTO.adjust_balance("E1", delta)
+        increment = doc_ref.set.call_args[0][0]["balance"]
+        self.assertEqual(increment.value, delta)
+        return balance, record_write
+
+    def test_integer_result_is_returned_and_recorded(self):
+        balance, record_write = self.adjust(Value(integer_value=36))
+        self.assertEqual(balance, 36)
+        self.assertIsInstance(balance, int)
+        record_write.assert_called_once_with("E1", 36)
+
+    def test_double_result_is_returned_and_recorded(self):
+        balance, record_write = self.adjust(Value(double_value=35.5))
+        self.assertEqual(balance, 35.5)
+        record_write.assert_called_once_with("E1", 35.5)
+
+    def test_non_numeric_result_decodes_as_zero(self):
+        self.assertEqual(models._decode_number(Value(null_value=0)), 0)
+        self.assertEqual(models._decode_number(Value(string_value="40")), 0)
+
+    def test_unconditional_deduct_uses_the_increment(self):
+        with mock.patch.object(models.ledger, "LEDGER_MODE", False), \
+                mock.patch.object(models.PTO, "adjust_balance", return_value=6) as adjust_balance:
+            self.assertEqual(models.PTO.deduct("E1", 4), (True, 6))
+        adjust_balance.assert_called_once_with("E1", -4)
+
+    def test_sufficient_deduct_records_the_transaction_balance(self):
+        with mock.patch.object(models, "get_firestore_client"), \
+                mock.patch.object(models.ledger, "LEDGER_MODE", False), \
+                mock.patch.object(models, "_deduct_in_transaction", return_value=(False, 3)), \
+                mock.patch.object(models, "record_write") as record_write:
+            self.assertEqual(models.PTO.deduct("E1", 4, require_sufficient=True), (False, 3))
+        record_write.assert_called_once_with("E1", 3)
+
+    def test_plan_deduction_creates_a_zero_record_only_when_missing(self):
+        self.assertEqual(models.plan_deduction(True, 10, 4), (True, 6, True))
+        self.assertEqual(models.plan_deduction(True, 3, 4), (False, 3, False))
+        self.assertEqual(models.plan_deduction(False, 0, 4), (False, 0, True))
+
+
+ORIGINAL_DEDUCT_ONCE = idempotency._deduct_once_in_transaction
+ORIGINAL_DEDUCT_MANY_ONCE = idempotency._deduct_many_once_in_transaction
+
+
+class FirestoreDoc:
+    def __init__(self, ref, data):
+        self.id = ref.id
+        self.reference = ref
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+
+class FirestoreRef:
+    def __init__(self, db, collection, id):
+        self.db = db
+        self.id = id
+        self.parent = mock.Mock(id=collection)
+        self.key = (collection, id)
+
+    def get(self, transaction=None):
+        return FirestoreDoc(self, self.db.docs.get(self.key))
+
+
+class FirestoreWrites:
+    """A transaction or write batch over InMemoryFirestore; creates of existing documents fail."""
+
+    def __init__(self, db, atomic):
+        self.db = db
+        self.atomic = atomic
+        self.writes = []
+
+    def set(self, ref, data, merge=False):
+        self.writes.append(("set", ref, data))
+        if not self.atomic:
+            self._apply()
+
+    def create(self, ref, data):
+        self.writes.append(("create", ref, data))
+        if not self.atomic:
+            self._apply()
+
+    def _apply(self):
+        if any(kind == "create" and ref.key in self.db.docs for kind, ref, _ in self.writes):
+            raise AlreadyExists("document exists")
+        results = []
+        for kind, ref, data in self.writes:
+            transforms = []
+            if isinstance(data.get("balance"), firestore.Increment):
+                balance = (self.db.docs.get(ref.key) or {}).get("balance", 0) + data["balance"].value
+                data = dict(data, balance=balance)
+                transforms = [Value(integer_value=balance)]
+            self.db.docs[ref.key] = data
+            results.append(mock.Mock(transform_results=transforms))
+        self.writes = []
+        return results
+
+    def commit(self):
+        self.db.commits += 1
+        return self._apply()
+
+
+class InMemoryFirestore:
+    def __init__(self, docs=None):
+        self.docs = dict(docs or {})
+        self.commits = 0
+
+    def collection(self, name):
+        return mock.Mock(document=lambda id: FirestoreRef(self, name, id))
+
+    def get_all(self, refs, field_paths=None, transaction=None):
+        return [ref.get() for ref in refs]
+
+    def batch(self):
+        return FirestoreWrites(self, atomic=True)
+
+    def transaction(self):
+        # Transaction functions run unwrapped below, applying writes as they go.
+        return FirestoreWrites(self, atomic=False)
+
+
+class IdempotencyTests(SimpleTestCase):
+    def setUp(self):
+        self.db = InMemoryFirestore({("pto", "E1"): {"balance": 10}})
+        patches = [
+            mock.patch.object(idempotency, "recent_results", BalanceCache(100, 600)),
+            mock.patch.object(idempotency, "get_firestore_client", return_value=self.db),
+            mock.patch.object(models, "get_firestore_client", return_value=self.db),
+            mock.patch.object(ledger, "LEDGER_MODE", False),
+            # Run the transaction bodies directly against the in-memory store.
+            mock.patch.object(
+                idempotency, "_deduct_once_in_transaction",
+                lambda transaction, *args: ORIGINAL_DEDUCT_ONCE.to_wrap(transaction, *args),
+            ),
+            mock.patch.object(
+                idempotency, "_deduct_many_once_in_transaction",
+                lambda transaction, *args: ORIGINAL_DEDUCT_MANY_ONCE.to_wrap(transaction, *args),
+            ),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def balance(self):
+        return self.db.docs[("pto", "E1")]["balance"]
+
+    def record(self, key):
+        return self.db.docs.get((idempotency.LEDGER_COLLECTION, key))
+
+    def test_recently_seen_key_is_answered_without_firestore(self):
+        idempotency.remember("pto_usage:r1", True, 6)
+        with mock.patch.object(idempotency, "get_firestore_client", side_effect=AssertionError("read")):
+            self.assertEqual(idempotency.deduct_once("pto_usage:r1", "E1", 4, require_sufficient=True), (True, 6, True))
+            self.assertEqual(idempotency.deduct_many_once([("pto_usage:r1", "E1", 4)]), [(True, 6, True)])
+        self.assertEqual(self.balance(), 10)
+
+    def test_transaction_applies_once_and_records_the_outcome(self):
+        self.assertEqual(idempotency.deduct_once("pto_usage:r1", "E1", 4, require_sufficient=True), (True, 6, False))
+        self.assertEqual(self.balance(), 6)
+        record = self.record("pto_usage:r1")
+        self.assertEqual((record["applied"], record["balance"], record["hours"]), (True, 6, 4))
+
+    def test_record_found_inside_the_transaction_is_returned_unchanged(self):
+        self.db.docs[(idempotency.LEDGER_COLLECTION, "pto_usage:r1")] = {"applied": False, "balance": 3}
+        self.assertEqual(idempotency.deduct_once("pto_usage:r1", "E1", 4, require_sufficient=True), (False, 3, True))
+        self.assertEqual(self.balance(), 10)
+
+    def test_existing_record_fails_the_batch_and_leaves_the_balance(self):
+        self.assertEqual(idempotency.deduct_once("pto_deduction:r1", "E1", 4), (True, 6, False))
+        idempotency.recent_results.invalidate("pto_deduction:r1")
+        # A redelivery after the LRU forgot the key hits AlreadyExists on the record.
+        self.assertEqual(idempotency.deduct_once("pto_deduction:r1", "E1", 4), (True, 6, True))
+        self.assertEqual(self.balance(), 6)
+
+    def test_repeated_key_in_one_transaction_applies_once(self):
+        results = idempotency.deduct_many_once(
+            [("pto_usage:r1", "E1", 2), ("pto_usage:r1", "E1", 2), ("pto_usage:r2", "E1", 20)]
+        )
+        self.assertEqual(results, [(True, 8, False), (True, 8, True), (False, 8, False)])
+        self.assertEqual(self.balance(), 8)
+        self.assertFalse(self.record("pto_usage:r2")["applied"])
+
+    def test_repeated_key_in_one_commit_applies_once(self):
+        results = idempotency.commit_deductions_once(
+            [("pto_deduction:r1", "E1", 2), ("pto_deduction:r1", "E1", 2), ("pto_deduction:r2", "E1", 3)]
+        )
+        self.assertEqual(results, [(True, 5, False), (True, 5, True), (True, 5, False)])
+        self.assertEqual(self.balance(), 5)
+        self.assertEqual(self.db.commits, 1)
+
+    def test_recorded_keys_are_skipped_by_a_batched_commit(self):
+        self.db.docs[(idempotency.LEDGER_COLLECTION, "pto_deduction:r1")] = {"applied": True, "balance": None}
+        results = idempotency.commit_deductions_once([("pto_deduction:r1", "E1", 2), ("pto_deduction:r2", "E1", 3)])
+        self.assertEqual(results, [(True, 7, True), (True, 7, False)])
+        self.assertEqual(self.balance(), 7)
+
+    def test_records_expire_after_the_ttl(self):
+        with mock.patch.object(idempotency, "IDEMPOTENCY_TTL_SECONDS", 3600):
+            record = idempotency.ledger_record("E1", 4, True, 6)
+        remaining = (record["expires_at"] - datetime.now(timezone.utc)).total_seconds()
+        self.assertTrue(3590 < remaining <= 3600)
+
+    def test_recent_keys_expire_from_the_lru(self):
+        idempotency.remember("pto_usage:r1", True, 6)
+        with mock.patch.object(models.time, "monotonic", return_value=time.monotonic() + 601):
+            self.assertIsNone(idempotency.recall("pto_usage:r1"))
+        self.assertEqual(idempotency.deduct_once("pto_usage:r1", "E1", 4, require_sufficient=True), (True, 6, False))
+
+
+class CreateManyTests(SimpleTestCase):
+    def create(self, db, employee_ids):
+        with mock.patch.object(models, "get_firestore_client", return_value=db), \
+                mock.patch.object(models, "record_write") as record_write:
+            created = models.PTO.create_many(employee_ids)
+        return created, record_write
+
+    def test_missing_records_are_created_in_one_batch(self):
+        db = FakeFirestore()
+        created, record_write = self.create(db, ["E1", "E2"])
+        self.assertEqual(created, ["E1", "E2"])
+        self.assertEqual(db.existing, {"pto/E1", "pto/E2"})
+        self.assertEqual(db.commits, 1)
+        record_write.assert_has_calls([mock.call("E1", 0), mock.call("E2", 0)])
+
+    def test_records_created_concurrently_are_left_alone(self):
+        db = FakeFirestore(existing={"pto/E2"})
+        created, record_write = self.create(db, ["E1", "E2", "E3"])
+        self.assertEqual(created, ["E1", "E3"])
+        # The batch failed as a whole, then each employee was created alone.
+        self.assertEqual(db.commits, 4)
+        self.assertNotIn(mock.call("E2", 0), record_write.call_args_list)
+
+
+class ValidateRowTests(SimpleTestCase):
+    def test_valid_rows(self):
+        self.assertEqual(validate_row({"employee_id": " E100 ", "balance": 40}), ("E100", 40))
+        self.assertEqual(validate_row({"employee_id": 7, "balance": "-8"}), ("7", -8))
+        self.assertEqual(validate_row({"employee_id": "E1", "balance": " 12 "}), ("E1", 12))
+
+    def test_invalid_rows(self):
+        for row, error in (
+            (ValueError("Expecting value"), "not valid JSON"),
+            (["E1", 40], "expected an object"),
+            ({"balance": 40}, "missing employee_id"),
+            ({"employee_id": "  ", "balance": 40}, "missing employee_id"),
+            ({"employee_id": "a/b", "balance": 40}, "may not contain"),
+            ({"employee_id": "E1"}, "not a whole number"),
+            ({"employee_id": "E1", "balance": "4.5"}, "not a whole number"),
+            ({"employee_id": "E1", "balance": 4.5}, "not a whole number"),
+            ({"employee_id": "E1", "balance": True}, "not a whole number"),
+            ({"employee_id": "E1", "balance": "--4"}, "not a whole number"),
+        ):
+            with self.subTest(row=row):
+                with self.assertRaisesRegex(ValueError, error):
+                    validate_row(row)
+
+
+class ParquetPartitionWriterTests(SimpleTestCase):
+    def test_fractional_and_malformed_balances(self):
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            self.skipTest("pyarrow is not installed")
+        path = os.path.join(tempfile.mkdtemp(), "pto-00000.parquet")
+        writer = ParquetPartitionWriter(path, ["employee_id", "balance"])
+        writer.write_rows([["E1", 40], ["E2", 7.5], ["E3", None], ["E4", "n/a"]])
+        writer.close()
+        table = pyarrow.parquet.read_table(path)
+        self.assertEqual(str(table.schema.field("balance").type), "double")
+        self.assertEqual(table.column("balance").to_pylist(), [40.0, 7.5, None, None])
@@ -0,0 +1,105 @@
+"""
+Firestore on_snapshot listener on the pto collection, feeding in-memory
+copies of the balances (the bulk snapshot and the balance mirror) with
+writes made by every pod and process, not just this one.
+
+The first snapshot of each subscription carries the whole collection. It is
+handed to on_reset(records) as (employee_id, balance) pairs so the copy is
+rebuilt rather than patched. Later snapshots are handed to
+on_change(employee_id, balance) per changed document, with balance None for
+a deleted one. Balances are passed on exactly as stored.
+
+A watch whose stream fails for good stops calling back without telling
+anyone. healthy() therefore also checks the stream, and ensure_running()
+replaces a dead subscription with a new one, which resyncs from scratch.
+"""
+import time
+import logging
+import threading
+from typing import Callable, Iterable, Optional, Tuple
+
+from utils.gcp_clients import get_firestore_client
+
+logger = logging.getLogger(__name__)
+
+
+def balance_of(document) -> Optional[float]:
+    return (document.to_dict() or {}).get("balance", 0)
+
+
+class PTOWatch:
+    def __init__(self, name: str,
+                 on_reset: Callable[[Iterable[Tuple[str, float]]], None],
+                 on_change: Callable[[str, Optional[float]], None]):
+        self.name = name
+        self.on_reset = on_reset
+        self.on_change = on_change
+        self.events = 0
+        self.restarts = 0
+        self.last_event_at = None
+        self.last_read_time = None
+        self._watch = None
+        self._synced = False
+        self._failed = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._watch is None:
+                self._subscribe()
+
+    def _subscribe(self):
+        self._synced = False
+        self._failed = False
+        self._watch = get_firestore_client().collection("pto").on_snapshot(self._on_snapshot)
+        logger.info(f"{self.name}: listening to the pto collection.")
+
+    def stop(self):
+        with self._lock:
+            watch, self._watch = self._watch, None
+            self._synced = False
+        if watch is not None:
+            watch.unsubscribe()
+
+    def _stream_alive(self) -> bool:
+        return self._watch is not None and self._watch.is_active and not self._failed
+
+    def healthy(self) -> bool:
+        """True while the stream is up and has delivered the full collection."""
+        return self._synced and self._stream_alive()
+
+    def ensure_running(self) -> bool:
+        """Resubscribe if the stream has died; returns healthy()."""
+        with self._lock:
+            if self._watch is not None and not self._stream_alive():
+                logger.warning(f"{self.name}: pto listener stream closed; resubscribing.")
+                self._watch.unsubscribe()
+                self.restarts += 1
+                self._subscribe()
+        return self.healthy()
+
+    def staleness(self) -> Optional[float]:
+        """Seconds since the last delivered snapshot, or None before the first one."""
+        if self.last_event_at is None:
+            return None
+        return time.monotonic() - self.last_event_at
+
+    def _on_snapshot(self, documents, changes, read_time):
+        try:
+            if not self._synced:
+                self.on_reset([(document.id, balance_of(document)) for document in documents])
+                self._synced = True
+            else:
+                for change in changes:
+                    if change.type.name == "REMOVED":
+                        self.on_change(change.document.id, None)
+                    else:
+                        self.on_change(change.document.id, balance_of(change.document))
+        except Exception:
+            # The copy may now be incomplete; ensure_running() resyncs it.
+            logger.exception(f"{self.name}: failed to apply a pto snapshot.")
+            self._failed = True
+            return
+        self.events += 1
+        self.last_event_at = time.monotonic()
+        self.last_read_time = read_time
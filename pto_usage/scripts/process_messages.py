@@ -4,103 +4,171 @@ import signal
 import threading
 import logging
 
-from google.cloud import pubsub_v1
-from pto_update.models import PTO
+from pto_update import idempotency
 from utils.dashboard_events import build_dashboard_payload
-from google.cloud import logging as cloud_logging
-
-# Initialize Google Cloud Logging
-cloud_client = cloud_logging.Client()
-cloud_client.setup_logging()
+from utils.batch_envelope import batch_payload, invalid_result, item_result, operation_request_id, operations_of
+from utils.dashboard_publisher import get_dashboard_publisher
+from utils.subscriber_settings import subscribe_options
+from utils.micro_batch import MicroBatcher, MICRO_BATCH_ENABLED
+from utils.ordered_lanes import LaneDispatcher, ORDERED_LANES_ENABLED
+from utils.supervision import await_stream, restart_delay
+from utils.structured_logging import level_for, log_payload
+from utils import gcp_clients, metrics
 
 # Standard logger setup
 logger = logging.getLogger("pto_deduction_handler")
-logger.setLevel(logging.INFO)
+logger.setLevel(level_for("pto_usage"))
 
 # GCP Pub/Sub configuration
-project_id = "hopkinstimesheetproj"
 subscription_name = "pto_deduction_sub"
-dashboard_topic = f"projects/{project_id}/topics/dashboard-queue"
-subscription_path = pubsub_v1.SubscriberClient().subscription_path(project_id, subscription_name)
+subscription_path = gcp_clients.subscription_path(subscription_name)
 
-subscriber = pubsub_v1.SubscriberClient()
-publisher = pubsub_v1.PublisherClient()
+dashboard_publisher = get_dashboard_publisher()
 
 # Graceful shutdown event
 shutdown_event = threading.Event()
+streaming_pull_future = None
 
 def signal_handler(sig, frame):
     logger.info("Received termination signal. Preparing for shutdown...")
     shutdown_event.set()
+    if streaming_pull_future is not None:
+        streaming_pull_future.cancel()
+
+@metrics.timed_stage("decode")
+def decode_message(message):
+    raw_data = message.data.decode("utf-8")
+    log_payload(logger, "pto_usage", raw_data)
+
+    data = json.loads(raw_data)
+    if isinstance(data, str):
+        data = json.loads(data)
+    return data
+
+def usage_fields(data):
+    return data["employee_id"], data["pto_hours"], data.get("request_id")
+
+def build_result_payload(employee_id, pto_hours, applied, balance):
+    if not applied:
+        msg = (
+            f"Not enough PTO balance for employee_id {employee_id}. "
+            f"Current: {balance}, Requested: {pto_hours}"
+        )
+        logger.warning(msg)
+        return build_dashboard_payload(employee_id, "pto_deducted", msg)
+
+    msg = (
+        f"PTO successfully deducted for employee_id {employee_id}. "
+        f"New balance: {balance}"
+    )
+    logger.info(msg)
+    return build_dashboard_payload(
+        employee_id,
+        "refresh_data",
+        "Time log created, please refresh dashboard data.",
+    )
+
+def usage_result(employee_id, applied, balance, duplicate):
+    status = "duplicate" if duplicate else ("ok" if applied else "insufficient")
+    return item_result(employee_id, status, balance)
+
+def process_envelope(message, data, operations):
+    # Sufficient-balance checks for the whole envelope share one transaction.
+    requests = []
+    results = [None] * len(operations)
+    for index, operation in enumerate(operations):
+        try:
+            employee_id, pto_hours, _ = usage_fields(operation)
+        except Exception as e:
+            results[index] = invalid_result(operation, e)
+            continue
+        request_id = operation_request_id(message, operation, index)
+        requests.append((index, (idempotency.key_for("pto_usage", message, request_id), employee_id, pto_hours)))
+
+    if requests:
+        outcomes = idempotency.deduct_many_once([request for _, request in requests])
+        for (index, (_, employee_id, _)), outcome in zip(requests, outcomes):
+            results[index] = usage_result(employee_id, *outcome)
+    logger.info(f"Batch envelope: {len(requests)} of {len(operations)} PTO usage deductions valid.")
+    dashboard_publisher.publish(batch_payload("pto_usage", data, results), ack=message)
 
 def callback(message):
     try:
-        logger.info("Received PTO deduction message.")
-        raw_data = message.data.decode("utf-8")
-        logger.info(f"Raw message received: {raw_data}")
-
-        data = json.loads(raw_data)
-        if isinstance(data, str):
-            data = json.loads(data)
-        logger.info(f"Payload: {data}")
-
-        employee_id = data["employee_id"]
-        pto_hours = data["pto_hours"]
-
-        pto = PTO.get_by_employee_id(employee_id)
-        created = False
-
-        if not pto:
-            pto = PTO(employee_id=employee_id, balance=0)
-            pto.save()
-            created = True
-
-        if created:
-            logger.info(f"Created new PTO record for employee_id {employee_id} with 0 balance.")
-
-        if pto.balance < pto_hours:
-            msg = (
-                f"Not enough PTO balance for employee_id {employee_id}. "
-                f"Current: {pto.balance}, Requested: {pto_hours}"
-            )
-            logger.warning(msg)
-            dashboard_payload = build_dashboard_payload(employee_id, "pto_deducted", msg)
-        else:
-            pto.balance -= pto_hours
-            pto.save()
-            msg = (
-                f"PTO successfully deducted for employee_id {employee_id}. "
-                f"New balance: {pto.balance}"
-            )
-            logger.info(msg)
-            dashboard_payload = build_dashboard_payload(
-                employee_id,
-                "refresh_data",
-                "Time log created, please refresh dashboard data.",
-            )
-
-        publisher.publish(dashboard_topic, json.dumps(dashboard_payload).encode("utf-8"))
-        logger.info("Published dashboard update.")
-        message.ack()
-        logger.info("Message acknowledged.")
+        logger.debug("Received PTO deduction message.")
+        data = decode_message(message)
+        operations = operations_of(data)
+        if operations is not None:
+            process_envelope(message, data, operations)
+            return
+        employee_id, pto_hours, request_id = usage_fields(data)
+
+        key = idempotency.key_for("pto_usage", message, request_id)
+        applied, balance, duplicate = idempotency.deduct_once(key, employee_id, pto_hours, require_sufficient=True)
+        if duplicate:
+            logger.info(f"[DUPLICATE] PTO usage {key} for employee_id {employee_id} was already processed.")
+        dashboard_payload = build_result_payload(employee_id, pto_hours, applied, balance)
+
+        dashboard_publisher.publish(dashboard_payload, ack=message)
+        logger.debug("Queued dashboard update; ack deferred until publish completes.")
 
     except Exception as e:
         logger.exception("Failed to handle message:")
         message.nack()
 
-def listen_for_messages():
+def process_batch(messages):
+    # All sufficient-balance checks in the batch share one transaction.
+    parsed = []
+    for message in messages:
+        try:
+            data = decode_message(message)
+            operations = operations_of(data)
+            if operations is not None:
+                process_envelope(message, data, operations)
+                continue
+            employee_id, pto_hours, request_id = usage_fields(data)
+        except Exception:
+            logger.exception("Failed to process message:")
+            message.nack()
+            continue
+        parsed.append((message, employee_id, pto_hours, idempotency.key_for("pto_usage", message, request_id)))
+
+    if not parsed:
+        return
+
+    try:
+        results = idempotency.deduct_many_once([(key, employee_id, pto_hours) for _, employee_id, pto_hours, key in parsed])
+    except Exception:
+        logger.exception(f"Failed to apply batch of {len(parsed)} PTO deductions:")
+        for message, _, _, _ in parsed:
+            message.nack()
+        return
+
+    for (message, employee_id, pto_hours, _), (applied, balance, _) in zip(parsed, results):
+        dashboard_payload = build_result_payload(employee_id, pto_hours, applied, balance)
+        dashboard_publisher.publish(dashboard_payload, ack=message)
+
+def listen_for_messages(message_callback=callback):
+    global streaming_pull_future
     logger.info(f"Listening to Pub/Sub subscription: {subscription_path}")
 
     while not shutdown_event.is_set():
         try:
-            future = subscriber.subscribe(subscription_path, callback=callback)
+            streaming_pull_future = future = gcp_clients.get_subscriber_client().subscribe(
+                subscription_path, callback=metrics.instrument("pto_usage", message_callback),
+                **subscribe_options("pto_usage")
+            )
             logger.info("PTO Deduction handler is actively listening for messages...")
-            future.result()  # blocks until failure
+            await_stream(future, "pto_usage")
         except Exception as e:
-            logger.exception("Pub/Sub listener crashed. Restarting in 5 seconds...")
-            time.sleep(5)
+            if shutdown_event.is_set():
+                break
+            delay = restart_delay("pto_usage")
+            logger.exception(f"Pub/Sub listener crashed. Restarting in {delay:.1f} seconds...")
+            shutdown_event.wait(delay)
 
 def run():
+    gcp_clients.setup_cloud_logging()
+
     if threading.current_thread() == threading.main_thread():
         signal.signal(signal.SIGINT, signal_handler)
         signal.signal(signal.SIGTERM, signal_handler)
@@ -114,15 +182,29 @@ def run():
 
     threading.Thread(target=heartbeat, daemon=True).start()
 
+    batcher = None
+    message_callback = callback
+    if MICRO_BATCH_ENABLED:
+        batcher = MicroBatcher("pto_usage", process_batch)
+        batcher.start()
+        message_callback = batcher.submit
+    elif ORDERED_LANES_ENABLED:
+        batcher = LaneDispatcher("pto_usage", callback)
+        batcher.start()
+        message_callback = batcher.submit
+
     try:
-        listen_for_messages()
+        listen_for_messages(message_callback)
     except Exception as e:
         logger.exception("Unhandled exception in run()")
     finally:
-        try:
-            subscriber.close()
-            logger.info("Subscriber client closed.")
-        except Exception as e:
-            logger.warning("Failed to close subscriber cleanly: %s", e)
+        if batcher:
+            batcher.stop()
+        # The subscriber client is shared; only this service's stream is cancelled here.
+        if streaming_pull_future is not None:
+            streaming_pull_future.cancel()
+            logger.info("Subscriber stream cancelled.")
+        # Publish refresh_data events the coalescer is still holding back.
+        dashboard_publisher.flush()
 
         logger.info("PTO Deduction microservice shut down.")
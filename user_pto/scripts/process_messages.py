@@ -4,94 +4,138 @@ import signal
 import threading
 import logging
 
-from google.cloud import pubsub_v1
+from pto_update.mirror import start_mirror
 from pto_update.models import PTO
 from utils.dashboard_events import build_dashboard_payload
-from google.cloud import logging as cloud_logging
-
-# Initialize Google Cloud Logging
-cloud_client = cloud_logging.Client()
-cloud_client.setup_logging()
+from utils.batch_envelope import batch_payload, invalid_result, item_result, operations_of
+from utils.dashboard_publisher import get_dashboard_publisher
+from utils.subscriber_settings import subscribe_options
+from utils.ordered_lanes import LaneDispatcher, ORDERED_LANES_ENABLED
+from utils.supervision import await_stream, restart_delay
+from utils.structured_logging import level_for, log_payload
+from utils import gcp_clients, metrics
 
 # Standard logger setup
 logger = logging.getLogger("user_pto_lookup")
-logger.setLevel(logging.INFO)
+logger.setLevel(level_for("user_pto"))
 
 # GCP configuration
-project_id = "hopkinstimesheetproj"
 subscription_name = "user_pto_queue-sub"
-dashboard_topic = f"projects/{project_id}/topics/dashboard-queue"
-subscription_path = pubsub_v1.SubscriberClient().subscription_path(project_id, subscription_name)
+subscription_path = gcp_clients.subscription_path(subscription_name)
 
-# Pub/Sub clients
-subscriber = pubsub_v1.SubscriberClient()
-publisher = pubsub_v1.PublisherClient()
+# Pub/Sub publishing goes through the shared dashboard publisher
+dashboard_publisher = get_dashboard_publisher()
 
 # Graceful shutdown event
 shutdown_event = threading.Event()
+streaming_pull_future = None
 
 def signal_handler(sig, frame):
     logger.info("Shutdown signal received. Exiting gracefully...")
     shutdown_event.set()
+    if streaming_pull_future is not None:
+        streaming_pull_future.cancel()
+
+@metrics.timed_stage("decode")
+def decode_message(message):
+    raw_data = message.data.decode("utf-8")
+    log_payload(logger, "user_pto", raw_data)
+
+    data = json.loads(raw_data)
+    if isinstance(data, str):
+        data = json.loads(data)
+    return data
+
+def build_lookup_payload(employee_id, balance, created):
+    msg = (
+        f"Created new PTO record for employee_id {employee_id} with 0 balance."
+        if created else
+        f"PTO balance for employee_id {employee_id} is {balance} hours."
+    )
+    logger.info(msg)
+
+    return build_dashboard_payload(
+        employee_id,
+        "pto_lookup",
+        msg,
+        {"pto_balance": balance}
+    )
+
+def process_envelope(message, data, operations):
+    # One batched read for every lookup; missing records are created at 0 in one batched write.
+    # A record created by someone else since the read is re-read, not overwritten.
+    employee_ids = []
+    results = [None] * len(operations)
+    for index, operation in enumerate(operations):
+        try:
+            employee_ids.append((index, str(operation["employee_id"])))
+        except Exception as e:
+            results[index] = invalid_result(operation, e)
 
-def callback(message):
-    try:
-        logger.info("Received PTO lookup message.")
-        raw_data = message.data.decode("utf-8")
-        logger.info(f"Raw message received: {raw_data}")
+    balances = PTO.get_many([employee_id for _, employee_id in employee_ids])
+    missing = [employee_id for employee_id, balance in balances.items() if balance is None]
+    created = set(PTO.create_many(missing)) if missing else set()
+    raced = [employee_id for employee_id in missing if employee_id not in created]
+    if raced:
+        balances.update(PTO.get_many(raced))
 
-        data = json.loads(raw_data)
-        if isinstance(data, str):
-            data = json.loads(data)
+    for index, employee_id in employee_ids:
+        status = "created" if employee_id in created else "ok"
+        results[index] = item_result(employee_id, status, balances[employee_id] or 0)
+    logger.info(f"Batch envelope: {len(employee_ids)} PTO lookups, {len(created)} records created.")
+    dashboard_publisher.publish(batch_payload("user_pto", data, results), ack=message)
 
+def callback(message):
+    try:
+        logger.debug("Received PTO lookup message.")
+        data = decode_message(message)
+        operations = operations_of(data)
+        if operations is not None:
+            process_envelope(message, data, operations)
+            return
         employee_id = data["employee_id"]
-        logger.info(f"Looking up PTO for employee_id: {employee_id}")
+        logger.debug(f"Looking up PTO for employee_id: {employee_id}")
 
         # Retrieve or create PTO object
         pto = PTO.get_by_employee_id(employee_id)
         created = False
 
         if not pto:
-            pto = PTO(employee_id=employee_id, balance=0)
-            pto.save()
-            created = True
-
-        msg = (
-            f"Created new PTO record for employee_id {employee_id} with 0 balance."
-            if created else
-            f"PTO balance for employee_id {employee_id} is {pto.balance} hours."
-        )
-        logger.info(msg)
-
-        payload = build_dashboard_payload(
-            employee_id,
-            "pto_lookup",
-            msg,
-            {"pto_balance": pto.balance}
-        )
-
-        publisher.publish(dashboard_topic, json.dumps(payload).encode("utf-8"))
-        logger.info("Published PTO balance update to dashboard topic.")
-        message.ack()
-        logger.info("Message acknowledged.")
+            # A record created by someone else since the read is re-read, not overwritten.
+            created = bool(PTO.create_many([employee_id]))
+            pto = PTO(employee_id=employee_id, balance=0) if created else PTO.get_by_employee_id(employee_id)
+
+        payload = build_lookup_payload(employee_id, pto.balance, created)
+
+        dashboard_publisher.publish(payload, ack=message)
+        logger.debug("Queued PTO balance update to dashboard topic; ack deferred until publish completes.")
 
     except Exception as e:
         logger.exception("Error processing PTO lookup message:")
         message.nack()
 
-def listen_for_messages():
+def listen_for_messages(message_callback=callback):
+    global streaming_pull_future
     logger.info(f"Listening to Pub/Sub subscription: {subscription_path}")
 
     while not shutdown_event.is_set():
         try:
-            future = subscriber.subscribe(subscription_path, callback=callback)
+            streaming_pull_future = future = gcp_clients.get_subscriber_client().subscribe(
+                subscription_path, callback=metrics.instrument("user_pto", message_callback),
+                **subscribe_options("user_pto")
+            )
             logger.info("User PTO Lookup microservice is actively listening for messages...")
-            future.result()  # blocks until failure
+            await_stream(future, "user_pto")
         except Exception as e:
-            logger.exception("Pub/Sub listener crashed. Restarting in 5 seconds...")
-            time.sleep(5)
+            if shutdown_event.is_set():
+                break
+            delay = restart_delay("user_pto")
+            logger.exception(f"Pub/Sub listener crashed. Restarting in {delay:.1f} seconds...")
+            shutdown_event.wait(delay)
 
 def run():
+    gcp_clients.setup_cloud_logging()
+
     if threading.current_thread() == threading.main_thread():
         signal.signal(signal.SIGINT, signal_handler)
         signal.signal(signal.SIGTERM, signal_handler)
@@ -100,20 +144,30 @@ def run():
 
     def heartbeat():
         while not shutdown_event.is_set():
-            logger.info("Heartbeat: User PTO Lookup microservice is alive")
+            logger.info(f"Heartbeat: User PTO Lookup microservice is alive. Balance cache: {PTO.cache_stats()}")
             time.sleep(300)
 
     threading.Thread(target=heartbeat, daemon=True).start()
+    start_mirror()
+
+    lanes = None
+    message_callback = callback
+    if ORDERED_LANES_ENABLED:
+        # A lookup may create the record; keep one employee's lookups in order.
+        lanes = LaneDispatcher("user_pto", callback)
+        lanes.start()
+        message_callback = lanes.submit
 
     try:
-        listen_for_messages()
+        listen_for_messages(message_callback)
     except Exception as e:
         logger.exception("Unhandled exception in run()")
     finally:
-        try:
-            subscriber.close()
-            logger.info("Subscriber client closed.")
-        except Exception as e:
-            logger.warning("Failed to close subscriber cleanly: %s", e)
+        if lanes:
+            lanes.stop()
+        # The subscriber client is shared; only this service's stream is cancelled here.
+        if streaming_pull_future is not None:
+            streaming_pull_future.cancel()
+            logger.info("Subscriber stream cancelled.")
 
         logger.info("User PTO Lookup microservice shut down.")
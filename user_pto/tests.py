@@ -1,3 +1,44 @@
-from django.test import TestCase
+import json
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase
+
+import user_pto.scripts.process_messages as user_pto_service
+
+
+class FakeMessage:
+    def __init__(self, data):
+        self.data = json.dumps(data).encode("utf-8")
+        self.message_id = "m1"
+
+    def nack(self):
+        raise AssertionError("unexpected nack")
+
+
+class LookupEnvelopeTests(SimpleTestCase):
+    def process(self, stored, created):
+        operations = [{"employee_id": "E1"}, {"employee_id": "E2"}, {"employee_id": "E3"}, {}]
+        message = FakeMessage({"operations": operations})
+        reads = [dict(stored), {"E3": 12}]
+        with mock.patch.object(user_pto_service.PTO, "get_many", side_effect=lambda ids: reads.pop(0)) as get_many, \
+                mock.patch.object(user_pto_service.PTO, "create_many", return_value=created) as create_many, \
+                mock.patch.object(user_pto_service, "dashboard_publisher") as publisher:
+            user_pto_service.callback(message)
+        payload, = publisher.publish.call_args[0]
+        return get_many, create_many, payload["payload"]["results"]
+
+    def test_missing_records_are_created_and_raced_ones_re_read(self):
+        # E3 was created elsewhere between the read and the create.
+        get_many, create_many, results = self.process({"E1": 5, "E2": None, "E3": None}, ["E2"])
+        create_many.assert_called_once_with(["E2", "E3"])
+        self.assertEqual(get_many.call_args_list[1], mock.call(["E3"]))
+        self.assertEqual(
+            [(result["employee_id"], result["status"], result["balance"]) for result in results],
+            [("E1", "ok", 5), ("E2", "created", 0), ("E3", "ok", 12), (None, "error", None)],
+        )
+
+    def test_nothing_is_written_when_every_record_exists(self):
+        get_many, create_many, results = self.process({"E1": 5, "E2": 0, "E3": 1}, [])
+        create_many.assert_not_called()
+        self.assertEqual(get_many.call_count, 1)
+        self.assertEqual([result["status"] for result in results], ["ok", "ok", "ok", "error"])
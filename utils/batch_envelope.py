@@ -0,0 +1,53 @@
+"""
+Batch envelopes: one Pub/Sub message carrying many operations for a service.
+
+    {"batch_id": "optional", "operations": [{"employee_id": "E1", "new_balance": 40}, ...]}
+
+Each operation has the same shape as that service's single-item message.
+Services handle an envelope with batched reads and writes. They answer with
+one dashboard event of type "<service>_batch_result" listing a result per
+operation, in order. Invalid operations are reported individually and do
+not fail the rest of the envelope. The envelope is acked once the event is
+published, and nacked if the batch could not be written. Messages without
+an "operations" list are handled as single items, as before.
+"""
+from collections import Counter
+
+from utils.dashboard_events import build_dashboard_payload
+
+
+def operations_of(data):
+    """The envelope's operations, or None if data is a single-item message."""
+    if isinstance(data, dict) and isinstance(data.get("operations"), list):
+        return data["operations"]
+    return None
+
+
+def operation_request_id(message, operation, index: int) -> str:
+    """Per-operation idempotency ID: the operation's request_id, else <message_id>:<index>."""
+    if isinstance(operation, dict) and operation.get("request_id"):
+        return operation["request_id"]
+    return f"{getattr(message, 'message_id', '')}:{index}"
+
+
+def item_result(employee_id, status: str, balance=None, message=None) -> dict:
+    result = {"employee_id": employee_id, "status": status, "balance": balance}
+    if message is not None:
+        result["message"] = message
+    return result
+
+
+def invalid_result(operation, error: Exception) -> dict:
+    employee_id = operation.get("employee_id") if isinstance(operation, dict) else None
+    return item_result(employee_id, "error", message=f"Invalid operation: {error!r}")
+
+
+def batch_payload(service: str, data: dict, results: list) -> dict:
+    counts = Counter(result["status"] for result in results)
+    summary = ", ".join(f"{count} {status}" for status, count in sorted(counts.items()))
+    return build_dashboard_payload(
+        "all",
+        f"{service}_batch_result",
+        f"Processed {len(results)} {service} operations: {summary or 'none'}.",
+        {"batch_id": data.get("batch_id"), "results": results},
+    )
@@ -0,0 +1,98 @@
+import os
+import json
+import time
+import logging
+import threading
+
+from utils.gcp_clients import DASHBOARD_PUBLISH_ORDERING, get_publisher_client, project_id
+from utils.refresh_coalescer import RefreshCoalescer
+from utils.metrics import DASHBOARD_PUBLISHES, DASHBOARD_PUBLISH_LATENCY, STAGE_DURATION
+
+logger = logging.getLogger(__name__)
+
+dashboard_topic = f"projects/{project_id}/topics/dashboard-queue"
+
+# refresh_data events for one employee within this window are published once.
+REFRESH_COALESCE_WINDOW_MS = int(os.getenv("DASHBOARD_REFRESH_COALESCE_MS", "0"))
+
+
+class DashboardPublisher:
+    """
+    Shared, batching publisher for dashboard-queue events. publish() returns
+    immediately; the input message(s) passed as ack are acked once the publish
+    succeeds and nacked if it fails, from the publisher's callback thread.
+    Outcomes and latencies are exported as pto_dashboard_publishes_total and
+    pto_dashboard_publish_latency_seconds.
+    """
+
+    def __init__(self, client=None, topic=dashboard_topic):
+        self.client = client
+        self.topic = topic
+        self.succeeded = 0
+        self.failed = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self._lock = threading.Lock()
+
+    def publish(self, payload, ack=None):
+        messages = ack if isinstance(ack, (list, tuple)) else ([ack] if ack is not None else [])
+        started = time.monotonic()
+        client = self.client or get_publisher_client()
+        ordering_key = str(payload.get("employee_id", "")) if DASHBOARD_PUBLISH_ORDERING else ""
+        future = client.publish(self.topic, json.dumps(payload).encode("utf-8"), ordering_key=ordering_key)
+        future.add_done_callback(lambda f: self._on_done(f, started, messages, client, ordering_key))
+        return future
+
+    def _on_done(self, future, started, messages, client=None, ordering_key=""):
+        latency = time.monotonic() - started
+        STAGE_DURATION.labels("publish").observe(latency)
+        error = future.exception()
+        outcome = "success" if error is None else "failure"
+        DASHBOARD_PUBLISHES.labels(outcome).inc()
+        DASHBOARD_PUBLISH_LATENCY.labels(outcome).observe(latency)
+        with self._lock:
+            if error is None:
+                self.succeeded += 1
+            else:
+                self.failed += 1
+            self.latency_total += latency
+            self.latency_max = max(self.latency_max, latency)
+
+        if error is None:
+            for message in messages:
+                message.ack()
+        else:
+            logger.error(f"Dashboard publish failed after {latency * 1000:.1f} ms: {error}")
+            if ordering_key:
+                # A failed publish pauses its ordering key until resumed.
+                client.resume_publish(self.topic, ordering_key)
+            for message in messages:
+                message.nack()
+
+    def flush(self):
+        """Nothing is held here; the client's own batches are flushed by gcp_clients.close_all()."""
+
+    def stats(self) -> dict:
+        with self._lock:
+            completed = self.succeeded + self.failed
+            return {
+                "succeeded": self.succeeded,
+                "failed": self.failed,
+                "latency_avg_ms": (self.latency_total / completed * 1000) if completed else 0.0,
+                "latency_max_ms": self.latency_max * 1000,
+            }
+
+
+_dashboard_publisher = None
+_dashboard_publisher_lock = threading.Lock()
+
+
+def get_dashboard_publisher():
+    """Shared DashboardPublisher, wrapped in a RefreshCoalescer when enabled."""
+    global _dashboard_publisher
+    with _dashboard_publisher_lock:
+        if _dashboard_publisher is None:
+            _dashboard_publisher = DashboardPublisher()
+            if REFRESH_COALESCE_WINDOW_MS > 0:
+                _dashboard_publisher = RefreshCoalescer(_dashboard_publisher, REFRESH_COALESCE_WINDOW_MS)
+        return _dashboard_publisher
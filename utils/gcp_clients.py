@@ -0,0 +1,163 @@
+import os
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+project_id = "hopkinstimesheetproj"
+
+# One instance of each client per process, created on first use so importing
+# a service module opens no gRPC channels.
+_clients = {}
+_lock = threading.RLock()
+_logging_configured = False
+
+# Publish dashboard events with the employee_id as ordering key, so one
+# employee's events are delivered in order on an ordered subscription.
+DASHBOARD_PUBLISH_ORDERING = os.getenv("DASHBOARD_PUBLISH_ORDERING", "False") == "True"
+
+
+def _get(name, factory):
+    with _lock:
+        client = _clients.get(name)
+        if client is None:
+            started = time.monotonic()
+            client = _clients[name] = factory()
+            logger.info(f"Created shared {name} client in {(time.monotonic() - started) * 1000:.0f} ms.")
+        return client
+
+
+def dashboard_batch_settings():
+    from google.cloud.pubsub_v1.types import BatchSettings
+
+    return BatchSettings(
+        max_messages=int(os.getenv("DASHBOARD_PUBLISH_MAX_MESSAGES", "100")),
+        max_bytes=int(os.getenv("DASHBOARD_PUBLISH_MAX_BYTES", str(1024 * 1024))),
+        max_latency=int(os.getenv("DASHBOARD_PUBLISH_MAX_LATENCY_MS", "10")) / 1000.0,
+    )
+
+
+def dashboard_publisher_options():
+    from google.cloud.pubsub_v1.types import LimitExceededBehavior, PublisherOptions, PublishFlowControl
+
+    # Block publishers (and so the callback pulling more work) once too much
+    # is waiting to go out, instead of buffering without bound.
+    return PublisherOptions(
+        enable_message_ordering=DASHBOARD_PUBLISH_ORDERING,
+        flow_control=PublishFlowControl(
+            message_limit=int(os.getenv("DASHBOARD_PUBLISH_FLOW_MAX_MESSAGES", "1000")),
+            byte_limit=int(os.getenv("DASHBOARD_PUBLISH_FLOW_MAX_BYTES", str(10 * 1024 * 1024))),
+            limit_exceeded_behavior=LimitExceededBehavior.BLOCK,
+        )
+    )
+
+
+def _create_firestore():
+    from google.cloud import firestore
+
+    return firestore.Client()
+
+
+def _create_async_firestore():
+    from google.cloud import firestore
+
+    return firestore.AsyncClient()
+
+
+def _create_publisher():
+    from google.cloud import pubsub_v1
+
+    return pubsub_v1.PublisherClient(
+        batch_settings=dashboard_batch_settings(),
+        publisher_options=dashboard_publisher_options(),
+    )
+
+
+def _create_subscriber():
+    from google.cloud import pubsub_v1
+
+    return pubsub_v1.SubscriberClient()
+
+
+def _create_logging():
+    from google.cloud import logging as cloud_logging
+
+    return cloud_logging.Client()
+
+
+def get_firestore_client():
+    return _get("firestore", _create_firestore)
+
+
+def get_async_firestore_client():
+    """Firestore AsyncClient for the asyncio engine; create it on the loop that uses it."""
+    return _get("async_firestore", _create_async_firestore)
+
+
+def get_publisher_client():
+    return _get("publisher", _create_publisher)
+
+
+def get_subscriber_client():
+    return _get("subscriber", _create_subscriber)
+
+
+def get_logging_client():
+    return _get("logging", _create_logging)
+
+
+def subscription_path(subscription_name: str) -> str:
+    return f"projects/{project_id}/subscriptions/{subscription_name}"
+
+
+def setup_cloud_logging():
+    """Install the non-blocking root log handler once per process (see utils.structured_logging)."""
+    global _logging_configured
+    with _lock:
+        if not _logging_configured:
+            from utils import structured_logging
+
+            structured_logging.configure()
+            _logging_configured = True
+
+
+def prewarm():
+    """Create every shared client and open the Firestore channel before traffic arrives."""
+    setup_cloud_logging()
+    get_subscriber_client()
+    get_publisher_client()
+    db = get_firestore_client()
+    try:
+        started = time.monotonic()
+        list(db.collection("pto").limit(1).select([]).stream())
+        logger.info(f"Firestore channel warmed in {(time.monotonic() - started) * 1000:.0f} ms.")
+    except Exception as e:
+        logger.warning("Firestore pre-warm query failed: %s", e)
+
+
+def close_all():
+    """Flush and close every shared client; called once at process shutdown."""
+    with _lock:
+        clients = dict(_clients)
+        _clients.clear()
+
+    publisher = clients.pop("publisher", None)
+    if publisher is not None:
+        try:
+            publisher.stop()
+            logger.info("Publisher client flushed and stopped.")
+        except Exception as e:
+            logger.warning("Failed to stop publisher cleanly: %s", e)
+
+    # Logging goes last so the shutdown of everything else is still recorded.
+    for name in ("subscriber", "firestore", "async_firestore", "logging"):
+        client = clients.get(name)
+        close = getattr(client, "close", None)
+        if close is None:
+            continue
+        try:
+            close()
+            logger.info(f"{name} client closed.")
+        except Exception as e:
+            logger.warning("Failed to close %s client cleanly: %s", name, e)
@@ -0,0 +1,82 @@
+"""
+Micro-benchmark of per-message logging overhead: `python -m utils.log_benchmark`.
+
+"before" replays the log lines a deduction callback used to emit (every line
+at INFO, full raw payload) through a synchronous handler. "after" replays
+the current lines (sampled payload, per-message chatter at DEBUG) through
+the queue-based handler from utils.structured_logging. The sink is a JSON
+formatter writing to os.devnull. --sink-latency-us adds a sleep per emitted
+record to stand in for a network log sink.
+"""
+import os
+import json
+import time
+import logging
+import argparse
+
+from utils import structured_logging
+
+
+class _SlowSink(logging.StreamHandler):
+    def __init__(self, stream, latency_us: float):
+        super().__init__(stream)
+        self.latency = latency_us / 1_000_000
+        self.setFormatter(structured_logging.JsonFormatter())
+
+    def emit(self, record):
+        if self.latency:
+            time.sleep(self.latency)
+        super().emit(record)
+
+
+def _before(logger, raw_data, employee_id, hours):
+    logger.info("Received new message on subscription.")
+    logger.info(f"Raw message received: {raw_data}")
+    logger.info("Converted pto_hours to int: %d", hours)
+    logger.info(f"[SUCCESS] PTO for employee {employee_id} updated. New balance: 32")
+    logger.info("Queued update to dashboard topic; ack deferred until publish completes.")
+
+
+def _after(logger, raw_data, employee_id, hours):
+    logger.debug("Received new message on subscription.")
+    structured_logging.log_payload(logger, "benchmark", raw_data)
+    logger.debug("Converted pto_hours to int: %d", hours)
+    logger.info(f"[SUCCESS] PTO for employee {employee_id} updated. New balance: 32")
+    logger.debug("Queued update to dashboard topic; ack deferred until publish completes.")
+
+
+def measure(emit, asynchronous: bool, messages: int, latency_us: float, payload_bytes: int) -> float:
+    """Return the mean caller-side microseconds per message."""
+    with open(os.devnull, "w") as devnull:
+        structured_logging.configure(_SlowSink(devnull, latency_us), asynchronous=asynchronous)
+        logger = logging.getLogger("log_benchmark")
+        logger.setLevel(logging.INFO)
+        raw_data = json.dumps({"employee_id": "E12345", "pto_hours": 8, "note": "x" * payload_bytes})
+        started = time.perf_counter()
+        for i in range(messages):
+            emit(logger, raw_data, f"E{i}", 8)
+        elapsed = time.perf_counter() - started
+        structured_logging.stop()
+    return elapsed / messages * 1_000_000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--payload-bytes", type=int, default=512)
+    parser.add_argument("--sink-latency-us", type=float, default=0.0)
+    args = parser.parse_args()
+
+    print(
+        f"{args.messages} messages, {args.payload_bytes}-byte payloads, "
+        f"{args.sink_latency_us:g} us sink latency, payload sample rate 1/{structured_logging.PAYLOAD_SAMPLE_RATE}"
+    )
+    before = measure(_before, False, args.messages, args.sink_latency_us, args.payload_bytes)
+    after = measure(_after, True, args.messages, args.sink_latency_us, args.payload_bytes)
+    print(f"  before (sync handler, 5 INFO lines, full payload) {before:8.1f} us/message")
+    print(f"  after  (queue handler, sampled payload)           {after:8.1f} us/message")
+    print(f"  speedup                                           {before / after:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
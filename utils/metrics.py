@@ -0,0 +1,125 @@
+import time
+import functools
+from contextlib import contextmanager
+
+from prometheus_client import Counter, Gauge, Histogram
+
+MESSAGES_RECEIVED = Counter(
+    "pto_messages_received_total", "Pub/Sub messages delivered to a service callback.", ["service"]
+)
+MESSAGES_ACKED = Counter("pto_messages_acked_total", "Pub/Sub messages acknowledged.", ["service"])
+MESSAGES_NACKED = Counter("pto_messages_nacked_total", "Pub/Sub messages negatively acknowledged.", ["service"])
+MESSAGES_IN_FLIGHT = Gauge(
+    "pto_messages_in_flight", "Messages received but not yet acked or nacked.", ["service"],
+    multiprocess_mode="livesum",
+)
+MESSAGE_DURATION = Histogram(
+    "pto_message_duration_seconds", "Time from callback entry to ack/nack, per service.", ["service"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+STAGE_DURATION = Histogram(
+    "pto_stage_duration_seconds", "Time spent in each message-processing stage.", ["stage"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5),
+)
+DASHBOARD_PUBLISHES = Counter(
+    "pto_dashboard_publishes_total", "Completed dashboard-queue publishes, by outcome.", ["outcome"]
+)
+DASHBOARD_PUBLISH_LATENCY = Histogram(
+    "pto_dashboard_publish_latency_seconds", "Time from publish() to the publish future resolving, by outcome.",
+    ["outcome"], buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+DASHBOARD_REFRESH_RECEIVED = Counter(
+    "pto_dashboard_refresh_received_total", "refresh_data events handed to the refresh coalescer."
+)
+DASHBOARD_REFRESH_SUPPRESSED = Counter(
+    "pto_dashboard_refresh_suppressed_total", "refresh_data events folded into an already pending publish."
+)
+FIRESTORE_ERRORS = Counter("pto_firestore_errors_total", "Failed Firestore operations.", ["operation"])
+DUPLICATES_SKIPPED = Counter(
+    "pto_duplicate_requests_total", "Redelivered requests answered from the idempotency ledger.", ["service"]
+)
+MIRROR_RECORDS = Gauge(
+    "pto_mirror_records", "Balances held in the in-memory pto mirror.", multiprocess_mode="max",
+)
+MIRROR_LAST_UPDATE = Gauge(
+    "pto_mirror_last_update_timestamp_seconds", "Unix time the mirror's listener last delivered a snapshot.",
+    multiprocess_mode="max",
+)
+
+
+@contextmanager
+def stage(name: str):
+    """Time a block as one of: decode, firestore_read, firestore_write, publish."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_DURATION.labels(name).observe(time.perf_counter() - started)
+
+
+def timed_stage(name: str):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def firestore_call(operation: str, stage_name: str, expected: tuple = ()):
+    """Time a Firestore call and count it as an error if it raises anything but `expected`."""
+    try:
+        with stage(stage_name):
+            yield
+    except expected:
+        raise
+    except Exception:
+        FIRESTORE_ERRORS.labels(operation).inc()
+        raise
+
+
+class InstrumentedMessage:
+    """
+    Wraps a Pub/Sub message so that whichever component finally acks or
+    nacks it (a callback, the micro-batcher, a publish future) records the
+    outcome and end-to-end latency for the receiving service.
+    """
+
+    __slots__ = ("_message", "_service", "_started", "_settled")
+
+    def __init__(self, message, service: str):
+        self._message = message
+        self._service = service
+        self._started = time.perf_counter()
+        self._settled = False
+        MESSAGES_RECEIVED.labels(service).inc()
+        MESSAGES_IN_FLIGHT.labels(service).inc()
+
+    def __getattr__(self, name):
+        return getattr(self._message, name)
+
+    def _settle(self, counter):
+        if self._settled:
+            return
+        self._settled = True
+        counter.labels(self._service).inc()
+        MESSAGES_IN_FLIGHT.labels(self._service).dec()
+        MESSAGE_DURATION.labels(self._service).observe(time.perf_counter() - self._started)
+
+    def ack(self):
+        self._message.ack()
+        self._settle(MESSAGES_ACKED)
+
+    def nack(self):
+        self._message.nack()
+        self._settle(MESSAGES_NACKED)
+
+
+def instrument(service: str, callback):
+    """Wrap a subscriber callback so every delivered message is instrumented."""
+    @functools.wraps(callback)
+    def wrapper(message):
+        return callback(InstrumentedMessage(message, service))
+    return wrapper
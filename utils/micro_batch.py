@@ -0,0 +1,83 @@
+import os
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+MICRO_BATCH_ENABLED = os.getenv("PTO_MICRO_BATCH_ENABLED", "False") == "True"
+MICRO_BATCH_MAX_MESSAGES = int(os.getenv("PTO_MICRO_BATCH_MAX_MESSAGES", "100"))
+MICRO_BATCH_MAX_LATENCY_MS = int(os.getenv("PTO_MICRO_BATCH_MAX_LATENCY_MS", "100"))
+
+
+class MicroBatcher:
+    """
+    Collects Pub/Sub messages and hands them to handler(messages) in groups of
+    up to max_messages, or whatever arrived within max_latency_ms of the first
+    message. The handler owns ack/nack for every message it receives.
+    """
+
+    def __init__(self, name, handler, max_messages=None, max_latency_ms=None):
+        self.name = name
+        self.handler = handler
+        self.max_messages = max_messages or MICRO_BATCH_MAX_MESSAGES
+        self.max_latency = (max_latency_ms or MICRO_BATCH_MAX_LATENCY_MS) / 1000.0
+        self._pending = []
+        self._deadline = None
+        self._stopped = False
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=f"{self.name}-micro-batch", daemon=True)
+        self._thread.start()
+        logger.info(
+            f"Micro-batching enabled for {self.name}: "
+            f"max {self.max_messages} messages / {self.max_latency * 1000:.0f} ms"
+        )
+
+    def submit(self, message):
+        # Used directly as the subscriber callback.
+        with self._cond:
+            first = not self._pending
+            if first:
+                self._deadline = time.monotonic() + self.max_latency
+            self._pending.append(message)
+            # The first message starts the latency clock the batch thread waits on.
+            if first or len(self._pending) >= self.max_messages:
+                self._cond.notify()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread:
+            self._thread.join()
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._stopped:
+                if self._pending:
+                    remaining = self._deadline - time.monotonic()
+                    if len(self._pending) >= self.max_messages or remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                else:
+                    self._cond.wait()
+            batch = self._pending[:self.max_messages]
+            self._pending = self._pending[self.max_messages:]
+            if self._pending:
+                self._deadline = time.monotonic()
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                return
+            try:
+                self.handler(batch)
+            except Exception:
+                logger.exception(f"Micro-batch handler for {self.name} failed; nacking {len(batch)} messages.")
+                for message in batch:
+                    message.nack()
@@ -0,0 +1,89 @@
+import os
+import json
+import zlib
+import queue
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+ORDERED_LANES_ENABLED = os.getenv("PTO_ORDERED_LANES_ENABLED", "False") == "True"
+ORDERED_LANES_DEFAULT = int(os.getenv("PTO_ORDERED_LANES", "16"))
+
+_STOP = object()
+
+
+def lanes_for(service: str) -> int:
+    return max(1, int(os.getenv(f"{service.upper()}_ORDERED_LANES", str(ORDERED_LANES_DEFAULT))))
+
+
+def employee_key(message) -> str:
+    """
+    The message's ordering key, which producers set to the employee_id when
+    publishing with message ordering. Falls back to an employee_id attribute,
+    then to the employee_id in the JSON payload.
+    """
+    key = getattr(message, "ordering_key", "")
+    if key:
+        return key
+    attributes = getattr(message, "attributes", None) or {}
+    if attributes.get("employee_id"):
+        return attributes["employee_id"]
+    try:
+        data = json.loads(message.data.decode("utf-8"))
+        if isinstance(data, str):
+            data = json.loads(data)
+        return str(data["employee_id"])
+    except Exception:
+        # Undecodable messages get their own lane slot; the handler will nack them.
+        return getattr(message, "message_id", "")
+
+
+class LaneDispatcher:
+    """
+    Hashes each message's employee key onto one of N lanes, each drained by a
+    single thread. Messages for one employee are handled one at a time in
+    arrival order, while different employees proceed in parallel. Used as
+    the subscriber callback; handler(message) owns ack/nack as usual.
+    """
+
+    def __init__(self, name, handler, lanes=None, key=employee_key):
+        self.name = name
+        self.handler = handler
+        self.key = key
+        self._queues = [queue.SimpleQueue() for _ in range(lanes or lanes_for(name))]
+        self._threads = []
+
+    def start(self):
+        for index, lane in enumerate(self._queues):
+            thread = threading.Thread(target=self._run, args=(lane,), name=f"{self.name}-lane-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"Ordered lanes enabled for {self.name}: {len(self._queues)} lanes keyed by employee_id")
+
+    def lane_for(self, key: str) -> int:
+        # crc32 rather than hash(): stable across processes and restarts.
+        return zlib.crc32(key.encode("utf-8")) % len(self._queues)
+
+    def submit(self, message):
+        self._queues[self.lane_for(self.key(message))].put(message)
+
+    def depths(self) -> list:
+        return [lane.qsize() for lane in self._queues]
+
+    def stop(self):
+        for lane in self._queues:
+            lane.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self, lane):
+        while True:
+            message = lane.get()
+            if message is _STOP:
+                return
+            try:
+                self.handler(message)
+            except Exception:
+                logger.exception(f"Lane handler for {self.name} failed; nacking message.")
+                message.nack()
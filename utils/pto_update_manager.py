@@ -1,4 +1,5 @@
 from pto_update.models import PTO
+from pto_update.idempotency import deduct_once
 
 class PTOUpdateManager:
     def __init__(self, employee_id, new_balance=None):
@@ -18,44 +19,35 @@ class PTOUpdateManager:
         return pto.balance
 
     def update_pto(self):
-        pto = PTO.get_by_employee_id(self.employee_id)
-        created = False
-
-        # If not found, create a new one
-        if not pto:
-            pto = PTO(employee_id=self.employee_id, balance=0)
+        try:
+            pto = PTO(employee_id=self.employee_id, balance=self.new_balance)
             pto.save()
-            created = True
 
             return {
                 "result": "success",
                 "message": f"PTO balance updated to {self.new_balance}"
             }
-        else:
+        except Exception as e:
             return {
                 "result": "error",
-                "message": "Invalid PTO object"
+                "message": str(e)
             }
 
-    def subtract_pto(self, deduction):
+    def subtract_pto(self, deduction, idempotency_key=None):
         """
-        Subtract the specified deduction from the current PTO balance.
+        Subtract the specified deduction from the current PTO balance. With an
+        idempotency_key a repeated request is reported as a duplicate and not
+        applied again.
         """
         try:
-            # Ensure a PTO record exists, default balance is 0.
-            pto = PTO.get_by_employee_id(self.employee_id)
-            if not pto:
-                pto = PTO(employee_id=self.employee_id, balance=0)
-            # Update the PTO balance to new_balance.
-            pto.balance = self.new_balance
-            # Calculate the new balance by subtracting the deduction.
-            new_balance = pto.balance - deduction
-            pto.balance = new_balance
-            pto.save()
+            # Single atomic increment; a missing record starts from 0.
+            _, new_balance, duplicate = deduct_once(idempotency_key, self.employee_id, deduction)
 
             return {
                 "result": "success",
-                "message": f"PTO balance updated to {new_balance}"
+                "message": f"PTO balance updated to {new_balance}",
+                "balance": new_balance,
+                "duplicate": duplicate
             }
         except Exception as e:
             return {
@@ -0,0 +1,99 @@
+import time
+import heapq
+import logging
+import threading
+
+from utils.metrics import DASHBOARD_REFRESH_RECEIVED, DASHBOARD_REFRESH_SUPPRESSED
+
+logger = logging.getLogger(__name__)
+
+
+class _PendingRefresh:
+    __slots__ = ("payload", "messages", "suppressed")
+
+    def __init__(self, payload):
+        self.payload = payload
+        self.messages = []
+        self.suppressed = 0
+
+
+class RefreshCoalescer:
+    """
+    Sits in front of a DashboardPublisher and collapses refresh_data events
+    for the same employee_id that arrive within window_ms of the first one
+    into a single publish. The input messages of suppressed events are acked
+    (or nacked) together with the one event that is actually published.
+    Every other event type is passed straight through. flush() publishes
+    whatever is still pending; services call it when they shut down.
+    """
+
+    def __init__(self, publisher, window_ms: int):
+        self.publisher = publisher
+        self.window = window_ms / 1000.0
+        self.received = 0
+        self.suppressed = 0
+        self._pending = {}
+        self._deadlines = []
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="refresh-coalescer", daemon=True)
+        self._thread.start()
+
+    def publish(self, payload, ack=None):
+        if payload.get("type") != "refresh_data":
+            return self.publisher.publish(payload, ack=ack)
+
+        messages = ack if isinstance(ack, (list, tuple)) else ([ack] if ack is not None else [])
+        employee_id = str(payload.get("employee_id"))
+        DASHBOARD_REFRESH_RECEIVED.inc()
+        with self._cond:
+            self.received += 1
+            pending = self._pending.get(employee_id)
+            if pending is None:
+                pending = self._pending[employee_id] = _PendingRefresh(payload)
+                heapq.heappush(self._deadlines, (time.monotonic() + self.window, employee_id))
+                self._cond.notify()
+            else:
+                pending.suppressed += 1
+                self.suppressed += 1
+                DASHBOARD_REFRESH_SUPPRESSED.inc()
+            pending.messages.extend(messages)
+        return None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._deadlines or self._deadlines[0][0] > time.monotonic():
+                    timeout = self._deadlines[0][0] - time.monotonic() if self._deadlines else None
+                    self._cond.wait(timeout)
+                _, employee_id = heapq.heappop(self._deadlines)
+                pending = self._pending.pop(employee_id)
+            self._publish(employee_id, pending)
+
+    def flush(self):
+        """Publish every pending refresh now instead of at its deadline."""
+        with self._cond:
+            pending, self._pending, self._deadlines = self._pending, {}, []
+        for employee_id, refresh in pending.items():
+            self._publish(employee_id, refresh)
+        if pending:
+            logger.info(f"Flushed {len(pending)} pending refresh_data events.")
+
+    def _publish(self, employee_id, pending):
+        try:
+            self.publisher.publish(pending.payload, ack=pending.messages)
+            if pending.suppressed:
+                logger.info(f"Coalesced {pending.suppressed + 1} refresh_data events for employee {employee_id}.")
+        except Exception:
+            logger.exception(f"Failed to publish coalesced refresh for employee {employee_id}:")
+            for message in pending.messages:
+                message.nack()
+
+    def stats(self) -> dict:
+        with self._cond:
+            stats = {
+                "refresh_received": self.received,
+                "refresh_suppressed": self.suppressed,
+                "refresh_pending": len(self._pending),
+            }
+        stats.update(self.publisher.stats())
+        return stats
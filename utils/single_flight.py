@@ -0,0 +1,89 @@
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class _Call:
+    __slots__ = ("done", "result", "error", "followers")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
+
+
+class SingleFlight:
+    """
+    Runs at most one fn per key at a time. Callers that arrive while a call
+    for the same key is running block until it finishes and share its result
+    (or exception) instead of starting their own. run_or_queue() coalesces
+    the same way without holding the caller's thread.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._queued = {}
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        """Return (result, shared) where shared is True for followers."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.followers += 1
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+    def run_or_queue(self, key, waiter, run) -> bool:
+        """
+        Non-blocking variant for callers that answer through a callback.
+        With no run for key active, call run([waiter]) on this thread and
+        return True. Otherwise queue waiter and return False at once. When a
+        run finishes, the thread that ran it starts one more run for every
+        waiter queued in the meantime. Queued waiters therefore get a result
+        at least as fresh as their request, and N triggers cost at most two
+        runs. run must answer (or fail) every waiter it is given.
+        """
+        with self._lock:
+            queued = self._queued.get(key)
+            if queued is not None:
+                queued.append(waiter)
+                self.coalesced += 1
+                return False
+            self._queued[key] = []
+
+        waiters = [waiter]
+        while waiters:
+            try:
+                run(waiters)
+            except Exception:
+                logger.exception(f"Coalesced run for {key!r} failed for {len(waiters)} waiters.")
+            with self._lock:
+                waiters = self._queued[key]
+                if waiters:
+                    self._queued[key] = []
+                else:
+                    del self._queued[key]
+        return True
@@ -0,0 +1,147 @@
+"""
+Low-overhead logging for the message hot paths.
+
+Records are handed to a QueueHandler on the calling thread and written by a
+single QueueListener thread, so a slow sink never blocks a Pub/Sub callback.
+Output goes to Cloud Logging (PTO_LOG_TARGET=cloud) or as one JSON object per
+line on stdout (PTO_LOG_TARGET=stdout). Structured fields are passed the way
+Cloud Logging expects them: extra={"json_fields": {...}}.
+
+Each service logger takes its level from <SERVICE>_LOG_LEVEL, falling back to
+PTO_LOG_LEVEL. Raw message payloads go through log_payload(), which logs one
+in PTO_LOG_PAYLOAD_SAMPLE_RATE of them at INFO. The rest are truncated to
+PTO_LOG_PAYLOAD_MAX_CHARS and logged at DEBUG, and they are only built when
+DEBUG is enabled.
+"""
+import os
+import sys
+import json
+import queue
+import atexit
+import logging
+import itertools
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_TARGET = os.getenv("PTO_LOG_TARGET", "cloud")
+LOG_ASYNC = os.getenv("PTO_LOG_ASYNC", "True") == "True"
+DEFAULT_LOG_LEVEL = os.getenv("PTO_LOG_LEVEL", "INFO")
+PAYLOAD_SAMPLE_RATE = int(os.getenv("PTO_LOG_PAYLOAD_SAMPLE_RATE", "100"))
+PAYLOAD_MAX_CHARS = int(os.getenv("PTO_LOG_PAYLOAD_MAX_CHARS", "256"))
+
+_lock = threading.Lock()
+_listener = None
+_payload_counters = {}
+
+
+def _parse_level(name: str):
+    """The numeric level for a name like "debug" or "10", or None if it is not one."""
+    name = name.strip().upper()
+    if name.isdigit():
+        return int(name)
+    level = logging.getLevelName(name)
+    # getLevelName answers an unknown name with the string "Level <name>".
+    return level if isinstance(level, int) else None
+
+
+def level_for(service: str) -> int:
+    """
+    Level for a service logger: <SERVICE>_LOG_LEVEL, else PTO_LOG_LEVEL. An
+    unknown level is logged and replaced by PTO_LOG_LEVEL (or INFO), rather
+    than failing the worker at import.
+    """
+    name = os.getenv(f"{service.upper()}_LOG_LEVEL", DEFAULT_LOG_LEVEL)
+    level = _parse_level(name)
+    if level is not None:
+        return level
+    fallback = _parse_level(DEFAULT_LOG_LEVEL)
+    if fallback is None:
+        fallback = logging.INFO
+    logging.getLogger(__name__).warning(
+        f"Unknown log level {name!r} for {service}; using {logging.getLevelName(fallback)}."
+    )
+    return fallback
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, with json_fields merged in at the top level."""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "severity": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        entry.update(getattr(record, "json_fields", None) or {})
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+def _create_sink_handler() -> logging.Handler:
+    if LOG_TARGET == "stdout":
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(JsonFormatter())
+        return handler
+
+    from utils.gcp_clients import get_logging_client
+
+    return get_logging_client().get_default_handler()
+
+
+def configure(sink: logging.Handler = None, asynchronous: bool = LOG_ASYNC) -> logging.Handler:
+    """
+    Install the root handler: the sink itself, or a QueueHandler feeding the
+    sink from a background listener thread. Returns the handler attached to
+    the root logger.
+    """
+    global _listener
+    sink = sink or _create_sink_handler()
+    root = logging.getLogger()
+    with _lock:
+        stop()
+        if asynchronous:
+            _listener = QueueListener(queue.SimpleQueue(), sink, respect_handler_level=True)
+            _listener.start()
+            handler = QueueHandler(_listener.queue)
+        else:
+            handler = sink
+        for existing in list(root.handlers):
+            root.removeHandler(existing)
+        root.addHandler(handler)
+        root.setLevel(logging.getLevelName(DEFAULT_LOG_LEVEL.upper()))
+    return handler
+
+
+def stop():
+    """Drain queued records and stop the listener thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop)
+
+
+def log_payload(logger: logging.Logger, service: str, raw_data: str):
+    """Log a raw message payload, in full for 1 in PAYLOAD_SAMPLE_RATE messages."""
+    counter = _payload_counters.get(service)
+    if counter is None:
+        counter = _payload_counters.setdefault(service, itertools.count())
+    # next() on itertools.count is atomic under the GIL.
+    if PAYLOAD_SAMPLE_RATE > 0 and next(counter) % PAYLOAD_SAMPLE_RATE == 0:
+        logger.info(
+            "Raw message received (sampled): %s", raw_data,
+            extra={"json_fields": {"service": service, "payload_sampled": True}},
+        )
+    elif logger.isEnabledFor(logging.DEBUG):
+        truncated = raw_data if len(raw_data) <= PAYLOAD_MAX_CHARS else raw_data[:PAYLOAD_MAX_CHARS] + "..."
+        logger.debug(
+            "Raw message received: %s", truncated,
+            extra={"json_fields": {"service": service, "payload_bytes": len(raw_data)}},
+        )
@@ -0,0 +1,50 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from google.cloud.pubsub_v1.subscriber.scheduler import ThreadScheduler
+from google.cloud.pubsub_v1.types import FlowControl
+
+# Per-service defaults; each can be overridden with <SERVICE>_FLOW_MAX_MESSAGES,
+# <SERVICE>_FLOW_MAX_BYTES, <SERVICE>_FLOW_MAX_LEASE_SECONDS and
+# <SERVICE>_EXECUTOR_WORKERS (e.g. BULK_PTO_EXECUTOR_WORKERS).
+SERVICE_DEFAULTS = {
+    "bulk_pto": {"max_messages": 10, "max_bytes": 10 * 1024 * 1024, "max_lease_seconds": 600, "workers": 2},
+    "pto_deduction": {"max_messages": 1000, "max_bytes": 100 * 1024 * 1024, "max_lease_seconds": 3600, "workers": 10},
+    "pto_update": {"max_messages": 1000, "max_bytes": 100 * 1024 * 1024, "max_lease_seconds": 3600, "workers": 10},
+    "pto_usage": {"max_messages": 1000, "max_bytes": 100 * 1024 * 1024, "max_lease_seconds": 3600, "workers": 10},
+    "user_pto": {"max_messages": 500, "max_bytes": 10 * 1024 * 1024, "max_lease_seconds": 600, "workers": 16},
+}
+
+
+def _setting(service: str, name: str, key: str) -> int:
+    default = SERVICE_DEFAULTS[service][key]
+    return int(os.getenv(f"{service.upper()}_{name}", str(default)))
+
+
+def flow_control_for(service: str) -> FlowControl:
+    return FlowControl(
+        max_messages=_setting(service, "FLOW_MAX_MESSAGES", "max_messages"),
+        max_bytes=_setting(service, "FLOW_MAX_BYTES", "max_bytes"),
+        max_lease_duration=max_lease_seconds_for(service),
+    )
+
+
+def executor_workers_for(service: str) -> int:
+    return _setting(service, "EXECUTOR_WORKERS", "workers")
+
+
+def max_lease_seconds_for(service: str) -> int:
+    return _setting(service, "FLOW_MAX_LEASE_SECONDS", "max_lease_seconds")
+
+
+def scheduler_for(service: str) -> ThreadScheduler:
+    # A scheduler belongs to one streaming pull, so build a fresh one per subscribe().
+    executor = ThreadPoolExecutor(
+        max_workers=executor_workers_for(service),
+        thread_name_prefix=f"{service}-callback",
+    )
+    return ThreadScheduler(executor)
+
+
+def subscribe_options(service: str) -> dict:
+    return {"flow_control": flow_control_for(service), "scheduler": scheduler_for(service)}
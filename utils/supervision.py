@@ -0,0 +1,82 @@
+import os
+import time
+import random
+import threading
+import concurrent.futures
+
+RESTART_BACKOFF_BASE = float(os.getenv("PTO_RESTART_BACKOFF_BASE_SECONDS", "1"))
+RESTART_BACKOFF_MAX = float(os.getenv("PTO_RESTART_BACKOFF_MAX_SECONDS", "60"))
+# A worker that stays up this long is considered healthy again.
+STABLE_AFTER_SECONDS = float(os.getenv("PTO_RESTART_STABLE_AFTER_SECONDS", "60"))
+# Consecutive failures after which a service is reported as degraded.
+DEGRADED_AFTER_FAILURES = int(os.getenv("PTO_DEGRADED_AFTER_FAILURES", "3"))
+
+
+def backoff_delay(failures: int, base: float = RESTART_BACKOFF_BASE, maximum: float = RESTART_BACKOFF_MAX) -> float:
+    """Exponential backoff with jitter: uniform in [d/2, d] for d = base * 2^(failures-1)."""
+    delay = min(maximum, base * 2 ** max(0, failures - 1))
+    return random.uniform(delay / 2, delay)
+
+
+class ServiceHealth:
+    """
+    Consecutive-failure bookkeeping per service. Supervisors and listener
+    loops report failures and recoveries; /ready reports the pod unready
+    while any service is degraded.
+    """
+
+    def __init__(self, degraded_after: int = DEGRADED_AFTER_FAILURES):
+        self.degraded_after = degraded_after
+        self._services = {}
+        self._lock = threading.Lock()
+
+    def _entry(self, service: str) -> dict:
+        return self._services.setdefault(
+            service, {"consecutive_failures": 0, "total_failures": 0, "last_failure": None}
+        )
+
+    def record_failure(self, service: str) -> int:
+        with self._lock:
+            entry = self._entry(service)
+            entry["consecutive_failures"] += 1
+            entry["total_failures"] += 1
+            entry["last_failure"] = time.time()
+            return entry["consecutive_failures"]
+
+    def record_healthy(self, service: str):
+        with self._lock:
+            self._entry(service)["consecutive_failures"] = 0
+
+    def degraded(self) -> list:
+        with self._lock:
+            return [
+                service for service, entry in self._services.items()
+                if entry["consecutive_failures"] >= self.degraded_after
+            ]
+
+    def status(self) -> dict:
+        with self._lock:
+            return {
+                service: {**entry, "degraded": entry["consecutive_failures"] >= self.degraded_after}
+                for service, entry in self._services.items()
+            }
+
+
+health_registry = ServiceHealth()
+
+
+def await_stream(future, service: str):
+    """
+    Block on a streaming pull future. Once the stream has stayed up for
+    STABLE_AFTER_SECONDS the service's failure streak is cleared.
+    """
+    try:
+        return future.result(timeout=STABLE_AFTER_SECONDS)
+    except concurrent.futures.TimeoutError:
+        health_registry.record_healthy(service)
+    return future.result()
+
+
+def restart_delay(service: str) -> float:
+    """Record a listener failure and return how long to wait before resubscribing."""
+    return backoff_delay(health_registry.record_failure(service))